@@ -0,0 +1,115 @@
+"""Build synthetic `$JNL_DIR` trees for benchmarking.
+
+    python -m benchmarks.generate /tmp/jnl-10k --entries 10000
+"""
+
+import argparse
+import datetime
+import os
+import random
+from typing import List
+
+import jnl.system
+
+WORDS = (
+    "the of and to in is for on that with as was at by it from this be or are "
+    "deploy ticket meeting review perf regression latency build release notes "
+    "python git symlink journal index search todo done followup design doc"
+).split()
+
+
+class Params:
+    def __init__(
+        self,
+        entries: int = 1000,
+        mean_lines: int = 40,
+        max_lines: int = 2000,
+        tag_density: float = 0.05,
+        daily_fraction: float = 0.3,
+        quick_fraction: float = 0.2,
+        project_fraction: float = 0.1,
+        noscan_fraction: float = 0.05,
+        one_on_one_fraction: float = 0.02,
+        seed: int = 100,
+    ):
+        self.entries = entries
+        self.mean_lines = mean_lines
+        """Line counts are exponentially distributed around this"""
+        self.max_lines = max_lines
+        self.tag_density = tag_density
+        """Chance that any given body line carries a tag like @done or @ft"""
+        self.daily_fraction = daily_fraction
+        self.quick_fraction = quick_fraction
+        self.project_fraction = project_fraction
+        self.noscan_fraction = noscan_fraction
+        """Fraction of entries with @noscan followed by a pile of junk"""
+        self.one_on_one_fraction = one_on_one_fraction
+        """Fraction of entries with a @quick(One/person/date) line to convert"""
+        self.seed = seed
+
+    def as_dict(self) -> dict:
+        return dict(vars(self))
+
+
+def _line(rand: random.Random, params: Params) -> str:
+    words = rand.choices(WORDS, k=rand.randint(0, 14))
+    if rand.random() < params.tag_density:
+        tag = rand.choice(["@done", "@ft", "@todo"])
+        words.insert(rand.randint(0, len(words)), tag)
+    return " ".join(words)
+
+
+def _entry_lines(
+    rand: random.Random, params: Params, index: int, guid: str
+) -> List[str]:
+    lines = ["", "My Reference: %s  " % guid]
+    if index < params.entries * params.daily_fraction:
+        day = datetime.date(2021, 1, 1) - datetime.timedelta(days=index)
+        lines.append("@quick(daily/%s) @ft" % day.isoformat())
+    elif rand.random() < params.quick_fraction / (1 - params.daily_fraction):
+        lines.append("@quick(notes/topic-%d)" % index)
+    if rand.random() < params.one_on_one_fraction:
+        day = datetime.date(2021, 1, 1) - datetime.timedelta(days=index)
+        lines.append("@quick(One/Person %d/%s)" % (index % 10, day.isoformat()))
+    if rand.random() < params.project_fraction:
+        lines.append("@project(proj-%d/%d)" % (rand.randint(0, 20), index))
+    count = min(params.max_lines, int(rand.expovariate(1 / params.mean_lines)))
+    lines.extend(_line(rand, params) for _ in range(count))
+    if rand.random() < params.noscan_fraction:
+        lines.insert(rand.randint(2, len(lines)), "@noscan")
+        lines.extend("$ some pasted output %d @quick(ignored)" % i for i in range(200))
+    return lines
+
+
+def generate(root: str, params: Params) -> str:
+    """Create `root/worklogs` filled per `params`. Returns root."""
+    rand = random.Random(params.seed)
+    worklogs = os.path.join(root, "worklogs")
+    os.makedirs(worklogs, exist_ok=True)
+    state = random.getstate()
+    random.seed(params.seed)
+    try:
+        for index in range(params.entries):
+            guid = jnl.system.guid()
+            with open(os.path.join(worklogs, "%s.txt" % guid), "w") as handle:
+                handle.write("\n".join(_entry_lines(rand, params, index, guid)))
+                handle.write("\n")
+    finally:
+        random.setstate(state)
+    return root
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("root")
+    defaults = Params()
+    for name, value in defaults.as_dict().items():
+        flag = "--" + name.replace("_", "-")
+        parser.add_argument(flag, type=type(value), default=value)
+    args = vars(parser.parse_args(argv))
+    root = args.pop("root")
+    generate(root, Params(**args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+"""How much memory a loaded journal takes, in bytes per entry.
+
+    python -m benchmarks.memory --entries 10000
+
+Counts what's allocated (per tracemalloc) while loading every entry with
+its tags exactly as the CLI and the daemon do, so anything the load path
+keeps around (like file text) shows up. Run it with `--no-index` to parse
+every file rather than decoding tags from the index.
+"""
+
+import argparse
+import gc
+import shutil
+import sys
+import tempfile
+import tracemalloc
+
+from benchmarks.generate import Params, generate
+from jnl.database import Database
+
+
+def measure(root: str, use_index: bool) -> int:
+    """Bytes allocated to keep every entry of `root` and its tags loaded."""
+    if use_index:
+        # untimed: build the index so what's measured is a warm load
+        Database(entry_listeners=[], dbdir=root).entries
+    gc.collect()
+    tracemalloc.start()
+    try:
+        database = Database(entry_listeners=[], dbdir=root, use_index=use_index)
+        for entry in database.entries:
+            entry.tags
+        database.entries_with_tag("quick")
+        gc.collect()
+        size, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return size
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--entries", type=int, default=10000)
+    parser.add_argument("--no-index", action="store_true")
+    args = parser.parse_args(argv)
+
+    root = tempfile.mkdtemp(prefix="jnl-mem-")
+    try:
+        generate(root, Params(entries=args.entries, mean_lines=5))
+        size = measure(root, use_index=not args.no_index)
+    finally:
+        shutil.rmtree(root)
+    sys.stdout.write(
+        "%d entries: %d bytes, %.0f bytes/entry\n"
+        % (args.entries, size, size / args.entries)
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,254 @@
+"""Time jnl's hot paths against synthetic journals of various sizes.
+
+    python -m benchmarks.run --sizes 1000,10000 --output results.json
+    python -m benchmarks.run --sizes 1000,10000 --compare results.json
+
+Results are JSON so runs from different commits can be compared.
+"""
+
+import argparse
+import json
+import os
+import platform
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from itertools import islice
+from typing import Callable, Dict, List, Optional, Tuple, Union
+
+import jnl.system
+from benchmarks.generate import Params, generate
+from jnl.database import Database
+from jnl.listeners import PreScanQuickCleaner, SetsOpenWith, Symlinker
+
+
+def _listeners():
+    out = [Symlinker(), PreScanQuickCleaner()]
+    if platform.system() == "Darwin":
+        out.insert(0, SetsOpenWith())
+    return out
+
+
+def _database(root: str) -> Database:
+    return Database(entry_listeners=_listeners(), dbdir=root)
+
+
+Benchmark = Union[
+    Callable[[], object], Tuple[Callable[[], object], Callable[[], object]]
+]
+"""fn, or (setup, fn) where setup runs untimed before every repeat"""
+
+
+def _time(
+    fn: Callable[[], object], repeat: int, setup: Optional[Callable[[], object]]
+) -> List[float]:
+    out = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        fn()
+        out.append(time.perf_counter() - start)
+    return out
+
+
+def _fresh(root: str, fn: Callable[[Database], object]) -> Callable[[], object]:
+    """Run fn against a Database with nothing loaded yet (but a warm index)."""
+
+    def run():
+        database = _database(root)
+        database.entries
+        return fn(database)
+
+    return run
+
+
+def benchmarks(root: str) -> Dict[str, Benchmark]:
+    literal = re.compile("regression latency", re.I)
+    regex = re.compile(r"deploy\s+\w+\s+ticket")
+    common = re.compile("review")
+    worklogs = os.path.join(root, "worklogs")
+    pristine = os.path.join(root, "pristine-worklogs")
+
+    def entries_cold():
+        os.remove(os.path.join(root, ".jnl", "index.sqlite"))
+        _database(root).entries
+
+    def with_corpus():
+        # so these time the corpus even when run with --only
+        from jnl.corpus import Corpus
+
+        database = _database(root)
+        corpus = Corpus(database.state_path())
+        corpus.create()
+        corpus.update(database.entries)
+
+    def with_unconverted_worklogs():
+        # the first repeat converts everything; the rest would time a no-op
+        if not os.path.exists(pristine):
+            shutil.copytree(worklogs, pristine, symlinks=True)
+        else:
+            shutil.rmtree(worklogs)
+            shutil.copytree(pristine, worklogs, symlinks=True)
+        # the copies are new inodes: warm the index again
+        _database(root).entries
+
+    # jnl.corpus is imported only once it's used, as jnl itself does
+    def corpus_build(database: Database):
+        from jnl.corpus import Corpus
+
+        corpus = Corpus(database.state_path())
+        corpus.create()
+        corpus.update(database.entries, full=True)
+
+    def corpus_update(database: Database):
+        from jnl.corpus import Corpus
+
+        Corpus(database.state_path()).update(database.entries)
+
+    def convert(database: Database):
+        for entry in database.entries:
+            entry.convert_ft_tags_to_obsidian()
+
+    # Ordered: convert_ft_tags_to_obsidian rewrites files so it goes last.
+    return {
+        "entries_cold": entries_cold,
+        "entries": lambda: _database(root).entries,
+        "scan_full": _fresh(root, lambda d: d.scan(full=True)),
+        "scan": _fresh(root, lambda d: d.scan()),
+        "entries_matching_literal": _fresh(
+            root, lambda d: list(d.entries_matching(literal))
+        ),
+        "entries_matching_regex": _fresh(
+            root, lambda d: list(d.entries_matching(regex))
+        ),
+        "search_first_page": _fresh(
+            root, lambda d: list(islice(d.entries_matching(common), 10))
+        ),
+        # The rest search the packed corpus rather than each file.
+        "corpus_build": _fresh(root, corpus_build),
+        "corpus_update": (with_corpus, _fresh(root, corpus_update)),
+        "entries_matching_literal_corpus": (
+            with_corpus,
+            _fresh(root, lambda d: list(d.entries_matching(literal))),
+        ),
+        "entries_matching_regex_corpus": (
+            with_corpus,
+            _fresh(root, lambda d: list(d.entries_matching(regex))),
+        ),
+        "search_first_page_corpus": (
+            with_corpus,
+            _fresh(root, lambda d: list(islice(d.entries_matching(common), 10))),
+        ),
+        "daily_entry": _fresh(root, lambda d: d.daily_entry("2020-06-01")),
+        "yesterday_entry": _fresh(root, lambda d: d.yesterday_entry()),
+        "convert_ft_tags_to_obsidian": (
+            with_unconverted_worklogs,
+            _fresh(root, convert),
+        ),
+    }
+
+
+def _meta() -> Dict:
+    try:
+        commit = subprocess.check_output(
+            ["git", "rev-parse", "HEAD"],
+            cwd=os.path.dirname(__file__),
+            stderr=subprocess.DEVNULL,
+            text=True,
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "commit": commit,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "time": time.time(),
+    }
+
+
+def run(sizes: List[int], repeat: int, workdir: str, only: List[str] = None) -> Dict:
+    results = []
+    for size in sizes:
+        params = Params(entries=size)
+        root = os.path.join(workdir, "jnl-%d" % size)
+        shutil.rmtree(root, ignore_errors=True)
+        generate(root, params)
+        # Untimed: build the index and quick/ so the warm benchmarks are warm
+        _database(root).scan()
+        for name, benchmark in benchmarks(root).items():
+            if only and name not in only:
+                continue
+            setup, fn = benchmark if isinstance(benchmark, tuple) else (None, benchmark)
+            timings = _time(fn, repeat, setup)
+            results.append(
+                {
+                    "name": name,
+                    "entries": size,
+                    "seconds": min(timings),
+                    "runs": timings,
+                    "params": params.as_dict(),
+                }
+            )
+            sys.stderr.write("%-30s %9d %10.4fs\n" % (name, size, min(timings)))
+        shutil.rmtree(root)
+    return {"meta": _meta(), "results": results}
+
+
+def compare(baseline: Dict, current: Dict, threshold: float) -> bool:
+    """Print current/baseline ratios. False if anything got slower than
+    `threshold` times the baseline."""
+    before = {(r["name"], r["entries"]): r["seconds"] for r in baseline["results"]}
+    ok = True
+    for result in current["results"]:
+        key = (result["name"], result["entries"])
+        if key not in before:
+            continue
+        ratio = result["seconds"] / before[key] if before[key] else float("inf")
+        flag = ""
+        if ratio > threshold:
+            flag = "  REGRESSION"
+            ok = False
+        print("%-30s %9d %8.2fx%s" % (*key, ratio, flag))
+    return ok
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sizes", default="1000,10000")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--only", help="comma-separated benchmark names")
+    parser.add_argument("--workdir", help="where to generate journals")
+    parser.add_argument("--output", help="write JSON results here")
+    parser.add_argument("--compare", help="JSON results of a baseline run")
+    parser.add_argument("--threshold", type=float, default=1.25)
+    args = parser.parse_args(argv)
+
+    sizes = [int(s) for s in args.sizes.split(",")]
+    only = args.only.split(",") if args.only else None
+    workdir = args.workdir or tempfile.mkdtemp(prefix="jnl-bench-")
+    # Keep scan's "Scanning ..." chatter and the like out of the results.
+    with open(os.devnull, "w") as devnull:
+        stdout, sys.stdout = sys.stdout, devnull
+        try:
+            results = run(sizes, args.repeat, workdir, only)
+        finally:
+            sys.stdout = stdout
+
+    if args.output:
+        with open(args.output, "w") as handle:
+            json.dump(results, handle, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+    if args.compare:
+        with open(args.compare) as handle:
+            if not compare(json.load(handle), results, args.threshold):
+                sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
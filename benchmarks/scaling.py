@@ -0,0 +1,78 @@
+"""How `jnl search` scales with worker processes.
+
+    python -m benchmarks.scaling --entries 10000 --processes 1,2,4,8
+
+Times a full search (every result, so every file is searched) for a
+regex that's slow per line and rarely matches, first on threads as
+`jnl search` does by default and then with each number of worker
+processes, and reports the speedup over threads. There's no corpus, so
+every search reads the files.
+"""
+
+import argparse
+import os
+import re
+import shutil
+import sys
+import tempfile
+import time
+from typing import List
+
+from benchmarks.generate import Params, generate
+from jnl.database import Database
+
+PATTERN = re.compile(r"\b(\w+)\s+\1\b")
+"""The same word twice in a row: tried at every word, seldom found"""
+
+
+def measure(root: str, processes: int, repeat: int) -> float:
+    """Best of `repeat` full searches, in seconds."""
+    database = Database(entry_listeners=[], dbdir=root)
+    database.entries
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in database.entries_matching(PATTERN, processes=processes):
+            pass
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+        for entry in database.entries:
+            entry.forget_content()
+    return best
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--entries", type=int, default=10000)
+    parser.add_argument(
+        "--processes",
+        default=",".join(str(n) for n in (2, 4, 8, 16) if n <= (os.cpu_count() or 1))
+        or "2",
+        help="comma-separated process counts to try",
+    )
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args(argv)
+    counts: List[int] = [int(n) for n in args.processes.split(",")]
+
+    root = tempfile.mkdtemp(prefix="jnl-scaling-")
+    try:
+        generate(root, Params(entries=args.entries))
+        # untimed: build the index
+        Database(entry_listeners=[], dbdir=root).entries
+        threads = measure(root, 1, args.repeat)
+        sys.stdout.write(
+            "%d entries, %d cores\nthreads: %.3fs\n"
+            % (args.entries, os.cpu_count() or 1, threads)
+        )
+        for processes in counts:
+            elapsed = measure(root, processes, args.repeat)
+            sys.stdout.write(
+                "%d processes: %.3fs (%.1fx)\n"
+                % (processes, elapsed, threads / elapsed)
+            )
+    finally:
+        shutil.rmtree(root)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+"""Microbenchmark: tag extraction with the per-line `Tag.parse` loop versus
+the single-pass `Tag.scan` over the whole file, on synthetic entry bodies.
+
+    python -m benchmarks.tags --entries 5000
+"""
+
+import argparse
+import random
+import sys
+import time
+from typing import Callable, List
+
+import jnl.system
+from benchmarks.generate import Params, _entry_lines
+from jnl.entries import Entry, Tag, TagSet
+
+
+def per_line(text: str) -> List[Tag]:
+    """What `Entry.tags` did before `Tag.scan`."""
+    tags = []
+    for line in text.splitlines(keepends=True):
+        on_line = Tag.parse(line)
+        tags.extend(on_line)
+        if [t for t in on_line if t.name == "noscan"]:
+            break
+    return tags
+
+
+def bodies(params: Params) -> List[str]:
+    rand = random.Random(params.seed)
+    return [
+        "\n".join(_entry_lines(rand, params, index, jnl.system.guid())) + "\n"
+        for index in range(params.entries)
+    ]
+
+
+def _best(fn: Callable[[], object], repeat: int) -> float:
+    out = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        out.append(time.perf_counter() - start)
+    return min(out)
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--entries", type=int, default=5000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args(argv)
+
+    texts = bodies(Params(entries=args.entries))
+    for text in texts:
+        expected = [(t.name, t.value) for t in per_line(text)]
+        assert [(t.name, t.value) for t in Tag.scan(text)] == expected
+
+    results = {
+        "Tag.parse per line": _best(lambda: [per_line(t) for t in texts], args.repeat),
+        "Tag.scan": _best(lambda: [Tag.scan(t) for t in texts], args.repeat),
+        "Tag.scan + TagSet": _best(
+            lambda: [TagSet(Tag.scan(t)) for t in texts], args.repeat
+        ),
+        "ScanPolicy.tags": _best(
+            lambda: [Entry.SCAN_POLICY.tags(t) for t in texts], args.repeat
+        ),
+    }
+    baseline = results["Tag.parse per line"]
+    for name, seconds in results.items():
+        sys.stdout.write("%-20s %10.4fs %7.2fx\n" % (name, seconds, baseline / seconds))
+
+
+if __name__ == "__main__":
+    main()
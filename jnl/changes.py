@@ -0,0 +1,126 @@
+"""Ask git which worklogs changed rather than stat-ing every one of them.
+
+A `GitChanges` remembers the commit `HEAD` pointed to, along with the
+worklogs that had uncommitted changes, the last time it was `mark`ed. Later
+`since_mark` combines `git diff` from that commit with the current
+`git status` to list every worklog that may have changed in between."""
+
+import json
+import os
+import subprocess
+from typing import Dict, List, Optional, Set, Tuple
+
+import jnl.index
+import jnl.trace
+
+
+def _git(dbdir: str, *args: str) -> Optional[str]:
+    """Output of git or None if it failed (not a repo, unknown commit, ...)"""
+    with jnl.trace.span("git %s", args[0]):
+        try:
+            result = subprocess.run(
+                ["git", *args],
+                cwd=dbdir,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL,
+            )
+        except OSError:
+            return None
+    if result.returncode != 0:
+        return None
+    return os.fsdecode(result.stdout)
+
+
+def _worklog_names(paths: List[str], prefix: str) -> Set[str]:
+    """File names of the worklogs among `paths`, which git gives relative to
+    the top of the repository rather than to `$JNL_DIR`."""
+    worklogs = prefix + "worklogs/"
+    return {p[len(worklogs) :] for p in paths if p.startswith(worklogs)}
+
+
+def git_status(dbdir: str) -> Optional[Tuple[str, str, Set[str]]]:
+    """(path of dbdir within the repo, HEAD, names of worklogs with
+    uncommitted changes) or None if dbdir isn't in a git repo with commits.
+    Renames count as changes to both names; untracked worklogs count too."""
+    out = _git(dbdir, "rev-parse", "--show-prefix", "HEAD")
+    if out is None:
+        return None
+    prefix, head = out.split("\n")[:2]
+    out = _git(
+        dbdir, "status", "--porcelain", "-z", "--untracked-files=all", "worklogs"
+    )
+    if out is None:
+        return None
+    paths = []
+    records = iter(out.split("\0"))
+    for record in records:
+        if not record:
+            continue
+        paths.append(record[3:])
+        if record[0] in "RC":
+            # followed by the name it was renamed or copied from
+            paths.append(next(records))
+    return prefix, head, _worklog_names(paths, prefix)
+
+
+class GitChanges:
+    MIN_ENTRIES = 2000
+    """Below this many entries stat-ing every worklog is quicker than
+    starting git, so callers shouldn't bother"""
+
+    def __init__(self, dbdir: str, name: str):
+        self.dbdir = dbdir
+        self.state_file = os.path.join(dbdir, ".jnl", "%s.json" % name)
+        self._seen: Optional[Dict] = None
+
+    def since_mark(self) -> Optional[Set[str]]:
+        """Names of the worklogs that may differ from when `mark` was last
+        called, or None if there's no telling: not a git journal, never
+        marked, or the marked commit is gone (e.g. after a rebase).
+
+        Worklogs git ignores aren't seen at all."""
+        status = git_status(self.dbdir)
+        self._seen = None
+        if status is None:
+            return None
+        prefix, head, dirty = status
+        self._seen = {"head": head, "dirty": sorted(dirty)}
+        try:
+            with open(self.state_file) as handle:
+                marked = json.load(handle)
+        except (OSError, ValueError):
+            return None
+        # Anything dirty back then may have been reverted since.
+        changed = dirty | set(marked["dirty"])
+        if marked["head"] != head:
+            # without renames, both names of a renamed worklog are listed
+            out = _git(
+                self.dbdir,
+                "diff",
+                "--name-only",
+                "--no-renames",
+                "-z",
+                marked["head"],
+                head,
+            )
+            if out is None:
+                return None
+            changed |= _worklog_names(out.split("\0"), prefix)
+        jnl.trace.count("worklogs changed per git", len(changed))
+        return changed
+
+    def mark(self) -> None:
+        """Remember what the last `since_mark` saw. Call once whatever it
+        reported has been dealt with."""
+        if self._seen is None:
+            self.forget()
+            return
+        jnl.index.ensure_state_dir(os.path.dirname(self.state_file))
+        with open(self.state_file, "w") as handle:
+            json.dump(self._seen, handle)
+
+    def forget(self) -> None:
+        """For when changes were picked up some other way (e.g. by stat-ing
+        everything): the next `since_mark` can't tell what changed."""
+        if os.path.exists(self.state_file):
+            os.unlink(self.state_file)
@@ -1,19 +1,35 @@
 import os
 import re
 import sys
+from typing import Any, Dict, Pattern, Set
 
 import jnl.system
+import jnl.trace
 
-import jnl.search
+import jnl.daemon
+import jnl.layout
 from jnl.database import Database
-from jnl.listeners import SetsOpenWith, Symlinker, PreScanQuickCleaner
+from jnl.entries import Entry
+from jnl.listeners import (
+    SetsOpenWith,
+    Symlinker,
+    PreScanQuickCleaner,
+    Summarizer,
+    CorpusUpdater,
+)
 
 
 class Main(object):
     def __init__(self, dbdir: str = None):
         self.database = Database(
             dbdir=dbdir,
-            entry_listeners=[SetsOpenWith(), Symlinker(), PreScanQuickCleaner()],
+            entry_listeners=[
+                SetsOpenWith(),
+                Symlinker(),
+                PreScanQuickCleaner(),
+                Summarizer(),
+                CorpusUpdater(),
+            ],
         )
 
     def open(self, argv):
@@ -23,18 +39,76 @@ class Main(object):
         jnl.system.open_entry(self.database.create_entry())
 
     def sync(self, argv):
+        import asyncio
+
+        asyncio.run(self._sync(argv))
+
+    async def _sync(self, argv):
+        import asyncio
+
         git_dir = self.database.path()
-        jnl.system.git_pull(git_dir)
-        self.scan(argv)
-        jnl.system.git_stat(git_dir)
+        before = await jnl.system.git_head(git_dir)
+        # Load entries (from the index where possible) while pull is busy
+        # talking to the remote.
+        await asyncio.gather(
+            jnl.system.git_async(git_dir, "pull"),
+            asyncio.to_thread(self._load_entries),
+        )
+        changed = None
+        if before is not None:
+            pulled = await jnl.system.git_changed_since(git_dir, before)
+            changed = {
+                p[len("worklogs/") :] for p in pulled if p.startswith("worklogs/")
+            }
+        if changed is None or changed:
+            # Only the files the pull touched get re-read
+            self.database.refresh()
+        self.scan(argv, changed=changed)
+        await jnl.system.git_async(git_dir, "status")
         if len(argv) > 2 and argv[2] == "push":
-            jnl.system.git_autopush(git_dir)
+            await jnl.system.git_async(git_dir, "autopush")
+
+    def _load_entries(self) -> None:
+        for entry in self.database.entries:
+            entry.tags
 
     def rename_daily(self, argv):
         entries = [x for x in self.database.entries if x.is_a_daily_entry()]
-        for entry in entries:
-            daily = entry.is_a_daily_entry()
-            entry.rename_file(f"{daily}.txt")
+        renames = [
+            (entry, f"{entry.is_a_daily_entry()}.txt")
+            for entry in entries
+            if entry.file_name != f"{entry.is_a_daily_entry()}.txt"
+        ]
+        if "--dry-run" in argv:
+            for entry, new_name in renames:
+                print(f"{entry.file_name} -> {new_name}")
+            return
+        self.database.rename_entries(renames)
+
+    def reshard(self, argv):
+        if len(argv) < 3 or argv[2] not in jnl.layout.LAYOUTS:
+            raise ValueError(
+                "Usage: jnl reshard {%s} [--dry-run]" % ",".join(jnl.layout.LAYOUTS)
+            )
+        layout = argv[2]
+        worklogs = self.database.path("worklogs")
+        moves = jnl.layout.moves(self.database.entries, layout)
+        if "--dry-run" in argv:
+            for entry, new_path in moves:
+                print(f"{entry.relative_path()} -> {new_path}")
+            return
+        self.database.move_entries(moves)
+        jnl.layout.write(worklogs, layout)
+        jnl.layout.prune(worklogs)
+        if jnl.system.in_git_repo(worklogs):
+            jnl.system.git_stage(worklogs, jnl.layout.LAYOUT_FILE)
+        print(f"Moved {len(moves)} entries")
+        # quick/ links still point at the old locations
+        self.database.scan()
+
+    def summarize(self, argv):
+        for summary in Summarizer.summarize(self.database, force="--full" in argv):
+            print(f"Wrote summary/{summary}.txt")
 
     def rename_single_quick(self, argv):
         entries = [x for x in self.database.entries if x.single_quick_entry()]
@@ -44,22 +118,72 @@ class Main(object):
             print(f"{quick}: {entry.guid}")
 
     def convert_to_obsidian_tags_one(self, argv):
-        for entry in self.database.entries:
-            entry.convert_ft_tags_to_obsidian()
+        import jnl.rewrite
 
-    def search(self, argv):
+        changes = jnl.rewrite.plan(
+            self.database.entries,
+            [Entry.ft_tag_to_obsidian],
+            jobs=int(_option(argv, "--jobs", str(os.cpu_count() or 1))),
+        )
+        if "--dry-run" in argv:
+            jnl.rewrite.print_diff(changes, sys.stdout)
+            return
+        jnl.rewrite.apply(changes)
+        print(f"Converted {len(changes)} entries")
+        # Rewriting replaces the files, losing their xattrs; put them back.
+        self.database.scan()
+
+    @staticmethod
+    def search_pattern(argv) -> Pattern[str]:
         pat_source: str = argv[2]
 
         if not pat_source.startswith("/"):
-            pattern = re.compile(pat_source, re.I)
-        else:
-            if not pat_source.endswith("/"):
-                raise ValueError(
-                    "Pattern '{}' must begin and end with /".format(pat_source)
-                )
-            pat_source = pat_source[1:-1]
-            pattern = re.compile(pat_source)
-        return jnl.search.search(database=self.database, pattern=pattern)
+            return re.compile(pat_source, re.I)
+        if not pat_source.endswith("/"):
+            raise ValueError(
+                "Pattern '{}' must begin and end with /".format(pat_source)
+            )
+        return re.compile(pat_source[1:-1])
+
+    @staticmethod
+    def search_filters(argv) -> Dict[str, Any]:
+        """`--since`/`--until` (anything dateparser understands, e.g.
+        "2 weeks ago"), `--rank` and `--processes` (0 for one per core) as
+        keyword args for `entries_matching`."""
+        out: Dict[str, Any] = {"rank": "--rank" in argv}
+        processes = _option(argv, "--processes")
+        if processes is not None:
+            out["processes"] = int(processes) or os.cpu_count() or 1
+        for name in ("since", "until"):
+            value = _option(argv, "--" + name)
+            if value is not None:
+                when = jnl.system.parse(value)
+                if when is None:
+                    raise ValueError("Can't make sense of --%s %s" % (name, value))
+                out[name] = when
+        return out
+
+    def search(self, argv):
+        import jnl.search
+
+        pattern = Main.search_pattern(argv)
+        return jnl.search.search(
+            database=self.database, pattern=pattern, **Main.search_filters(argv)
+        )
+
+    def find(self, argv):
+        if len(argv) < 3:
+            raise ValueError("Usage: jnl find EXPRESSION [--open]")
+        # `jnl find @done OR @todo` needn't be quoted
+        expression = " ".join(a for a in argv[2:] if a != "--open")
+        for entry in self.database.query(expression):
+            if "--open" in argv:
+                jnl.system.open_entry(entry)
+            else:
+                print(f"{entry.file_path()}  {' '.join(map(str, entry.tags))}")
+
+    def daemon(self, argv):
+        jnl.daemon.Daemon(self).serve_forever()
 
     def stat(self, _):
         git_dir = self.database.path()
@@ -78,6 +202,10 @@ class Main(object):
             return self.proj(argv)
         if argv[1] == "search":
             return self.search(argv)
+        if argv[1] == "find":
+            return self.find(argv)
+        if argv[1] == "daemon":
+            return self.daemon(argv)
         if argv[1] == "new":
             return self.new(argv)
         if argv[1] == "daily" or argv[1] == "today" or argv[1] == "t":
@@ -94,14 +222,29 @@ class Main(object):
             return self.sync(argv)
         if argv[1] == "rename-daily":
             return self.rename_daily(argv)
+        if argv[1] == "summarize":
+            return self.summarize(argv)
+        if argv[1] == "reshard":
+            return self.reshard(argv)
         if argv[1] == "rename-single-quick":
             return self.rename_single_quick(argv)
         if argv[1] == "convert-to-obsidian-tags-one":
             return self.convert_to_obsidian_tags_one(argv)
         raise ValueError("Don't know about action {}".format(argv[1]))
 
-    def scan(self, _):
-        self.database.scan()
+    def scan(self, argv, changed: Set[str] = None):
+        jobs = int(_option(argv, "--jobs", "1"))
+        if jobs < 1:
+            jobs = os.cpu_count() or 1
+        if "--corpus" in argv or "--no-corpus" in argv:
+            import jnl.corpus
+
+            corpus = jnl.corpus.Corpus(self.database.state_path())
+            if "--corpus" in argv:
+                corpus.create()
+            else:
+                corpus.delete()
+        self.database.scan(jobs=jobs, full="--full" in argv, changed=changed)
 
     def yesterday(self):
         daily = self.database.yesterday_entry()
@@ -114,16 +257,77 @@ class Main(object):
         self.database.scan()
 
 
+def _option(argv, name: str, default: str = None) -> str:
+    """Value of `--name value` or `--name=value` in argv."""
+    for i, arg in enumerate(argv):
+        if arg == name and i + 1 < len(argv):
+            return argv[i + 1]
+        if arg.startswith(name + "="):
+            return arg[len(name) + 1 :]
+    return default
+
+
 def empty_fixture_path():
     return os.path.join(
         os.path.dirname(os.path.realpath(__file__)), "fixtures", "empty"
     )
 
 
+def profile_startup(args) -> int:
+    """Re-run jnl with `python -X importtime` and summarize where the time
+    spent importing modules went."""
+    import subprocess
+
+    run_main = "import sys, jnl.cli; jnl.cli.main(sys.argv)"
+    command = [sys.executable, "-X", "importtime", "-c", run_main, *args[1:]]
+    process = subprocess.run(command, stderr=subprocess.PIPE, text=True)
+    timings = []
+    for line in process.stderr.splitlines():
+        if not line.startswith("import time:"):
+            sys.stderr.write(line + "\n")
+            continue
+        parts = line[len("import time:") :].split("|")
+        if not parts[0].strip().isdigit():
+            continue  # header
+        self_us, cumulative_us, module = int(parts[0]), int(parts[1]), parts[2]
+        timings.append((cumulative_us, self_us, module.strip()))
+    total = sum(self_us for _, self_us, _ in timings)
+    sys.stderr.write("%10s %10s  module\n" % ("cumul ms", "self ms"))
+    for cumulative_us, self_us, module in sorted(timings, reverse=True)[:25]:
+        sys.stderr.write(
+            "%10.1f %10.1f  %s\n" % (cumulative_us / 1000, self_us / 1000, module)
+        )
+    sys.stderr.write(
+        "%10.1f %10s  total (%d modules)\n" % (total / 1000, "", len(timings))
+    )
+    return process.returncode
+
+
 def main(args=None):
     if args is None:
         args = sys.argv
+    if "--profile-startup" in args:
+        sys.exit(profile_startup([a for a in args if a != "--profile-startup"]))
     if "JNL_DIR" not in os.environ:
         os.environ["JNL_DIR"] = empty_fixture_path()
+    trace = [a for a in args if a == "--trace" or a.startswith("--trace=")]
+    if trace:
+        args = [a for a in args if a not in trace]
+        return run_traced(args, trace[0][len("--trace=") :])
+    if jnl.daemon.forward(os.environ["JNL_DIR"], args):
+        return
     mainv = Main()
     mainv.run(args)
+
+
+def run_traced(args, chrome_trace_path: str = None):
+    """Run locally (not in the daemon) with tracing on, then print where the
+    time went and optionally write a Chrome trace to chrome_trace_path."""
+    jnl.trace.enable()
+    try:
+        with jnl.trace.span("jnl %s", " ".join(args[1:])):
+            Main().run(args)
+    finally:
+        jnl.trace.report(sys.stderr)
+        if chrome_trace_path:
+            jnl.trace.dump_chrome_trace(chrome_trace_path)
@@ -0,0 +1,436 @@
+"""A packed copy of every entry's text so `jnl search` can run its regex
+over one memory-mapped file instead of opening thousands of small ones.
+
+`.jnl/corpus.json` lists the segments of `.jnl/corpus-N.txt`: for each
+entry its path, guid, the mtime/size the text was copied at, and where
+the text sits (in characters, for searching, and in bytes, for copying).
+Every segment is followed by a newline so no line runs into the next
+entry's first line.
+
+Updates only append the entries whose files changed; the segments they
+replace just stop being listed. Once more of the file is dead than alive
+it's rewritten (as the next N) with only the live segments. Searches
+check each entry's stat against its segment and leave any that don't
+match to be searched the usual way, so a stale corpus only costs speed.
+
+Opt in with `jnl scan --corpus`; from then on scans keep it current."""
+
+import bisect
+import json
+import os
+import re
+import tempfile
+from contextlib import contextmanager
+from typing import (
+    TYPE_CHECKING,
+    AnyStr,
+    Callable,
+    Dict,
+    Iterator,
+    List,
+    Match,
+    NamedTuple,
+    Optional,
+    Pattern,
+    Set,
+    Tuple,
+    Union,
+)
+
+import jnl.trace
+from jnl.entries import Entry, EntryMatch
+from jnl.index import ensure_state_dir
+
+if TYPE_CHECKING:
+    import mmap
+
+_UNSUPPORTED_RE = re.compile(r"\\[AZ]|\(\?<?[=!]")
+"""Constructs that could match a line on its own but not the same line in
+the middle of the corpus (or vice versa)"""
+
+MIN_DEAD_CHARS = 1 << 20
+"""Don't bother compacting until at least this much text is dead"""
+
+WINDOW_BYTES = 8 << 20
+"""How much of the corpus a whole-corpus search decodes at a time"""
+
+
+class Segment(NamedTuple):
+    relative_path: str
+    guid: str
+    mtime_ns: int
+    size: int
+    char_offset: int
+    chars: int
+    """length of the entry's text, not counting the newline after it"""
+    byte_offset: int
+    byte_length: int
+    """including the newline after it"""
+
+
+class Corpus:
+    def __init__(self, state_dir: str):
+        self.state_dir = state_dir
+        self.table_path = os.path.join(state_dir, "corpus.json")
+
+    def exists(self) -> bool:
+        return os.path.exists(self.table_path)
+
+    def create(self) -> None:
+        """Start keeping a corpus; the next `update` fills it."""
+        if not self.exists():
+            self._save(_Table())
+
+    def delete(self) -> None:
+        table = self._load()
+        if table is not None and os.path.exists(self._data_path(table)):
+            os.unlink(self._data_path(table))
+        if self.exists():
+            os.unlink(self.table_path)
+
+    def update(
+        self, entries: List[Entry], full: bool = False, changed: Set[str] = None
+    ) -> None:
+        """Append the text of entries whose files changed since they were
+        copied. `changed` is the paths (relative to worklogs/) of the only
+        entries that may have; with `full` everything is copied afresh."""
+        with jnl.trace.span("Corpus.update"):
+            self._update(entries, full, changed)
+
+    def _update(self, entries: List[Entry], full: bool, changed: Optional[Set[str]]):
+        table = self._load()
+        if table is None:
+            return
+        if full:
+            self._discard(table)
+            table = _Table(generation=table.generation + 1)
+        by_path = {s.relative_path: s for s in table.segments}
+        live: List[Segment] = []
+        appends: List[Tuple[Entry, os.stat_result]] = []
+        for entry in entries:
+            relative_path = entry.relative_path()
+            segment = by_path.pop(relative_path, None)
+            if changed is not None and relative_path not in changed:
+                if segment is not None and segment.guid == entry.guid:
+                    live.append(segment)
+                    continue
+            try:
+                stat = os.stat(entry.file_path())
+            except FileNotFoundError:
+                continue
+            if segment is not None and segment[1:4] == (
+                entry.guid,
+                stat.st_mtime_ns,
+                stat.st_size,
+            ):
+                live.append(segment)
+            else:
+                appends.append((entry, stat))
+        jnl.trace.count("syscall stat", len(entries))
+        if not appends and len(live) == len(table.segments):
+            return
+        data_path = self._data_path(table)
+        with open(data_path, "ab") as f:
+            # drop anything appended by an update that didn't finish
+            f.truncate(table.bytes)
+            for entry, stat in appends:
+                try:
+                    with open(entry.file_path()) as source:
+                        text = source.read()
+                except FileNotFoundError:
+                    continue
+                jnl.trace.count("file opens")
+                data = (text + "\n").encode("utf-8")
+                f.write(data)
+                live.append(
+                    Segment(
+                        entry.relative_path(),
+                        entry.guid,
+                        stat.st_mtime_ns,
+                        stat.st_size,
+                        table.chars,
+                        len(text),
+                        table.bytes,
+                        len(data),
+                    )
+                )
+                table.chars += len(text) + 1
+                table.bytes += len(data)
+        live.sort(key=lambda s: s.char_offset)
+        table.segments = live
+        alive = sum(s.chars + 1 for s in live)
+        if table.chars - alive > max(alive, MIN_DEAD_CHARS):
+            self._compact(table)
+        else:
+            self._save(table)
+        jnl.trace.count("corpus segments appended", len(appends))
+
+    def _compact(self, table: "_Table") -> None:
+        """Pack table's live segments into the next data file."""
+        out = _Table(generation=table.generation + 1)
+        with open(self._data_path(table), "rb") as old, open(
+            self._data_path(out), "wb"
+        ) as new:
+            for segment in table.segments:
+                old.seek(segment.byte_offset)
+                new.write(old.read(segment.byte_length))
+                out.segments.append(
+                    segment._replace(char_offset=out.chars, byte_offset=out.bytes)
+                )
+                out.chars += segment.chars + 1
+                out.bytes += segment.byte_length
+        # the new table goes in before the old data goes away
+        self._save(out)
+        self._discard(table)
+
+    def matches(
+        self,
+        pattern: Pattern[AnyStr],
+        entries: List[Entry],
+        stats: Dict[str, Tuple[int, int]],
+        ordered: bool = True,
+    ) -> Optional[Iterator[Tuple[str, List[EntryMatch]]]]:
+        """(guid, matches) for each of `entries` matching `pattern`, in the
+        order of `entries` or, unless `ordered`, in whatever order one pass
+        over the whole corpus finds them. `stats` has each entry's current
+        (mtime_ns, size) by guid; entries that don't match their segment
+        (changed since it was copied, or missing) are searched from their
+        files. None if there's no corpus or it can't do this pattern."""
+        search = multiline_search(pattern)
+        if search is None:
+            return None
+        table = self._load()
+        if table is None:
+            return None
+        by_guid = {s.guid: s for s in table.segments}
+        wanted: List[Tuple[Entry, Optional[Segment]]] = []
+        for entry in entries:
+            segment = by_guid.get(entry.guid)
+            if segment is not None and (
+                segment.relative_path != entry.relative_path()
+                or (segment.mtime_ns, segment.size) != stats.get(entry.guid)
+            ):
+                segment = None
+            wanted.append((entry, segment))
+        jnl.trace.count("corpus entries stale", sum(1 for _, s in wanted if s is None))
+        if ordered:
+            return self._each(table, pattern, search, wanted)
+        return self._all(table, pattern, search, wanted)
+
+    def _each(
+        self,
+        table: "_Table",
+        pattern: Pattern[str],
+        search: Callable[..., Optional[Match[str]]],
+        wanted: List[Tuple[Entry, Optional[Segment]]],
+    ) -> Iterator[Tuple[str, List[EntryMatch]]]:
+        """Searches the segments one at a time in the order asked for, so
+        the first results come back without reading the rest."""
+        with self._mapped(table) as mapped:
+            for entry, segment in wanted:
+                if segment is None:
+                    found = entry.matches(pattern)
+                else:
+                    # without the newline after it
+                    end = segment.byte_offset + segment.byte_length - 1
+                    text = str(mapped[segment.byte_offset : end], "utf-8")
+                    found = _matches(pattern, search, entry, text, 0, len(text))
+                if found:
+                    yield entry.guid, found
+
+    def _all(
+        self,
+        table: "_Table",
+        pattern: Pattern[str],
+        search: Callable[..., Optional[Match[str]]],
+        wanted: List[Tuple[Entry, Optional[Segment]]],
+    ) -> Iterator[Tuple[str, List[EntryMatch]]]:
+        """One regex pass over the corpus, a window of whole segments (see
+        `WINDOW_BYTES`) at a time so only that much is ever decoded. Each
+        hit is mapped back to its entry by a binary search over where the
+        window's segments start."""
+        entries = {s.char_offset: e for e, s in wanted if s is not None}
+        with self._mapped(table) as mapped:
+            for window in _windows(table.segments):
+                first, last = window[0], window[-1]
+                with jnl.trace.span("Corpus pass"):
+                    end = last.byte_offset + last.byte_length
+                    text = str(mapped[first.byte_offset : end], "utf-8")
+                yield from _window_matches(pattern, search, text, window, entries)
+        for entry, segment in wanted:
+            if segment is None:
+                found = entry.matches(pattern)
+                if found:
+                    yield entry.guid, found
+
+    @contextmanager
+    def _mapped(self, table: "_Table") -> Iterator[Union[bytes, "mmap.mmap"]]:
+        import mmap
+
+        if not table.bytes:
+            yield b""
+            return
+        with open(self._data_path(table), "rb") as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                yield mapped
+
+    def _data_path(self, table: "_Table") -> str:
+        return os.path.join(self.state_dir, "corpus-%d.txt" % table.generation)
+
+    def _discard(self, table: "_Table") -> None:
+        if os.path.exists(self._data_path(table)):
+            os.unlink(self._data_path(table))
+
+    def _load(self) -> Optional["_Table"]:
+        try:
+            with open(self.table_path) as handle:
+                raw = json.load(handle)
+        except (OSError, ValueError):
+            return None
+        table = _Table(raw["generation"], raw["chars"], raw["bytes"])
+        table.segments = [Segment(*s) for s in raw["segments"]]
+        if os.path.exists(self._data_path(table)):
+            if os.path.getsize(self._data_path(table)) >= table.bytes:
+                return table
+        if table.bytes:
+            # data file went missing; start over
+            return _Table(generation=table.generation + 1)
+        return table
+
+    def _save(self, table: "_Table") -> None:
+        ensure_state_dir(self.state_dir)
+        handle, temp_path = tempfile.mkstemp(dir=self.state_dir, suffix=".tmp")
+        try:
+            with os.fdopen(handle, "w") as f:
+                json.dump(
+                    {
+                        "generation": table.generation,
+                        "chars": table.chars,
+                        "bytes": table.bytes,
+                        "segments": table.segments,
+                    },
+                    f,
+                )
+            os.replace(temp_path, self.table_path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+
+
+def _windows(segments: List[Segment]) -> Iterator[List[Segment]]:
+    """Runs of consecutive segments spanning at most WINDOW_BYTES (or just
+    one segment, if it's bigger than that on its own)."""
+    window: List[Segment] = []
+    for segment in segments:
+        if window and (
+            segment.byte_offset + segment.byte_length - window[0].byte_offset
+            > WINDOW_BYTES
+        ):
+            yield window
+            window = []
+        window.append(segment)
+    if window:
+        yield window
+
+
+def _window_matches(
+    pattern: Pattern[str],
+    search: Callable[..., Optional[Match[str]]],
+    text: str,
+    window: List[Segment],
+    entries: Dict[int, Entry],
+) -> Iterator[Tuple[str, List[EntryMatch]]]:
+    """(guid, matches) for each of `entries` (by char offset) among the
+    segments of window, whose text is `text`."""
+    base = window[0].char_offset
+    starts = [s.char_offset - base for s in window]
+    position = 0
+    while True:
+        hit = search(text, position)
+        if hit is None:
+            return
+        index = bisect.bisect_right(starts, hit.start()) - 1
+        # whatever this hit is, carry on at the next segment
+        position = starts[index + 1] if index + 1 < len(starts) else None
+        segment = window[index]
+        start, end = starts[index], starts[index] + segment.chars
+        entry = entries.get(segment.char_offset)
+        if entry is not None and hit.start() < end:
+            # not dead text or the newline after the segment
+            found = _matches(pattern, search, entry, text, start, end)
+            if found:
+                yield entry.guid, found
+        if position is None:
+            return
+
+
+def multiline_search(
+    pattern: Pattern[AnyStr],
+) -> Optional[Callable[..., Optional[Match[str]]]]:
+    """`search` of pattern but with ^ and $ matching at every line, like
+    they do when each line is searched on its own, so any line that matches
+    `pattern` is found searching the whole text at once. None if pattern
+    can't be trusted to do that."""
+    if not isinstance(pattern.pattern, str) or pattern.flags & re.DOTALL:
+        return None
+    if _UNSUPPORTED_RE.search(pattern.pattern):
+        return None
+    return re.compile(pattern.pattern, pattern.flags | re.MULTILINE).search
+
+
+def line_matches(
+    pattern: Pattern[str],
+    search: Callable[..., Optional[Match[str]]],
+    text: str,
+    start: int,
+    end: int,
+) -> Iterator[Tuple[int, Match[str]]]:
+    """(line index, match) for each line of text[start:end] that `pattern`
+    matches, the match made against the line alone. `search` (see
+    `multiline_search`) finds the lines worth trying; a hit may run past its
+    line or be a false start, so it's only a hint."""
+    position = start
+    counted, line_index = start, 0
+    while True:
+        hit = search(text, position, end)
+        if hit is None:
+            return
+        at = hit.start()
+        line_start = text.rfind("\n", start, at) + 1 or start
+        if line_start >= end:
+            # after the final newline: there's no line there
+            return
+        line_end = text.find("\n", at, end)
+        line_end = end if line_end == -1 else line_end + 1
+        match = pattern.search(text[line_start:line_end])
+        if match is not None:
+            line_index += text.count("\n", counted, line_start)
+            counted = line_start
+            yield line_index, match
+        if line_end >= end:
+            return
+        position = line_end
+
+
+def _matches(
+    pattern: Pattern[str],
+    search: Callable[..., Optional[Match[str]]],
+    entry: Entry,
+    text: str,
+    start: int,
+    end: int,
+) -> List[EntryMatch]:
+    """What `entry.matches(pattern)` would return, given that text[start:end]
+    is the entry's text."""
+    return [
+        EntryMatch(entry, match, line_index)
+        for line_index, match in line_matches(pattern, search, text, start, end)
+    ]
+
+
+class _Table:
+    def __init__(self, generation: int = 0, chars: int = 0, bytes: int = 0):
+        self.generation = generation
+        self.chars = chars
+        self.bytes = bytes
+        self.segments: List[Segment] = []
@@ -0,0 +1,254 @@
+"""`jnl daemon` keeps a Database loaded and answers CLI requests over a Unix
+socket at `$JNL_DIR/.jnl/daemon.sock`. `worklogs/` is watched (inotify on
+Linux, polling elsewhere) so entries and `quick/` stay current between
+requests. When the socket is there, `jnl` forwards commands to the daemon
+rather than loading everything itself."""
+
+import io
+import json
+import os
+import select
+import socket
+import struct
+import sys
+import threading
+import time
+import traceback
+from contextlib import redirect_stdout
+from typing import Callable, Dict, List, Optional, Tuple
+
+# `forward` runs on every jnl invocation so the heavier imports that only
+# the daemon itself needs (ctypes, socketserver, jnl.search) are deferred.
+
+
+def socket_path(dbdir: str) -> str:
+    return os.path.join(dbdir, ".jnl", "daemon.sock")
+
+
+def forwardable(argv: List[str]) -> bool:
+    """Commands the daemon can run; mirrors the dispatch in `Main.run`."""
+    if len(argv) == 1 or argv[1].startswith("p"):
+        return True
+    return argv[1] in {
+        "search",
+        "daily",
+        "today",
+        "t",
+        "y",
+        "yesterday",
+        "yd",
+        "scan",
+        "open",
+    }
+
+
+def _request(path: str, request: Dict) -> Dict:
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(path)
+        sock.sendall(json.dumps(request).encode() + b"\n")
+        sock.shutdown(socket.SHUT_WR)
+        with sock.makefile("rb") as handle:
+            return json.loads(handle.read())
+
+
+def forward(dbdir: str, argv: List[str]) -> bool:
+    """Run argv in a running daemon. Returns False (and does nothing) if the
+    command can't be forwarded or no daemon is listening."""
+    path = socket_path(dbdir)
+    if not forwardable(argv) or not os.path.exists(path):
+        return False
+    request = {"argv": argv, "cwd": os.environ.get("JNL_ORIG_CWD", os.getcwd())}
+    try:
+        response = _request(path, request)
+    except (ConnectionRefusedError, FileNotFoundError):
+        # stale socket from a daemon that didn't shut down cleanly
+        return False
+    sys.stdout.write(response["output"])
+    if response.get("error") is not None:
+        sys.stderr.write(response["error"])
+        raise SystemExit(1)
+    options: Optional[Dict[str, str]] = response.get("options")
+    if options is not None:
+        choice = input("? ")
+        forward(dbdir, [argv[0], "open", options[str(int(choice))]])
+    return True
+
+
+class Daemon:
+    def __init__(self, main, poll_interval: float = 2.0):
+        self.main = main
+        self.database = main.database
+        self.poll_interval = poll_interval
+        self.lock = threading.Lock()
+        """Held while running a request or applying changes to the Database"""
+
+    def handle(self, request: Dict) -> Dict:
+        import jnl.search
+
+        argv: List[str] = request["argv"]
+        out = io.StringIO()
+        response = {"output": "", "error": None}
+        with self.lock:
+            old_cwd = os.environ.get("JNL_ORIG_CWD")
+            os.environ["JNL_ORIG_CWD"] = request.get("cwd", os.getcwd())
+            try:
+                with redirect_stdout(out):
+                    if argv[1] == "search":
+                        # The client does the prompting and sends back `open`
+                        response["options"] = jnl.search.render(
+                            database=self.database,
+                            pattern=self.main.search_pattern(argv),
+                            scr=out,
+                            **self.main.search_filters(argv),
+                        )
+                    else:
+                        self.main.run(argv)
+            except Exception:
+                response["error"] = traceback.format_exc()
+            finally:
+                if old_cwd is None:
+                    del os.environ["JNL_ORIG_CWD"]
+                else:
+                    os.environ["JNL_ORIG_CWD"] = old_cwd
+        response["output"] = out.getvalue()
+        return response
+
+    def on_change(self) -> None:
+        with self.lock:
+            self.database.refresh()
+            self.database.scan()
+
+    def server(self, path: str) -> "socketserver.UnixStreamServer":
+        import socketserver
+
+        daemon = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                request = json.loads(self.rfile.readline())
+                self.wfile.write(json.dumps(daemon.handle(request)).encode())
+
+        if os.path.exists(path):
+            os.unlink(path)
+        return socketserver.ThreadingUnixStreamServer(path, Handler)
+
+    def serve_forever(self) -> None:
+        worklogs = self.database.path("worklogs")
+        self.database.scan()
+        watcher = threading.Thread(
+            target=watch,
+            args=(worklogs, self.on_change, self.poll_interval),
+            daemon=True,
+        )
+        watcher.start()
+        path = socket_path(self.database.dbdir)
+        with self.server(path) as server:
+            print("Listening on %s" % path)
+            try:
+                server.serve_forever()
+            except KeyboardInterrupt:
+                pass
+            finally:
+                os.unlink(path)
+
+
+def snapshot(path: str) -> Dict[str, Tuple[int, int]]:
+    import jnl.layout
+
+    return {
+        name: (stat.st_mtime_ns, stat.st_size) for name, stat in jnl.layout.files(path)
+    }
+
+
+def watch(path: str, on_change: Callable[[], None], poll_interval: float) -> None:
+    """Call on_change whenever a worklog in `path` (or any shard directory
+    within it) is written, added, or removed. Never returns, even if
+    on_change raises: the exception is printed and watching goes on."""
+    on_change = _logging_exceptions(on_change)
+    try:
+        _watch_inotify(path, on_change)
+    except OSError:
+        pass
+    _watch_polling(path, on_change, poll_interval)
+
+
+def _logging_exceptions(on_change: Callable[[], None]) -> Callable[[], None]:
+    def guarded() -> None:
+        try:
+            on_change()
+        except Exception:
+            # e.g. an editor's half-written file; the next change retries
+            print("Exception handling a change in worklogs:", file=sys.stderr)
+            traceback.print_exc()
+
+    return guarded
+
+
+def _watch_polling(path: str, on_change: Callable[[], None], interval: float):
+    last = snapshot(path)
+    while True:
+        time.sleep(interval)
+        current = snapshot(path)
+        if current != last:
+            last = current
+            on_change()
+
+
+_IN_CLOSE_WRITE = 0x008
+_IN_MOVED_FROM = 0x040
+_IN_MOVED_TO = 0x080
+_IN_CREATE = 0x100
+_IN_DELETE = 0x200
+_IN_ISDIR = 0x40000000
+_EVENT = struct.Struct("iIII")
+
+
+def _watch_inotify(path: str, on_change: Callable[[], None]) -> None:
+    """Raises OSError if inotify isn't available (i.e. not on Linux)."""
+    import ctypes
+    import ctypes.util
+
+    library = ctypes.util.find_library("c")
+    libc = ctypes.CDLL(library, use_errno=True)
+    if not hasattr(libc, "inotify_init1"):
+        raise OSError("inotify not available")
+    fd = libc.inotify_init1(os.O_CLOEXEC)
+    if fd < 0:
+        raise OSError(ctypes.get_errno(), "inotify_init1")
+    mask = _IN_CLOSE_WRITE | _IN_MOVED_FROM | _IN_MOVED_TO | _IN_CREATE | _IN_DELETE
+
+    def _add_watches():
+        # inotify isn't recursive so every shard directory needs a watch.
+        # Re-adding an existing one is harmless.
+        for directory, _, _ in os.walk(path):
+            if libc.inotify_add_watch(fd, os.fsencode(directory), mask) < 0:
+                os.close(fd)
+                raise OSError(ctypes.get_errno(), "inotify_add_watch")
+
+    _add_watches()
+    while True:
+        events = _read_events(fd)
+        # Editors tend to write in bursts; wait for things to settle.
+        while select.select([fd], [], [], 0.2)[0]:
+            events.extend(_read_events(fd))
+        if any(event_mask & _IN_ISDIR for event_mask, _ in events):
+            _add_watches()
+        if any(
+            name.endswith(".txt") or event_mask & _IN_ISDIR
+            for event_mask, name in events
+        ):
+            on_change()
+
+
+def _read_events(fd: int) -> List[Tuple[int, str]]:
+    """(mask, name) of each event waiting on fd"""
+    buffer = os.read(fd, 64 * 1024)
+    events = []
+    offset = 0
+    while offset < len(buffer):
+        _, event_mask, _, length = _EVENT.unpack_from(buffer, offset)
+        offset += _EVENT.size
+        name = os.fsdecode(buffer[offset : offset + length].rstrip(b"\0"))
+        events.append((event_mask, name))
+        offset += length
+    return events
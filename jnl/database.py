@@ -1,11 +1,39 @@
 import os
-from typing import List, Optional, Tuple, Pattern, AnyStr, Dict
+import time
+from bisect import bisect_left, insort
+from collections import Counter, defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from itertools import islice
+from typing import (
+    IO,
+    Callable,
+    List,
+    Optional,
+    Tuple,
+    Pattern,
+    AnyStr,
+    Dict,
+    Iterable,
+    Iterator,
+    Set,
+)
 
+import jnl.changes
+import jnl.layout
+import jnl.query
 import jnl.system
+import jnl.trace
 from jnl.entries import Entry, Tag, EntryMatch
+from jnl.index import EntryIndex, ensure_state_dir
 
 
 class NopListener(object):
+    thread_safe: bool = False
+    """Whether on_entry can run concurrently for different entries.
+    Listeners that aren't thread-safe are called one entry at a time in
+    entry order even when scanning with multiple jobs."""
+
     def on_entry(self, database: "Database", entry: "Entry") -> None:
         pass
 
@@ -16,18 +44,168 @@ class NopListener(object):
         pass
 
 
+class _Lookups:
+    """Indexes over the loaded entries backing the `Database.entry*` queries.
+    Results come back in the same order as `Database.entries`."""
+
+    def __init__(self, entries: List[Entry]):
+        self.entries: List[Entry] = []
+        self.by_guid: Dict[str, Entry] = {}
+        self.by_tag: Dict[Tuple[str, Optional[str]], List[int]] = defaultdict(list)
+        """(tag name, value) => ordinals of the entries with that tag"""
+        self.by_name: Dict[str, List[int]] = defaultdict(list)
+        self.values: Dict[str, List[Tuple[str, int]]] = defaultdict(list)
+        """tag name => sorted (tag value, entry ordinal) for prefix lookups"""
+        self.daily: List[Tuple[str, int]] = []
+        """sorted (yyyy-mm-dd, entry ordinal) of daily entries"""
+        # sorted once at the end rather than kept sorted along the way
+        for entry in entries:
+            self._add(entry, list.append)
+        for values in self.values.values():
+            values.sort()
+        self.daily.sort()
+
+    def add(self, entry: Entry) -> None:
+        """Index one more entry, e.g. one just created."""
+        self._add(entry, insort)
+
+    def _add(
+        self,
+        entry: Entry,
+        put: Callable[[List[Tuple[str, int]], Tuple[str, int]], None],
+    ) -> None:
+        ordinal = len(self.entries)
+        self.entries.append(entry)
+        self.by_guid.setdefault(entry.guid, entry)
+        for key in dict.fromkeys((t.name, t.value) for t in entry.tags):
+            self.by_tag[key].append(ordinal)
+        for name in dict.fromkeys(t.name for t in entry.tags):
+            self.by_name[name].append(ordinal)
+        for tag in entry.tags:
+            if tag.value is not None:
+                put(self.values[tag.name], (tag.value, ordinal))
+        daily = entry.is_a_daily_entry()
+        if daily:
+            put(self.daily, (daily, ordinal))
+
+    def ordinals_starting_with(self, name: str, prefix: str) -> Set[int]:
+        values = self.values.get(name, [])
+        ordinals = set()
+        index = bisect_left(values, (prefix, -1))
+        while index < len(values) and values[index][0].startswith(prefix):
+            ordinals.add(values[index][1])
+            index += 1
+        return ordinals
+
+    def starting_with(self, name: str, prefix: str) -> List[Entry]:
+        return self.at(sorted(self.ordinals_starting_with(name, prefix)))
+
+    def at(self, ordinals: Iterable[int]) -> List[Entry]:
+        return [self.entries[ordinal] for ordinal in ordinals]
+
+
+class _ScanLock:
+    """`.jnl/scan.lock`, held for the length of a scan so scans of the same
+    journal (the daemon, `jnl today` from the app and from a shell, ...)
+    take turns instead of racing each other over quick/ and the caches.
+
+    It also says when the entries were listed for the last scan that went
+    over all of them. A scan that had to wait for the lock can tell from
+    that whether the one that held it already saw everything it would see
+    itself, e.g. when several wait on the same running scan: the first to
+    get the lock after it scans and the rest needn't."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.asked = time.time_ns()
+        self.waited = False
+        self._handle: Optional[IO[str]] = None
+
+    def __enter__(self) -> "_ScanLock":
+        try:
+            import fcntl
+        except ImportError:
+            # not on a Unix: scans don't take turns
+            return self
+        self._handle = open(self.path, "a+")
+        try:
+            fcntl.flock(self._handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            self.waited = True
+            with jnl.trace.span("Database.scan (waiting for another scan)"):
+                fcntl.flock(self._handle, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *_) -> None:
+        if self._handle is not None:
+            # closing releases the lock
+            self._handle.close()
+            self._handle = None
+
+    def covered(self, full: bool) -> bool:
+        """Whether a scan that finished while this one waited listed the
+        entries after this one was asked for (and was full, if `full`)."""
+        if not self.waited or self._handle is None:
+            return False
+        self._handle.seek(0)
+        try:
+            listed_at, was_full = map(int, self._handle.read().split())
+        except ValueError:
+            return False
+        return listed_at > self.asked and (bool(was_full) or not full)
+
+    def record(self, listed_at: int, full: bool) -> None:
+        """Note that a scan over every entry, as listed at `listed_at`, is
+        done."""
+        if self._handle is None:
+            return
+        self._handle.seek(0)
+        self._handle.truncate()
+        # "a+" writes at the end, which is now the start
+        self._handle.write("%d %d\n" % (listed_at, full))
+        self._handle.flush()
+
+
 class Database:
     def __init__(
         self,
         entry_listeners: List[NopListener],
         dbdir=None,
+        use_index: bool = True,
     ):
         self.entry_listeners = entry_listeners
         self.dbdir = os.getenv("JNL_DIR") if dbdir is None else dbdir
 
-        self._entries: Optional[List[str]] = None
+        self._entries: Optional[List[Entry]] = None
         """Use .entries instead of _entries to ensure it's initialized"""
 
+        self._stale: Dict[str, Entry] = {}
+        """Without the index: entries from before `refresh` by relative path,
+        reused by the next load if their files didn't change"""
+
+        self._lookups: Optional[_Lookups] = None
+
+        self._listed_at: int = 0
+        """time.time_ns() when `entries` was last listed"""
+
+        self.full_scan: bool = False
+        """Set during `scan(full=True)`: listeners should rebuild everything
+        rather than only what changed since the last scan."""
+
+        self.changed_files: Optional[Set[str]] = None
+        """Set during `scan(changed=...)`: paths (relative to worklogs/) of
+        the entries that may have changed. None means any of them might
+        have."""
+
+        self._index: Optional[EntryIndex] = (
+            EntryIndex(self.state_path()) if use_index else None
+        )
+
+    def state_path(self, *parts: str) -> str:
+        """Path within `$JNL_DIR/.jnl` where jnl keeps its own caches.
+        Unlike `path` this doesn't create anything."""
+        return os.path.join(self.dbdir, ".jnl", *parts)
+
     def path(self, *subdirs: str) -> str:
         out = os.path.join(self.dbdir, *subdirs)
         if not jnl.system.exists(out):
@@ -38,34 +216,106 @@ class Database:
     @property
     def entries(self) -> List[Entry]:
         if self._entries is None:
-            my_path = self.path("worklogs")
-            self._entries = [
-                Entry(
-                    worklogs_path=self.path("worklogs"),
-                    file_name=f,
-                    path=my_path,
-                )
-                for f in os.listdir(my_path)
-                if os.path.isfile(os.path.join(my_path, f)) and Entry.valid_file_name(f)
-            ]
+            self._listed_at = time.time_ns()
+            with jnl.trace.span("Database.entries"):
+                self._entries = self._load_entries()
         return self._entries
 
+    def _load_entries(self) -> List[Entry]:
+        my_path = self.path("worklogs")
+        if self._index is not None:
+            return self._index.refresh(my_path)
+        stale, self._stale = self._stale, {}
+        entries = []
+        for name, stat in jnl.layout.files(my_path):
+            entry = stale.get(name)
+            if entry is None:
+                entry = Entry.at(my_path, name)
+            else:
+                entry.invalidate(stat)
+            entries.append(entry)
+        entries.sort(key=lambda e: e.file_name)
+        return entries
+
+    def refresh(self) -> None:
+        """Pick up entries that were added, removed, or edited since they were
+        loaded. Only the changed files get re-read."""
+        if self._index is None and self._entries is not None:
+            self._stale = {e.relative_path(): e for e in self._entries}
+        self._entries = None
+        self._lookups = None
+
+    def _lookup(self) -> _Lookups:
+        if self._lookups is None:
+            self._lookups = _Lookups(self.entries)
+        return self._lookups
+
     def create_entry(self, tags: List[Tag] = None) -> Entry:
-        entry = Entry(worklogs_path=self.path("worklogs"), tags=tags, create=True)
-        self.entries.append(entry)
+        # Load existing entries first so the new file isn't picked up twice.
+        entries = self.entries
+        worklogs = self.path("worklogs")
+        layout = jnl.layout.read(worklogs)
+        if layout == "flat":
+            entry = Entry(worklogs_path=worklogs, tags=tags, create=True)
+        else:
+            guid = jnl.system.guid()
+            path = os.path.join(worklogs, jnl.layout.shard(layout, guid))
+            if not jnl.system.exists(path):
+                jnl.system.makedirs(path)
+            entry = Entry(
+                worklogs_path=worklogs, path=path, guid=guid, tags=tags, create=True
+            )
+        entries.append(entry)
+        if self._lookups is not None:
+            self._lookups.add(entry)
         return entry
 
-    # maybe combine all these entry_with_* stuff to have a predicate or something
-    # or at least refactor internal
+    def rename_entries(self, renames: List[Tuple[Entry, str]]) -> None:
+        """Rename many entries at once (each staying in its directory).
+        Refuses (before renaming anything) if two entries would end up with
+        the same name or a name is taken."""
+        self.move_entries(
+            [
+                (e, os.path.join(os.path.dirname(e.relative_path()), new_name))
+                for e, new_name in renames
+            ]
+        )
+
+    def move_entries(self, moves: List[Tuple[Entry, str]]) -> None:
+        """Like `rename_entries` but with new paths relative to worklogs/,
+        possibly in another shard directory."""
+        targets = Counter(new_path for _, new_path in moves)
+        taken = {e.relative_path() for e in self.entries}
+        taken -= {e.relative_path() for e, _ in moves}
+        clashes = sorted(t for t, n in targets.items() if t in taken or n > 1)
+        if clashes:
+            raise ValueError("Can't rename onto existing names %s" % clashes)
+        jnl.system.git_mv_many(
+            self.path("worklogs"), [(e.relative_path(), new) for e, new in moves]
+        )
+        # The lookups hold the Entry itself and none are keyed on its file
+        # name, so they stay valid.
+        for entry, new_path in moves:
+            entry.moved_to(new_path)
 
     def entries_with_project(self, project: str) -> List[Entry]:
-        return [e for e in self.entries if e.tag_starts_with("project", project)]
+        return self._lookup().starting_with("project", project)
 
     def entry_with_guid(self, guid: str) -> Entry:
-        return [e for e in self.entries if e.guid == guid][0]
+        return self._lookup().by_guid[guid]
 
     def entries_with_tag(self, name: str, value: str = None) -> List[Entry]:
-        return [e for e in self.entries if e.has_tag(name, value)]
+        lookups = self._lookup()
+        if value is None:
+            return lookups.at(lookups.by_name.get(name, []))
+        return lookups.at(lookups.by_tag.get((name, value), []))
+
+    def query(self, expression: str) -> Iterator[Entry]:
+        """Entries whose tags match `expression` (see `jnl.query` for the
+        syntax), lazily and in the same order as `entries`. Raises
+        ValueError right away if the expression doesn't parse."""
+        plan = jnl.query.Query(expression)
+        return plan.run(self._lookup())
 
     def daily_entry(self, yyyymmdd: str = None) -> Entry:
         if yyyymmdd is None:
@@ -81,32 +331,221 @@ class Database:
         return existing[0]
 
     def yesterday_entry(self) -> Entry:
-        existing: List[Tuple[Entry, Optional[str]]] = [
-            (e, e.is_a_daily_entry()) for e in self.entries if e.is_a_daily_entry()
-        ]
-        existing.sort(key=lambda tup: tup[1])
+        lookups = self._lookup()
         # -1 ("last item") is today
-        return existing[-2][0]
+        return lookups.entries[lookups.daily[-2][1]]
+
+    def scan(
+        self, jobs: int = 1, full: bool = False, changed: Optional[Set[str]] = None
+    ) -> None:
+        """Run every listener over every entry.
+
+        With `full` listeners throw away whatever they remember from the
+        previous scan and rebuild from scratch.
+
+        `changed` is the paths (relative to worklogs/) of the only entries
+        known to have changed (e.g. by a `git pull`) so listeners can skip
+        per-file work on the rest.
+
+        With `jobs > 1` entries are parsed and handed to thread-safe
+        listeners on a thread pool. The remaining listeners then see the
+        (already parsed) entries serially in entry order so their
+        results - including any exceptions - don't depend on timing.
 
-    def scan(self) -> None:
-        # Could multi-thread but it's super fast even with 1800+ worklog entries.
+        Large git-backed journals work out `changed` themselves, from what
+        git says changed since the previous scan.
+
+        Scans of the same journal take turns (see `_ScanLock`), and one
+        that had to wait is skipped if a scan that finished meanwhile
+        already saw everything it would have."""
+        ensure_state_dir(self.state_path())
+        with _ScanLock(self.state_path("scan.lock")) as lock:
+            if lock.covered(full):
+                jnl.trace.count("scans coalesced")
+                return
+            tracker = jnl.changes.GitChanges(self.dbdir, "scan")
+            if changed is not None:
+                # leave the mark be so the next scan sees these changes too
+                tracker = None
+            elif len(self.entries) >= tracker.MIN_ENTRIES:
+                since = tracker.since_mark()
+                if not full:
+                    changed = since
+            self.full_scan = full
+            self.changed_files = None if full else changed
+            try:
+                self._scan(jobs)
+            finally:
+                self.full_scan = False
+                self.changed_files = None
+            if full or changed is None:
+                lock.record(self._listed_at, full)
+            if tracker is not None:
+                # with no since_mark (small journals) this forgets instead
+                tracker.mark()
+
+    def _scan(self, jobs: int) -> None:
         listeners = self.entry_listeners
         for listener in listeners:
-            listener.on_pre_scan(database=self)
-        for entry in self.entries:
-            for listener in listeners:
-                try:
-                    listener.on_entry(database=self, entry=entry)
-                except Exception:
-                    print("Listener %s Exception on entry %s" % (listener, entry))
-                    raise
+            with jnl.trace.span("%s.on_pre_scan", type(listener).__name__):
+                listener.on_pre_scan(database=self)
+        entries = self.entries
+        serial = listeners
+        if jobs > 1:
+            concurrent = [l for l in listeners if l.thread_safe]
+            serial = [l for l in listeners if not l.thread_safe]
+
+            def _parse_and_notify(entry: Entry) -> None:
+                entry.tags
+                self._notify(concurrent, entry)
+
+            with ThreadPoolExecutor(max_workers=jobs) as pool:
+                # list() so the first exception in entry order is re-raised here
+                list(pool.map(_parse_and_notify, entries))
+        for entry in entries:
+            self._notify(serial, entry)
+        for listener in listeners:
+            with jnl.trace.span("%s.on_post_scan", type(listener).__name__):
+                listener.on_post_scan(database=self)
+
+    def _notify(self, listeners: List[NopListener], entry: Entry) -> None:
         for listener in listeners:
-            listener.on_post_scan(database=self)
-
-    def entries_matching(self, pattern: Pattern[AnyStr]) -> Dict[str, List[EntryMatch]]:
-        out: Dict[str, (Entry, List[EntryMatch])] = {}
-        for e in self.entries:
-            matches: List[EntryMatch] = e.matches(pattern)
-            if matches:
-                out[e.guid] = matches
+            try:
+                with jnl.trace.span("%s.on_entry", type(listener).__name__):
+                    listener.on_entry(database=self, entry=entry)
+            except Exception:
+                print("Listener %s Exception on entry %s" % (listener, entry))
+                raise
+
+    def entries_matching(
+        self,
+        pattern: Pattern[AnyStr],
+        jobs: int = 4,
+        since: Optional[datetime] = None,
+        until: Optional[datetime] = None,
+        rank: bool = False,
+        processes: int = 1,
+    ) -> Iterator[Tuple[str, List[EntryMatch]]]:
+        """(guid, matches) for each entry matching `pattern`, most recently
+        modified first. Files are searched `jobs` at a time, a few ahead of
+        what's been consumed, so the first results come back right away and
+        closing the generator early skips reading the rest.
+
+        Entries last modified outside of `since`..`until` are skipped
+        without being opened. With `rank` every remaining entry is searched
+        and results come back most relevant first (see `relevance`).
+
+        With `processes > 1` files are searched by that many worker
+        processes rather than threads (see `jnl.parallel`), for regexes
+        expensive enough to keep more than one core busy. That skips the
+        corpus (see `jnl.corpus`), which is only ever searched on one core."""
+        entries = self.entries
+        candidates = (
+            self._index.candidates(pattern) if self._index is not None else None
+        )
+        if candidates is not None:
+            entries = [e for e in entries if e.guid in candidates]
+        stats = Database._stats(entries)
+        mtimes = {guid: stat[0] for guid, stat in stats.items()}
+        if since is not None or until is not None:
+            low = 0 if since is None else int(since.timestamp() * 1e9)
+            high = None if until is None else int(until.timestamp() * 1e9)
+            entries = [
+                e
+                for e in entries
+                if low <= mtimes[e.guid] and (high is None or mtimes[e.guid] <= high)
+            ]
+        # stable, so entries modified at the same time stay in name order
+        entries = sorted(entries, key=lambda e: mtimes[e.guid], reverse=True)
+        if processes > 1:
+            results = self._search_processes(entries, pattern, processes)
+        else:
+            # ranking needs every result anyway, in no particular order
+            results = self._search_corpus(entries, pattern, stats, ordered=not rank)
+        if results is None:
+            results = self._search(entries, pattern, jobs)
+        if not rank:
+            yield from results
+            return
+        now = jnl.system.now().timestamp() * 1e9
+        yield from sorted(
+            results,
+            key=lambda result: -Database.relevance(
+                pattern, result[1], (now - mtimes[result[0]]) / 86400e9
+            ),
+        )
+
+    @staticmethod
+    def relevance(
+        pattern: Pattern[AnyStr], matches: List[EntryMatch], age_days: float
+    ) -> float:
+        """Higher is better: a point per matching line, three per tag the
+        pattern hits, plus up to five for having been edited recently
+        (halving every week)."""
+        tag_hits = sum(1 for t in matches[0].entry.tags if pattern.search(str(t)))
+        recency = 5 * 0.5 ** (max(age_days, 0) / 7)
+        return len(matches) + 3 * tag_hits + recency
+
+    @staticmethod
+    def _stats(entries: List[Entry]) -> Dict[str, Tuple[int, int]]:
+        """guid => (mtime_ns, size); (0, -1) for files that are gone"""
+        out = {}
+        for entry in entries:
+            try:
+                stat = os.stat(entry.file_path())
+                out[entry.guid] = (stat.st_mtime_ns, stat.st_size)
+            except FileNotFoundError:
+                out[entry.guid] = (0, -1)
+        jnl.trace.count("syscall stat", len(entries))
         return out
+
+    def _search_corpus(
+        self,
+        entries: List[Entry],
+        pattern: Pattern[AnyStr],
+        stats: Dict[str, Tuple[int, int]],
+        ordered: bool,
+    ) -> Optional[Iterator[Tuple[str, List[EntryMatch]]]]:
+        """Like `_search` but from the packed corpus (see `jnl.corpus`), or
+        None if there isn't one or it can't handle the pattern."""
+        import jnl.corpus
+
+        corpus = jnl.corpus.Corpus(self.state_path())
+        if not corpus.exists():
+            return None
+        return corpus.matches(pattern, entries, stats, ordered=ordered)
+
+    @staticmethod
+    def _search_processes(
+        entries: List[Entry], pattern: Pattern[AnyStr], processes: int
+    ) -> Iterator[Tuple[str, List[EntryMatch]]]:
+        """`_search` on worker processes (see `jnl.parallel`)."""
+        import jnl.parallel
+
+        return jnl.parallel.search(entries, pattern, processes)
+
+    @staticmethod
+    def _search(
+        entries: List[Entry], pattern: Pattern[AnyStr], jobs: int
+    ) -> Iterator[Tuple[str, List[EntryMatch]]]:
+        def _matches(entry: Entry) -> List[EntryMatch]:
+            matches = entry.matches(pattern)
+            if not matches:
+                entry.forget_content()
+            return matches
+
+        remaining = iter(entries)
+        with ThreadPoolExecutor(max_workers=jobs) as pool:
+            pending = deque(
+                pool.submit(_matches, e) for e in islice(remaining, 2 * jobs)
+            )
+            try:
+                while pending:
+                    matches = pending.popleft().result()
+                    for entry in islice(remaining, 1):
+                        pending.append(pool.submit(_matches, entry))
+                    if matches:
+                        yield matches[0].entry.guid, matches
+            finally:
+                for future in pending:
+                    future.cancel()
@@ -1,5 +1,8 @@
 import os
 import re
+import sys
+import tempfile
+from array import array
 from typing import (
     Callable,
     Optional,
@@ -7,14 +10,14 @@ from typing import (
     AnyStr,
     List,
     Generator,
+    Iterator,
     Pattern,
     TextIO,
     Tuple,
 )
 
-from colorama import Fore
-
 import jnl.system
+import jnl.trace
 
 
 class Tag:
@@ -57,6 +60,35 @@ class Tag:
         re.VERBOSE,
     )
 
+    MAX_SCAN_VALUE = 256
+    """Longest tag value SCAN_RE finds"""
+
+    SCAN_RE = re.compile(
+        TAG_RE.pattern.replace("[^)]*?", "[^)\\n]{0,%d}?" % MAX_SCAN_VALUE),
+        re.VERBOSE,
+    )
+    """TAG_RE but values can't span lines, so it can run over a whole file
+    and find what running TAG_RE line by line would. Values are also capped
+    at MAX_SCAN_VALUE characters so a line of unclosed ('s can't make
+    scanning quadratic: a longer one is scanned as a tag with no value."""
+
+    @staticmethod
+    def scan(text: str) -> List["Tag"]:
+        """Tags in a whole file's text in one pass: those up to and including
+        the line with the first @noscan."""
+        out = []
+        stop = None
+        for re_match in Tag.SCAN_RE.finditer(text):
+            if stop is not None and re_match.start() >= stop:
+                break
+            tag = Tag(re_match)
+            out.append(tag)
+            if stop is None and tag.name == "noscan":
+                stop = text.find("\n", re_match.end())
+                if stop == -1:
+                    break
+        return out
+
     @staticmethod
     def parse(line: str) -> List["Tag"]:
         """Return list of tags"""
@@ -69,11 +101,14 @@ class Tag:
 
         return out
 
+    __slots__ = ("_name", "_value")
+
     def __init__(self, re_match: Match[AnyStr] = None, name=None, value=None):
         if re_match is not None:
             name = re_match.group(1).strip()
             value = re_match.group(2)
-        self._name: str = name
+        # A handful of names ("quick", "ft", "done") cover nearly every tag
+        self._name: str = sys.intern(name)
         self._value: str = value
 
     def one_on_one(self) -> Optional[Tuple[str, str]]:
@@ -110,7 +145,150 @@ class Tag:
         )
 
 
+class ScanPolicy:
+    """How much of an entry jnl reads looking for tags, so pasted logs and
+    other huge or binary files can't stall a scan.
+
+    - Files up to `full_scan_bytes` are scanned up to the first `@noscan`.
+    - Bigger files get an implicit `@noscan`: only their first `head_bytes`
+      and last `tail_bytes` (whole lines of them) are read for tags, and
+      the tail only if the head has no `@noscan` of its own.
+    - Files with a NUL byte in the first `sniff_bytes` are binary and have
+      no tags.
+    - Lines longer than `max_line_chars` (minified JS/JSON, base64, ...)
+      are skipped, which also bounds how long matching any line can take.
+
+    Replace `Entry.SCAN_POLICY` to change these."""
+
+    def __init__(
+        self,
+        full_scan_bytes: int = 512 * 1024,
+        head_bytes: int = 64 * 1024,
+        tail_bytes: int = 16 * 1024,
+        sniff_bytes: int = 8 * 1024,
+        max_line_chars: int = 4096,
+    ):
+        self.full_scan_bytes = full_scan_bytes
+        self.head_bytes = head_bytes
+        self.tail_bytes = tail_bytes
+        self.sniff_bytes = sniff_bytes
+        self.max_line_chars = max_line_chars
+        # Starting with a literal \n lets re skip ahead to line starts
+        self._long_line_re = re.compile(r"\n[^\n]{%d}" % (max_line_chars + 1))
+
+    def is_binary(self, text: AnyStr) -> bool:
+        nul = b"\0" if isinstance(text, bytes) else "\0"
+        return text.find(nul, 0, self.sniff_bytes) != -1
+
+    def tags(self, text: str) -> List[Tag]:
+        """Tags in text (a whole file, its head, or its tail) per the policy."""
+        if self.is_binary(text):
+            return []
+        if len(text) <= self.max_line_chars:
+            return Tag.scan(text)
+        out: List[Tag] = []
+        start = 0
+        for line_start, line_end in self._long_lines(text):
+            out.extend(Tag.scan(text[start:line_start]))
+            if any(t.name == "noscan" for t in out):
+                return out
+            start = line_end
+        out.extend(Tag.scan(text[start:] if start else text))
+        return out
+
+    def _long_lines(self, text: str) -> Iterator[Tuple[int, int]]:
+        """(start, end) of each line longer than `max_line_chars`"""
+        end = text.find("\n")
+        if end == -1:
+            end = len(text)
+        if end > self.max_line_chars:
+            yield 0, end
+        while True:
+            match = self._long_line_re.search(text, end)
+            if match is None:
+                return
+            end = text.find("\n", match.end())
+            if end == -1:
+                end = len(text)
+            yield match.start() + 1, end
+
+    def read_tags(self, path: str, size: int) -> List[Tag]:
+        """Tags of a file bigger than `full_scan_bytes`: only its head and
+        tail are read."""
+        with open(path, "rb") as f:
+            head = f.read(self.head_bytes)
+            jnl.trace.count("bytes read", len(head))
+            if self.is_binary(head):
+                return []
+            # drop the partial last line
+            tags = self.tags(_decode(head[: head.rfind(b"\n") + 1]))
+            if any(t.name == "noscan" for t in tags) or not self.tail_bytes:
+                return tags
+            f.seek(max(size - self.tail_bytes, len(head)))
+            tail = f.read(self.tail_bytes)
+        jnl.trace.count("bytes read", len(tail))
+        # drop the partial first line (all of it if that's all there is)
+        newline = tail.find(b"\n")
+        if newline != -1:
+            tags.extend(self.tags(_decode(tail[newline + 1 :])))
+        return tags
+
+
+def _decode(data: bytes) -> str:
+    return data.decode("utf-8", errors="replace")
+
+
+class TagSet:
+    """An entry's tags along with everything jnl derives from them, worked
+    out once so the Entry predicates don't have to re-match anything.
+
+    An empty TagSet is a real answer - the file was read and has no tags -
+    so most scratch worklogs are read once like any other."""
+
+    __slots__ = ("tags", "daily", "one_on_one", "single_quick", "_mtime_ns", "_size")
+
+    def __init__(self, tags: List[Tag], stat_key: Optional[Tuple[int, int]] = None):
+        # Entries only have a few tags so a tuple beats per-entry sets/dicts
+        self.tags: Tuple[Tag, ...] = tuple(tags)
+        # two slots rather than a tuple: thousands of these stay loaded
+        self._mtime_ns, self._size = stat_key if stat_key else (None, None)
+        quick = [t for t in tags if t.name == "quick"]
+        self.daily: Optional[str] = next(
+            (d for d in (t.daily() for t in quick) if d), None
+        )
+        self.one_on_one: Optional[Tuple[str, str]] = next(
+            (o for o in (t.one_on_one() for t in quick) if o), None
+        )
+        self.single_quick: Optional[str] = None
+        if len(quick) == 1 and not self.daily:
+            value = quick[0].value
+            # TODO: handle subdirs separately
+            if value is not None and "/" not in value:
+                self.single_quick = value
+
+    @property
+    def stat_key(self) -> Optional[Tuple[int, int]]:
+        """(mtime_ns, size) of the file the tags were parsed from, None if
+        unknown (e.g. the entry was just created with them)."""
+        if self._mtime_ns is None:
+            return None
+        return self._mtime_ns, self._size
+
+    def has(self, name: str, value: Optional[str] = None) -> bool:
+        return any(
+            t.name == name and (value is None or t.value == value) for t in self.tags
+        )
+
+    def starts_with(self, name: str, prefix: str) -> bool:
+        return any(
+            t.name == name and t.value is not None and t.value.startswith(prefix)
+            for t in self.tags
+        )
+
+
 class EntryMatch:
+    __slots__ = ("entry", "match", "matched_line_index")
+
     def __init__(self, entry: "Entry", match: Match[AnyStr], matched_line_index: int):
         self.entry = entry
         self.match = match
@@ -123,6 +301,8 @@ class EntryMatch:
         after_context: int = 0,
         prefix: str = "  ",
     ):
+        from colorama import Fore
+
         min_line = max(0, self.matched_line_index - before_context)
         max_line = self.matched_line_index + after_context
         for (line, line_index) in self.entry.lines(min_line, max_line):
@@ -137,6 +317,42 @@ class EntryMatch:
             scr.write("\n")
 
 
+class EntryContent:
+    """The text of an entry file read in one go plus a table of where each
+    line starts so any range of lines can be sliced out without re-reading.
+    `stat_key` is the (mtime, size) the file had when it was read."""
+
+    __slots__ = ("text", "stat_key", "_starts")
+
+    def __init__(self, text: str, stat_key: Tuple[int, int]):
+        self.text = text
+        self.stat_key = stat_key
+        self._starts: Optional[array] = None
+
+    @property
+    def starts(self) -> array:
+        if self._starts is None:
+            starts = array("Q", [0])
+            find = self.text.find
+            index = find("\n")
+            while index != -1:
+                starts.append(index + 1)
+                index = find("\n", index + 1)
+            if starts[-1] == len(self.text):
+                # no partial line after the final newline
+                starts.pop()
+            self._starts = starts
+        return self._starts
+
+    def __len__(self) -> int:
+        return len(self.starts)
+
+    def line(self, index: int) -> str:
+        starts = self.starts
+        end = starts[index + 1] if index + 1 < len(starts) else len(self.text)
+        return self.text[starts[index] : end]
+
+
 class Entry:
     FILENAME_RE = re.compile(
         r"""
@@ -153,6 +369,10 @@ class Entry:
         r"^(?:My Reference):\s+([A-Z0-9]+)\s*$",
     )
 
+    __slots__ = ("worklogs_path", "guid", "path", "_file_name", "_tags", "_content")
+
+    SCAN_POLICY = ScanPolicy()
+
     @staticmethod
     def valid_file_name(file_name: str) -> bool:
         return file_name.endswith(".txt")
@@ -165,8 +385,11 @@ class Entry:
         guid: str = None,
         tags: List[Tag] = None,
         create: bool = False,
+        stat_key: Optional[Tuple[int, int]] = None,
     ):
-        self.worklogs_path = worklogs_path
+        self.worklogs_path: str = sys.intern(worklogs_path)
+        if path is None:
+            path = self.worklogs_path
 
         found_guid = guid
         if found_guid is None:
@@ -177,109 +400,243 @@ class Entry:
                 if match is not None:
                     found_guid = match.group(1).strip()
         if found_guid is None:
-            with open(os.path.join(self.worklogs_path, file_name), "r") as handle:
-                for line in handle.readlines():
-                    match = Entry.EXTRACT_GUID_RE.match(line)
-                    if match:
-                        found_guid = match.group(0)
+            # "My Reference" is near the top; don't read all of a huge file
+            with open(os.path.join(path, file_name), "rb") as handle:
+                head = _decode(handle.read(Entry.SCAN_POLICY.head_bytes))
+            for line in head.splitlines():
+                match = Entry.EXTRACT_GUID_RE.match(line)
+                if match:
+                    found_guid = match.group(1)
+                    break
         if found_guid is None:
             raise ValueError(f"Couldn't find guid on {file_name}")
         self.guid: str = found_guid
 
-        if path is None:
-            path = self.worklogs_path
-        self.path: str = path
+        self.path: str = sys.intern(path)
         """dirname of full file_name path"""
 
-        if file_name is None:
-            file_name = "%s.txt" % self.guid
-        self.file_name: str = file_name
+        self._file_name: Optional[str] = None
+        """None when it's the usual {guid}.txt so that isn't kept twice"""
+        self.file_name = "%s.txt" % self.guid if file_name is None else file_name
 
-        self._tags: List[Tag] = tags
+        self._tags: Optional[TagSet] = None if tags is None else TagSet(tags, stat_key)
+        """Parsed tags or None if the file hasn't been read yet. `stat_key`
+        says which version of the file given `tags` came from."""
+
+        self._content: Optional[EntryContent] = None
 
         if create:
             self._create()
 
-        self._tags: List[Tag] = []
-
     def is_a_daily_entry(self) -> Optional[str]:
         """
         :return: if this entry has @quick(daily/X) returns X else None
         """
-        tags = [t for t in self.tags if t.daily()]
-        if not tags:
-            return None
-        return tags[0].daily()
+        return self.tag_set().daily
+
+    @property
+    def file_name(self) -> str:
+        if self._file_name is None:
+            return self.guid + ".txt"
+        return self._file_name
+
+    @file_name.setter
+    def file_name(self, file_name: str) -> None:
+        self._file_name = None if file_name == self.guid + ".txt" else file_name
+
+    @staticmethod
+    def at(worklogs_path: str, relative_path: str, **kwargs) -> "Entry":
+        """The entry whose file is at relative_path within worklogs_path,
+        which may be in a shard subdirectory (see `jnl.layout`)."""
+        directory, file_name = os.path.split(relative_path)
+        return Entry(
+            worklogs_path=worklogs_path,
+            path=os.path.join(worklogs_path, directory) if directory else worklogs_path,
+            file_name=file_name,
+            **kwargs,
+        )
 
     def file_path(self) -> str:
         return os.path.join(self.path, self.file_name)
 
+    def relative_path(self) -> str:
+        """file_path() relative to worklogs_path"""
+        if self.path == self.worklogs_path:
+            return self.file_name
+        return os.path.join(self.path[len(self.worklogs_path) + 1 :], self.file_name)
+
+    def moved_to(self, relative_path: str) -> None:
+        """Point at the file's new location after it was moved."""
+        directory, file_name = os.path.split(relative_path)
+        path = os.path.join(self.worklogs_path, directory)
+        self.path = sys.intern(path if directory else self.worklogs_path)
+        self.file_name = file_name
+        self._content = None
+
     def file_extension(self) -> str:
         return self.file_name.split(".")[-1]
 
-    def rename_file(self, new_name: str):
-        jnl.system.git_mv(self.worklogs_path, self.file_name, new_name)
-
     def _create(self) -> None:
+        if self._tags is None:
+            self._tags = TagSet([])
         with open(self.file_path(), "w+") as f:
             f.write("\n")
             f.write("My Reference: %s  \n" % self.guid)
-            for tag in self.tags:
+            for tag in self._tags.tags:
                 f.write(str(tag))
                 f.write("  \n")
+        stat = os.stat(self.file_path())
+        self._tags = TagSet(self._tags.tags, (stat.st_mtime_ns, stat.st_size))
 
     @property
     def tags(self) -> List[Tag]:
-        if not self._tags:
-            tags = []
-            for line, line_no in self.lines():
-                on_line = Tag.parse(line)
-                tags.extend(on_line)
-                if [t for t in on_line if t.name == "noscan"]:
-                    break
-            self._tags = [t for t in tags if t is not None]
+        return self.tag_set().tags
+
+    def tag_set(self) -> TagSet:
+        if self._tags is None:
+            with jnl.trace.span("Entry.tags"):
+                self._tags = self._read_tags()
         return self._tags
 
+    def _read_tags(self) -> TagSet:
+        policy = Entry.SCAN_POLICY
+        stat = os.stat(self.file_path())
+        jnl.trace.count("syscall stat")
+        if stat.st_size > policy.full_scan_bytes:
+            # Leave the text be: it's only read in full if searched.
+            tags = policy.read_tags(self.file_path(), stat.st_size)
+            jnl.trace.count("file opens")
+            return TagSet(tags, (stat.st_mtime_ns, stat.st_size))
+        stat_key = (stat.st_mtime_ns, stat.st_size)
+        content = self._content
+        if content is not None and content.stat_key == stat_key:
+            text = content.text
+        else:
+            # Don't keep the text: most entries are never searched or shown.
+            # Undecodable bytes mustn't stop the binary check or the scan.
+            text = self._read_text(stat, errors="replace")
+        return TagSet(policy.tags(text), stat_key)
+
     def single_quick_entry(self) -> Optional[str]:
-        quick = [t for t in self.tags if t.name == "quick"]
-        if len(quick) != 1 or self.is_a_daily_entry():
-            return None
-        val = quick[0].value
-        if "/" in val:
-            # TODO: handle subdirs separately
-            return None
-        return val
+        return self.tag_set().single_quick
+
+    def one_on_one_entry(self) -> Optional[Tuple[str, str]]:
+        """(person, date) if this entry has @quick(One/person/date)"""
+        return self.tag_set().one_on_one
+
+    def invalidate(self, stat: Optional[os.stat_result] = None) -> bool:
+        """Forget the tags and text if the file changed (by mtime or size)
+        since they were read, so they're re-read on next use. Pass `stat` if
+        it's at hand to save the syscall. Returns whether anything was
+        forgotten."""
+        if stat is None:
+            stat = os.stat(self.file_path())
+            jnl.trace.count("syscall stat")
+        stat_key = (stat.st_mtime_ns, stat.st_size)
+        tags, content = self._tags, self._content
+        stale = False
+        if tags is not None and tags.stat_key != stat_key:
+            self._tags = None
+            stale = True
+        if content is not None and content.stat_key != stat_key:
+            self._content = None
+            stale = True
+        return stale
+
+    def content(self, stat: Optional[os.stat_result] = None) -> EntryContent:
+        """The file's text, only re-read if its mtime or size changed since
+        the last call. Tags parsed from an older version are dropped. Pass
+        `stat` if the file was only just stat-ed."""
+        if stat is None:
+            stat = os.stat(self.file_path())
+            jnl.trace.count("syscall stat")
+        stat_key = (stat.st_mtime_ns, stat.st_size)
+        if self._content is not None and self._content.stat_key == stat_key:
+            return self._content
+        text = self._read_text(stat)
+        if self._tags is not None and self._tags.stat_key != stat_key:
+            # parsed from an older version (or we can't tell)
+            self._tags = None
+        self._content = EntryContent(text, stat_key)
+        return self._content
+
+    def _read_text(self, stat: os.stat_result, errors: str = "strict") -> str:
+        with jnl.trace.span("Entry.lines (read)"), open(
+            self.file_path(), errors=errors
+        ) as f:
+            text = f.read()
+        jnl.trace.count("file opens")
+        jnl.trace.count("bytes read", stat.st_size)
+        return text
+
+    def forget_content(self) -> None:
+        """Drop the cached text, e.g. after searching it found nothing."""
+        self._content = None
 
     def lines(
         self, min_index: int = 0, max_index: Optional[int] = None, strip=False
     ) -> Generator[Tuple[str, int], None, None]:
         if min_index < 0 or (max_index is not None and min_index > max_index):
             raise ValueError("Invalid min={} and max={}".format(min_index, max_index))
-        line_index = -1
-        with open(self.file_path()) as f:
-            for line in f:
-                line_index = line_index + 1
-                if max_index is not None and line_index > max_index:
-                    break
-                elif line_index < min_index:
-                    continue
-                yield line.strip() if strip else line, line_index
+        content = self.content()
+        end = len(content) if max_index is None else min(len(content), max_index + 1)
+        for line_index in range(min_index, end):
+            line = content.line(line_index)
+            yield line.strip() if strip else line, line_index
 
     def text(self) -> str:
         out = "\n".join([line for (line, line_no) in self.lines()])
         return out
 
-    def rewrite(self, replacements: List[Callable[[str], str]]):
-        lines = [*self.lines(strip=False)]
+    def rewritten(self, replacements: List[Callable[[str], str]]) -> Optional[str]:
+        """The file's text with every replacement applied to every line, or
+        None if that wouldn't change anything."""
+        lines = [line for line, line_no in self.lines(strip=False)]
         replaced = []
-        for line, line_no in lines:
+        for line in lines:
             for replacement in replacements:
                 line = replacement(line)
             replaced.append(line)
         if lines == replaced:
-            return
-        with open(self.file_path(), "w") as handle:
-            handle.writelines(replaced)
+            return None
+        return "".join(replaced)
+
+    def write_temp(self, text: str) -> str:
+        """Write text to a temp file next to this entry, returning its path.
+        `os.replace` it over `file_path()` to swap it in atomically."""
+        handle, temp_path = tempfile.mkstemp(
+            dir=self.path, prefix=".%s." % self.file_name, suffix=".tmp"
+        )
+        try:
+            with os.fdopen(handle, "w") as f:
+                f.write(text)
+            os.chmod(temp_path, os.stat(self.file_path()).st_mode & 0o7777)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+        return temp_path
+
+    def replace_with(self, temp_path: str) -> None:
+        os.replace(temp_path, self.file_path())
+        self._content = None
+        self._tags = None
+
+    def rewrite(self, replacements: List[Callable[[str], str]]):
+        text = self.rewritten(replacements)
+        if text is not None:
+            self.replace_with(self.write_temp(text))
+
+    @staticmethod
+    def ft_tag_to_obsidian(line: str) -> str:
+        tags = Tag.parse(line)
+        if not tags:
+            return line
+        one = [t for t in tags if t.one_on_one()]
+        if not one or not one[0]:
+            return line
+        person, when = one[0].one_on_one()
+        person = person.replace(" ", "_")
+        return line.replace(str(one[0]), f"#one/{person} {when}")
 
     def convert_ft_tags_to_obsidian(self):
         """
@@ -288,33 +645,15 @@ class Entry:
         to
             #one/Foo yyyy-mm-dd
         """
-
-        def _conv_tag(line: str) -> str:
-            tags = Tag.parse(line)
-            if not tags:
-                return line
-            one = [t for t in tags if t.one_on_one()]
-            if not one or not one[0]:
-                return line
-            person, when = one[0].one_on_one()
-            person = person.replace(" ", "_")
-            return line.replace(str(one[0]), f"#one/{person} {when}")
-
-        self.rewrite([_conv_tag])
+        self.rewrite([Entry.ft_tag_to_obsidian])
 
     # maybe combine has_tag and tag_starts_with and pass in a predicate for the tag value?
 
     def has_tag(self, name: str, val: str = None) -> bool:
-        return any(
-            t.name == name and (True if val is None else t.value == val)
-            for t in self.tags
-        )
+        return self.tag_set().has(name, val)
 
     def tag_starts_with(self, name: str, prefix: str) -> bool:
-        return any(
-            t.name == name and t.value is not None and t.value.startswith(prefix)
-            for t in self.tags
-        )
+        return self.tag_set().starts_with(name, prefix)
 
     def __repr__(self) -> str:
         return "%s: %s" % (self.file_name, self.tags)
@@ -0,0 +1,273 @@
+import json
+import os
+import sqlite3
+from typing import AnyStr, Dict, Iterable, List, Optional, Pattern, Set, Tuple
+
+try:
+    from re import _parser as sre_parse
+    from re import _constants as sre_constants
+except ImportError:  # python < 3.11
+    import sre_parse
+    import sre_constants
+
+import jnl.changes
+import jnl.layout
+import jnl.trace
+from jnl.entries import Entry, Tag
+
+
+_FOLD = str.maketrans({"\u0130": "i", "\u0131": "i", "\u017f": "s", "\u212a": "k"})
+"""Non-ASCII characters that `re.I` treats as equal to an ASCII letter"""
+
+
+def fold(text: str) -> str:
+    """Case-fold `text` the same way for indexing and for querying."""
+    return text.translate(_FOLD).lower()
+
+
+def trigrams(lines: Iterable[str]) -> Set[str]:
+    out = set()
+    for line in lines:
+        line = fold(line.rstrip("\n"))
+        out.update(line[i : i + 3] for i in range(len(line) - 2))
+    return out
+
+
+def required_literals(pattern: Pattern[AnyStr]) -> List[str]:
+    """Runs of printable ASCII characters that any match of `pattern` must
+    contain. Conservative: anything we don't understand (alternation,
+    optional groups, character classes, ...) just ends the current run."""
+    out: List[str] = []
+    _required(sre_parse.parse(pattern.pattern, pattern.flags), out)
+    return [fold(run) for run in out]
+
+
+def _required(parsed, out: List[str]) -> None:
+    run: List[str] = []
+
+    def flush():
+        if run:
+            out.append("".join(run))
+            run.clear()
+
+    for op, arg in parsed:
+        if op is sre_constants.LITERAL and 32 <= arg < 127:
+            run.append(chr(arg))
+            continue
+        flush()
+        if op is sre_constants.SUBPATTERN:
+            _required(arg[-1], out)
+        elif op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT):
+            if arg[0] >= 1:
+                _required(arg[2], out)
+    flush()
+
+
+class EntryIndex:
+    """Persistent per-entry metadata kept in `$JNL_DIR/.jnl/index.sqlite`.
+
+    Each row remembers the stat data of a worklog file along with the tags
+    parsed from it. `refresh` only re-reads files whose stat data changed
+    since the last run so listing entries and looking up tags doesn't have
+    to read every file body on every invocation."""
+
+    SCHEMA_VERSION = 2
+
+    def __init__(self, state_dir: str):
+        self.state_dir = state_dir
+        self._conn: Optional[sqlite3.Connection] = None
+
+    @staticmethod
+    def _encode_tags(tags: List[Tag]) -> str:
+        return json.dumps([[t.name, t.value] for t in tags])
+
+    @staticmethod
+    def _decode_tags(encoded: str) -> List[Tag]:
+        return [Tag(name=name, value=value) for (name, value) in json.loads(encoded)]
+
+    def _connection(self) -> sqlite3.Connection:
+        if self._conn is None:
+            ensure_state_dir(self.state_dir)
+            # Used from whichever thread loads entries (the daemon's request
+            # threads, `jnl sync` loading during the pull) but never from two
+            # at once.
+            conn = sqlite3.connect(
+                os.path.join(self.state_dir, "index.sqlite"), check_same_thread=False
+            )
+            version = conn.execute("PRAGMA user_version").fetchone()[0]
+            if version != EntryIndex.SCHEMA_VERSION:
+                self._create_schema(conn)
+            self._conn = conn
+        return self._conn
+
+    def _create_schema(self, conn: sqlite3.Connection) -> None:
+        with conn:
+            conn.execute("DROP TABLE IF EXISTS entries")
+            conn.execute("DROP TABLE IF EXISTS grams")
+            conn.execute(
+                """
+                CREATE TABLE entries (
+                    guid TEXT PRIMARY KEY,
+                    -- relative to worklogs/, see jnl.layout
+                    file_name TEXT NOT NULL UNIQUE,
+                    mtime_ns INTEGER NOT NULL,
+                    size INTEGER NOT NULL,
+                    inode INTEGER NOT NULL,
+                    tags TEXT NOT NULL
+                )
+                """
+            )
+            # Case-folded trigrams of each entry's lines. Used by `candidates`
+            # to narrow down which files a search has to read.
+            conn.execute(
+                """
+                CREATE TABLE grams (
+                    gram TEXT NOT NULL,
+                    guid TEXT NOT NULL,
+                    PRIMARY KEY (gram, guid)
+                ) WITHOUT ROWID
+                """
+            )
+            conn.execute("CREATE INDEX grams_guid ON grams (guid)")
+            conn.execute("PRAGMA user_version = %d" % EntryIndex.SCHEMA_VERSION)
+
+    def refresh(self, worklogs_path: str) -> List[Entry]:
+        """Return the entries in `worklogs_path`, re-parsing only files whose
+        mtime, size, or inode differ from what the index has recorded."""
+        with jnl.trace.span("EntryIndex.refresh"):
+            return self._refresh(worklogs_path)
+
+    def _refresh(self, worklogs_path: str) -> List[Entry]:
+        conn = self._connection()
+        known: Dict[str, Tuple[str, int, int, int, str, str]] = {
+            row[1]: row
+            for row in conn.execute(
+                "SELECT guid, file_name, mtime_ns, size, inode, tags FROM entries"
+            )
+        }
+        changes = jnl.changes.GitChanges(os.path.dirname(worklogs_path), "index")
+        changed = None
+        if len(known) >= jnl.changes.GitChanges.MIN_ENTRIES:
+            changed = changes.since_mark()
+        entries: List[Entry] = []
+        rows: List[Tuple[str, str, int, int, int, str]] = []
+        grams: List[Tuple[str, str]] = []
+        if changed is None:
+            for name, stat in jnl.layout.files(worklogs_path):
+                row = known.pop(name, None)
+                entries.append(self._entry(worklogs_path, name, stat, row, rows, grams))
+        else:
+            # git vouches for everything else being as it was indexed
+            unchanged = {n: r for n, r in known.items() if n not in changed}
+            for name in changed:
+                if not Entry.valid_file_name(name):
+                    continue
+                try:
+                    stat = os.stat(os.path.join(worklogs_path, name))
+                except FileNotFoundError:
+                    continue
+                row = known.pop(name, None)
+                entries.append(self._entry(worklogs_path, name, stat, row, rows, grams))
+            jnl.trace.count("syscall stat", len(changed))
+            entries.extend(self._indexed(worklogs_path, r) for r in unchanged.values())
+            # what's left are the rows of deleted files
+            known = {n: r for n, r in known.items() if n in changed}
+        if rows or known:
+            stale = [(row[0],) for row in known.values()]
+            stale.extend((row[0],) for row in rows)
+            with conn:
+                conn.executemany("DELETE FROM entries WHERE guid = ?", stale)
+                conn.executemany("DELETE FROM grams WHERE guid = ?", stale)
+                conn.executemany(
+                    "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?)", rows
+                )
+                conn.executemany("INSERT OR IGNORE INTO grams VALUES (?, ?)", grams)
+        if changed is None and len(entries) < jnl.changes.GitChanges.MIN_ENTRIES:
+            changes.forget()
+        else:
+            changes.mark()
+        jnl.trace.count("entries re-indexed", len(rows))
+        entries.sort(key=lambda e: e.file_name)
+        return entries
+
+    @staticmethod
+    def _indexed(worklogs_path: str, row: Tuple) -> Entry:
+        return Entry.at(
+            worklogs_path,
+            row[1],
+            guid=row[0],
+            tags=EntryIndex._decode_tags(row[5]),
+            stat_key=(row[2], row[3]),
+        )
+
+    @staticmethod
+    def _entry(
+        worklogs_path: str,
+        relative_path: str,
+        stat: os.stat_result,
+        row: Optional[Tuple],
+        rows: List[Tuple],
+        grams: List[Tuple[str, str]],
+    ) -> Entry:
+        """The entry at relative_path, from its index row if stat says that's
+        current. Otherwise it's re-read and its new row and trigrams are
+        added to `rows` and `grams`."""
+        if row is not None and row[2:5] == (
+            stat.st_mtime_ns,
+            stat.st_size,
+            stat.st_ino,
+        ):
+            return EntryIndex._indexed(worklogs_path, row)
+        entry = Entry.at(worklogs_path, relative_path)
+        try:
+            # read the text once for both; tags come from it while it's cached
+            lines = [line for line, _ in entry.lines()]
+        except UnicodeDecodeError:
+            # not UTF-8: index what decodes, the way its tags are read
+            with open(entry.file_path(), errors="replace") as handle:
+                lines = handle.readlines()
+        grams.extend((gram, entry.guid) for gram in trigrams(lines))
+        rows.append(
+            (
+                entry.guid,
+                relative_path,
+                stat.st_mtime_ns,
+                stat.st_size,
+                stat.st_ino,
+                EntryIndex._encode_tags(entry.tags),
+            )
+        )
+        entry.forget_content()
+        return entry
+
+    def candidates(self, pattern: Pattern[AnyStr]) -> Optional[Set[str]]:
+        """Guids of the entries that could possibly match `pattern` or None
+        if the pattern doesn't require any trigrams and everything is a
+        candidate. Only valid right after `refresh`."""
+        required = set()
+        for run in required_literals(pattern):
+            required.update(run[i : i + 3] for i in range(len(run) - 2))
+        if not required:
+            return None
+        required = sorted(required)
+        rows = self._connection().execute(
+            "SELECT guid FROM grams WHERE gram IN (%s) GROUP BY guid"
+            " HAVING COUNT(*) = ?" % ", ".join("?" * len(required)),
+            [*required, len(required)],
+        )
+        return {row[0] for row in rows}
+
+    def close(self) -> None:
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+
+def ensure_state_dir(state_dir: str) -> str:
+    """Create `$JNL_DIR/.jnl` if needed. It gets its own `.gitignore` so the
+    caches in there never show up in `jnl stat` of a git-backed journal."""
+    if not os.path.isdir(state_dir):
+        os.makedirs(state_dir)
+        with open(os.path.join(state_dir, ".gitignore"), "w") as handle:
+            handle.write("*\n")
+    return state_dir
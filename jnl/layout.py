@@ -0,0 +1,119 @@
+"""Where in `worklogs/` each entry's file lives.
+
+By default every worklog sits directly in `worklogs/` ("flat"). Big journals
+can shard them into subdirectories instead, either by month ("month":
+`worklogs/2021/03/GUID.txt`) or by the first two characters of the guid
+("prefix": `worklogs/HM/GUID.txt`). The layout is recorded in
+`worklogs/.layout` so every checkout of a journal agrees on it. Entries are
+found wherever they are regardless of the layout; it only decides where new
+entries go and where `jnl reshard` moves existing ones."""
+
+import datetime
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Tuple
+
+import jnl.system
+import jnl.trace
+from jnl.entries import Entry
+
+LAYOUTS = ("flat", "month", "prefix")
+LAYOUT_FILE = ".layout"
+
+
+def read(worklogs_path: str) -> str:
+    try:
+        with open(os.path.join(worklogs_path, LAYOUT_FILE)) as handle:
+            layout = handle.read().strip()
+    except FileNotFoundError:
+        return "flat"
+    if layout not in LAYOUTS:
+        raise ValueError("Unknown layout %s in %s" % (layout, LAYOUT_FILE))
+    return layout
+
+
+def write(worklogs_path: str, layout: str) -> None:
+    if layout not in LAYOUTS:
+        raise ValueError("Layout must be one of %s" % ", ".join(LAYOUTS))
+    path = os.path.join(worklogs_path, LAYOUT_FILE)
+    if layout == "flat":
+        if os.path.exists(path):
+            os.unlink(path)
+        return
+    with open(path, "w") as handle:
+        handle.write(layout + "\n")
+
+
+def shard(layout: str, guid: str, when: Optional[datetime.date] = None) -> str:
+    """Directory (relative to worklogs/) for an entry; "" when flat. `when`
+    is when the entry was started (default today) for the month layout."""
+    if layout == "month":
+        if when is None:
+            when = jnl.system.now()
+        return os.path.join("%04d" % when.year, "%02d" % when.month)
+    if layout == "prefix":
+        return guid[:2]
+    return ""
+
+
+def started(entry: Entry) -> datetime.date:
+    """The day of a daily entry, otherwise the day its file last changed."""
+    daily = entry.is_a_daily_entry()
+    if daily:
+        try:
+            return datetime.date.fromisoformat(daily)
+        except ValueError:
+            pass
+    return datetime.date.fromtimestamp(os.stat(entry.file_path()).st_mtime)
+
+
+def moves(entries: List[Entry], layout: str) -> List[Tuple[Entry, str]]:
+    """(entry, new path relative to worklogs/) for every entry not already
+    where `layout` would put it."""
+    out = []
+    for entry in entries:
+        directory = shard(layout, entry.guid, started(entry))
+        target = os.path.join(directory, entry.file_name)
+        if target != entry.relative_path():
+            out.append((entry, target))
+    return out
+
+
+def files(worklogs_path: str, jobs: int = 8) -> List[Tuple[str, os.stat_result]]:
+    """(path relative to worklogs_path, stat) of every worklog. Each shard
+    directory is listed with its own `os.scandir` on a thread pool."""
+
+    def _list(relative: str) -> Tuple[List[Tuple[str, os.stat_result]], List[str]]:
+        found, subdirs = [], []
+        with os.scandir(os.path.join(worklogs_path, relative)) as it:
+            for dir_entry in it:
+                if dir_entry.name.startswith("."):
+                    continue
+                name = os.path.join(relative, dir_entry.name)
+                if dir_entry.is_dir(follow_symlinks=False):
+                    subdirs.append(name)
+                elif Entry.valid_file_name(dir_entry.name) and dir_entry.is_file():
+                    found.append((name, dir_entry.stat()))
+        jnl.trace.count("syscall scandir")
+        jnl.trace.count("syscall stat", len(found))
+        return found, subdirs
+
+    out: List[Tuple[str, os.stat_result]] = []
+    found, pending = _list("")
+    out.extend(found)
+    if not pending:
+        return out
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        futures = [pool.submit(_list, d) for d in pending]
+        while futures:
+            found, subdirs = futures.pop().result()
+            out.extend(found)
+            futures.extend(pool.submit(_list, d) for d in subdirs)
+    return out
+
+
+def prune(worklogs_path: str) -> None:
+    """Remove shard directories left empty, e.g. after resharding."""
+    for directory, _, _ in os.walk(worklogs_path, topdown=False):
+        if directory != worklogs_path and not os.listdir(directory):
+            os.rmdir(directory)
@@ -1,12 +1,13 @@
-import binascii
+import json
 import os
 import re
-
-import xattr
+import tempfile
+from typing import Dict, List, Optional
 
 import jnl.system
 from jnl.entries import Entry
 from jnl.database import NopListener, Database
+from jnl.index import ensure_state_dir
 
 
 class SetsOpenWith(NopListener):
@@ -39,13 +40,19 @@ class SetsOpenWith(NopListener):
         flags=re.M,
     )
 
-    OPEN_WITH_ATTR = binascii.unhexlify(OPEN_WITH_ATTR_HEX)
+    OPEN_WITH_ATTR = bytes.fromhex(OPEN_WITH_ATTR_HEX)
+
+    thread_safe = True
 
     def on_entry(self, database: Database, entry: Entry) -> None:
         if not entry.has_tag("ft", None):
             return
+        changed = database.changed_files
+        if changed is not None and entry.relative_path() not in changed:
+            # set when the file was written and it hasn't been replaced since
+            return
 
-        return xattr.setxattr(
+        return jnl.system.setxattr(
             entry.file_path(),
             "com.apple.LaunchServices.OpenWith",
             SetsOpenWith.OPEN_WITH_ATTR,
@@ -53,8 +60,57 @@ class SetsOpenWith(NopListener):
 
 
 class Symlinker(NopListener):
+    """Maintains the `quick/` tree of symlinks for `@quick(...)` tags.
+
+    The links made by the last scan are remembered in `.jnl/quick.json` so
+    later scans only create, remove, or retarget the links that changed.
+    Without that file (or with `jnl scan --full`) every link is created
+    again, in `.jnl/quick.new` (which `PreScanQuickCleaner` empties first),
+    and that whole tree then takes the place of `quick/` in one rename. So
+    nobody following a link in `quick/` ever finds it empty or half-built.
+    The file is removed before `quick/` is touched and written again only
+    once every link is in place, so a scan that fails part-way is followed
+    by a rebuild."""
+
     def __init__(self):
         self.yyyymmdd = None
+        self._links: Dict[str, str] = {}
+        """Link path relative to quick/ => entry file it should point to"""
+        self._previous: Dict[str, str] = {}
+        self._root: Optional[str] = None
+        """Where the links go: quick/ itself or, when rebuilding, staging"""
+
+    @staticmethod
+    def state_file(database: Database) -> str:
+        return database.state_path("quick.json")
+
+    @staticmethod
+    def staging_path(database: Database) -> str:
+        return database.state_path("quick.new")
+
+    @staticmethod
+    def rebuilding(database: Database) -> bool:
+        return (
+            database.full_scan
+            or not os.path.exists(Symlinker.state_file(database))
+            or not jnl.system.exists(os.path.join(database.dbdir, "quick"))
+        )
+
+    def on_pre_scan(self, database: Database) -> None:
+        self._links = {}
+        self._previous = {}
+        state_file = Symlinker.state_file(database)
+        if Symlinker.rebuilding(database):
+            # Forget what we knew so a scan that fails part-way (leaving
+            # quick/ as it was) is followed by another rebuild.
+            if os.path.exists(state_file):
+                os.remove(state_file)
+            ensure_state_dir(database.state_path())
+            self._root = Symlinker.staging_path(database)
+        else:
+            with open(state_file) as handle:
+                self._previous = json.load(handle)
+            self._root = database.path("quick")
 
     def on_entry(self, database: Database, entry: Entry) -> None:
         if self.yyyymmdd is None:
@@ -63,27 +119,107 @@ class Symlinker(NopListener):
         for tag in tags:
             val = tag.value
             parts = val.split("/")
-            dir_parts = parts[:-1]
-            past = parts[-1]
-            filename_part = "%s.%s" % (past, entry.file_extension())
-            into_dir = database.path("quick", *dir_parts)
-            symlink = os.path.join(into_dir, filename_part)
-            if jnl.system.exists(symlink):
+            filename_part = "%s.%s" % (parts[-1], entry.file_extension())
+            link = "/".join([*parts[:-1], filename_part])
+            existing = self._links.get(link)
+            if existing is not None and existing != entry.file_path():
+                raise ValueError(
+                    "@quick(%s) owned by %s, so %s can't take it"
+                    % (val, existing, entry.file_path())
+                )
+            self._links[link] = entry.file_path()
+
+    def on_post_scan(self, database: Database) -> None:
+        state_file = Symlinker.state_file(database)
+        if os.path.exists(state_file):
+            # It describes quick/ as it was; while quick/ changes it would
+            # be wrong, and without it a scan that fails part-way is
+            # followed by a rebuild.
+            os.remove(state_file)
+        for link, target in self._previous.items():
+            if self._links.get(link) != target:
+                try:
+                    jnl.system.unlink(os.path.join(self._root, link))
+                except FileNotFoundError:
+                    pass
+        for link, target in self._links.items():
+            if self._previous.get(link) == target and jnl.system.lexists(
+                os.path.join(self._root, link)
+            ):
+                # unless someone deleted it since
+                continue
+            *dir_parts, filename_part = link.split("/")
+            symlink = os.path.join(self._directory(*dir_parts), filename_part)
+            if link not in self._previous and jnl.system.lexists(symlink):
                 existing = jnl.system.readlink(symlink)
-                if existing == entry.file_path():
-                    # job already done
+                if existing == target:
                     continue
-                else:
-                    raise ValueError(
-                        "@quick(%s) owned by %s, so %s can't take it"
-                        % (val, existing, entry.file_path())
-                    )
-            jnl.system.symlink(entry.file_path(), symlink)
+                raise ValueError(
+                    "@quick(%s) owned by %s, so %s can't take it"
+                    % (os.path.splitext(link)[0], existing, target)
+                )
+            jnl.system.symlink(target, symlink)
+        if self._root == Symlinker.staging_path(database):
+            jnl.system.replace_dir(self._directory(), database.path("quick"))
+        ensure_state_dir(database.state_path())
+        handle, temp_path = tempfile.mkstemp(dir=database.state_path(), suffix=".tmp")
+        try:
+            with os.fdopen(handle, "w") as f:
+                json.dump(self._links, f, indent=2, sort_keys=True)
+            os.replace(temp_path, state_file)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+
+    def _directory(self, *parts: str) -> str:
+        out = os.path.join(self._root, *parts)
+        if not jnl.system.exists(out):
+            jnl.system.makedirs(out)
+        return out
 
 
 class PreScanQuickCleaner(NopListener):
+    """Empties what a failed rebuild left in `Symlinker`'s staging tree."""
+
+    thread_safe = True
+
     def on_pre_scan(self, database: Database) -> None:
-        path = database.path("quick")
-        print(("Scanning %s" % path))
-        if jnl.system.exists(path):
-            jnl.system.rmtree(path)
+        print(("Scanning %s" % os.path.join(database.dbdir, "quick")))
+        staging = Symlinker.staging_path(database)
+        if Symlinker.rebuilding(database) and jnl.system.exists(staging):
+            jnl.system.rmtree(staging)
+
+
+class Summarizer(NopListener):
+    """Keeps the weekly and monthly roll-ups in `summary/` current; only the
+    ones whose daily entries changed get rewritten (see `jnl.summary`)."""
+
+    def on_post_scan(self, database: Database) -> None:
+        Summarizer.summarize(database, force=database.full_scan)
+
+    @staticmethod
+    def summarize(database: Database, force: bool = False) -> List[str]:
+        import jnl.summary
+
+        return jnl.summary.materialize(
+            os.path.join(database.dbdir, "summary"),
+            database.state_path("summary.json"),
+            database.entries,
+            force=force,
+        )
+
+
+class CorpusUpdater(NopListener):
+    """Keeps the packed search corpus (see `jnl.corpus`) current once it's
+    been turned on with `jnl scan --corpus`."""
+
+    def on_post_scan(self, database: Database) -> None:
+        import jnl.corpus
+
+        corpus = jnl.corpus.Corpus(database.state_path())
+        if corpus.exists():
+            corpus.update(
+                database.entries,
+                full=database.full_scan,
+                changed=database.changed_files,
+            )
@@ -0,0 +1,130 @@
+"""Searching entries' files on several cores at once.
+
+`Database._search` reads and searches files on threads, but the regex
+itself only ever runs on one core at a time. `search` here hands the
+entries out in chunks to a pool of processes instead. Each worker compiles
+the pattern once, when it starts; a chunk goes out as just the files'
+paths and comes back as just the hits, (line index, start, end) for each
+matching line, so a search for an uncommon term pickles next to nothing.
+
+Match objects can't cross processes, so the parent reads the entries that
+matched and searches their matching lines again to build the `EntryMatch`es
+(`jnl search` was going to read those files to show them anyway). Results
+come back in the order the entries were given, a few chunks ahead of what's
+been consumed, just like `_search`."""
+
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from itertools import islice
+from typing import (
+    Callable,
+    Iterable,
+    Iterator,
+    List,
+    Match,
+    Optional,
+    Pattern,
+    Tuple,
+)
+
+import jnl.corpus
+import jnl.trace
+from jnl.entries import Entry, EntryMatch
+
+CHUNK = 64
+"""Files per task: enough to keep the pickling per file small, few enough
+that the first page doesn't wait on much more than it needs"""
+
+Hit = Tuple[int, int, int]
+"""(line index, start, end) of a match within its line"""
+
+_pattern: Optional[Pattern[str]] = None
+_search: Optional[Callable[..., Optional[Match[str]]]] = None
+
+
+def _start(pattern: Pattern[str]) -> None:
+    """Runs once in each worker, with pattern compiled afresh by unpickling."""
+    global _pattern, _search
+    _pattern = pattern
+    _search = jnl.corpus.multiline_search(pattern)
+
+
+def _search_files(paths: List[str]) -> List[Tuple[int, List[Hit]]]:
+    """(index into paths, hits) for each file with a matching line."""
+    out = []
+    for index, path in enumerate(paths):
+        try:
+            with open(path) as handle:
+                text = handle.read()
+        except FileNotFoundError:
+            continue
+        hits = [(line_index,) + match.span() for line_index, match in _lines(text)]
+        if hits:
+            out.append((index, hits))
+    return out
+
+
+def _lines(text: str) -> Iterable[Tuple[int, Match[str]]]:
+    """(line index, match) of each line of text `_pattern` matches, split
+    into lines the way `EntryContent` does."""
+    if _search is not None:
+        # only split up the files with a match somewhere
+        return jnl.corpus.line_matches(_pattern, _search, text, 0, len(text))
+    lines = text.split("\n")
+    if lines[-1] == "":
+        lines.pop()
+    found = []
+    for line_index, line in enumerate(lines):
+        if line_index < len(lines) - 1 or text.endswith("\n"):
+            line += "\n"
+        match = _pattern.search(line)
+        if match is not None:
+            found.append((line_index, match))
+    return found
+
+
+def _rebuild(entry: Entry, pattern: Pattern[str], hits: List[Hit]) -> List[EntryMatch]:
+    """The `EntryMatch`es a worker found in entry, or all of them afresh if
+    the file changed since."""
+    content = entry.content()
+    out = []
+    for line_index, start, end in hits:
+        match = None
+        if line_index < len(content):
+            match = pattern.search(content.line(line_index))
+        if match is None or match.span() != (start, end):
+            return entry.matches(pattern)
+        out.append(EntryMatch(entry, match, line_index))
+    return out
+
+
+def search(
+    entries: List[Entry], pattern: Pattern[str], processes: int
+) -> Iterator[Tuple[str, List[EntryMatch]]]:
+    """(guid, matches) for each of `entries` matching `pattern`, in order,
+    searched by `processes` worker processes."""
+    chunks = (entries[i : i + CHUNK] for i in range(0, len(entries), CHUNK))
+    pool = ProcessPoolExecutor(
+        max_workers=processes, initializer=_start, initargs=(pattern,)
+    )
+
+    def submit(chunk: List[Entry]) -> Tuple[List[Entry], Future]:
+        paths = [e.file_path() for e in chunk]
+        return chunk, pool.submit(_search_files, paths)
+
+    try:
+        pending = deque(submit(c) for c in islice(chunks, 2 * processes))
+        while pending:
+            chunk, future = pending.popleft()
+            found = future.result()
+            for next_chunk in islice(chunks, 1):
+                pending.append(submit(next_chunk))
+            jnl.trace.count("parallel chunks searched")
+            for index, hits in found:
+                entry = chunk[index]
+                matches = _rebuild(entry, pattern, hits)
+                if matches:
+                    yield entry.guid, matches
+    finally:
+        # closed early: don't search what nobody's going to look at
+        pool.shutdown(wait=True, cancel_futures=True)
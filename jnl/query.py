@@ -0,0 +1,312 @@
+"""A small language for finding entries by their tags, used by `jnl find`
+and `Database.query`:
+
+    quick:daily/2021-* AND NOT @done OR project:foo*
+
+A term is `name` (has the tag at all), `name:value` (has it with exactly
+that value), `name:prefix*`, or `name:pattern` with `*`/`?` anywhere for a
+glob. `@name` and `@name(value)` work too, so tags can be pasted as they
+are written, and `name:"a value with spaces"` can be quoted. Terms combine
+with NOT, AND (or nothing: `a b` is `a AND b`), OR and parentheses; NOT
+binds tightest, then AND, then OR. The keywords are case-insensitive.
+
+An expression is compiled once into a tree of nodes. Run against the
+`Database`'s tag lookups, every node works out which entries (by ordinal)
+it could match straight from the indexes; only when that's not exact (a
+glob value) does the tree get evaluated against each remaining entry's
+tags, in the same single pass that yields the results."""
+
+import fnmatch
+import re
+from typing import (
+    TYPE_CHECKING,
+    Iterator,
+    List,
+    NoReturn,
+    Optional,
+    Pattern,
+    Set,
+)
+
+from jnl.entries import TagSet
+
+if TYPE_CHECKING:
+    from jnl.database import _Lookups
+    from jnl.entries import Entry
+
+TOKEN_RE = re.compile(
+    r"""
+    \s*
+    (?:
+        (@[^\s()]+\([^)]*\))    # group 1: @name(value), parens and all
+        |
+        ([()])                  # group 2: grouping
+        |
+        ((?:[^\s()"]|"[^"]*")+) # group 3: word, "quoted" parts may have spaces
+    )
+    """,
+    re.VERBOSE,
+)
+
+KEYWORDS = ("AND", "OR", "NOT")
+
+
+class Node:
+    exact: bool = True
+    """Whether `candidates` is exactly what matches, so `test` needn't run"""
+
+    def candidates(self, lookups: "_Lookups") -> Optional[Set[int]]:
+        """Ordinals of the entries that may match, or None for any of them."""
+        raise NotImplementedError
+
+    def test(self, tags: TagSet) -> bool:
+        raise NotImplementedError
+
+
+class Has(Node):
+    def __init__(self, name: str, value: Optional[str] = None):
+        self.name = name
+        self.value = value
+
+    def candidates(self, lookups: "_Lookups") -> Optional[Set[int]]:
+        if self.value is None:
+            return set(lookups.by_name.get(self.name, ()))
+        return set(lookups.by_tag.get((self.name, self.value), ()))
+
+    def test(self, tags: TagSet) -> bool:
+        return tags.has(self.name, self.value)
+
+    def __repr__(self) -> str:
+        if self.value is None:
+            return "@%s" % self.name
+        return "@%s(%s)" % (self.name, self.value)
+
+
+class StartsWith(Node):
+    def __init__(self, name: str, prefix: str):
+        self.name = name
+        self.prefix = prefix
+
+    def candidates(self, lookups: "_Lookups") -> Optional[Set[int]]:
+        return lookups.ordinals_starting_with(self.name, self.prefix)
+
+    def test(self, tags: TagSet) -> bool:
+        return tags.starts_with(self.name, self.prefix)
+
+    def __repr__(self) -> str:
+        return "@%s(%s*)" % (self.name, self.prefix)
+
+
+class Glob(Node):
+    """No index covers these, so candidates are every entry with the tag and
+    the pattern is checked against each of their values."""
+
+    exact = False
+
+    def __init__(self, name: str, pattern: str):
+        self.name = name
+        self.pattern = pattern
+        self._re: Pattern[str] = re.compile(fnmatch.translate(pattern))
+
+    def candidates(self, lookups: "_Lookups") -> Optional[Set[int]]:
+        return set(lookups.by_name.get(self.name, ()))
+
+    def test(self, tags: TagSet) -> bool:
+        match = self._re.match
+        return any(
+            t.name == self.name and t.value is not None and match(t.value)
+            for t in tags.tags
+        )
+
+    def __repr__(self) -> str:
+        return "@%s(%s)" % (self.name, self.pattern)
+
+
+class Not(Node):
+    def __init__(self, operand: Node):
+        self.operand = operand
+        self.exact = operand.exact
+
+    def candidates(self, lookups: "_Lookups") -> Optional[Set[int]]:
+        if not self.operand.exact:
+            return None
+        return set(range(len(lookups.entries))) - self.operand.candidates(lookups)
+
+    def test(self, tags: TagSet) -> bool:
+        return not self.operand.test(tags)
+
+    def __repr__(self) -> str:
+        return "NOT %r" % (self.operand,)
+
+
+class And(Node):
+    def __init__(self, operands: List[Node]):
+        # Cheap, exact tests first so `test` can stop early
+        self.operands = sorted(operands, key=lambda o: not o.exact)
+        self.exact = all(o.exact for o in operands)
+
+    def candidates(self, lookups: "_Lookups") -> Optional[Set[int]]:
+        out = None
+        for operand in self.operands:
+            found = operand.candidates(lookups)
+            if found is None:
+                continue
+            out = found if out is None else out & found
+            if not out:
+                break
+        return out
+
+    def test(self, tags: TagSet) -> bool:
+        return all(o.test(tags) for o in self.operands)
+
+    def __repr__(self) -> str:
+        return "(%s)" % " AND ".join(map(repr, self.operands))
+
+
+class Or(Node):
+    def __init__(self, operands: List[Node]):
+        self.operands = operands
+        self.exact = all(o.exact for o in operands)
+
+    def candidates(self, lookups: "_Lookups") -> Optional[Set[int]]:
+        out: Set[int] = set()
+        for operand in self.operands:
+            found = operand.candidates(lookups)
+            if found is None:
+                return None
+            out |= found
+        return out
+
+    def test(self, tags: TagSet) -> bool:
+        return any(o.test(tags) for o in self.operands)
+
+    def __repr__(self) -> str:
+        return "(%s)" % " OR ".join(map(repr, self.operands))
+
+
+class Query:
+    def __init__(self, expression: str):
+        self.expression = expression
+        self.root: Node = _Parser(expression).parse()
+
+    def run(self, lookups: "_Lookups") -> Iterator["Entry"]:
+        """Entries matching, lazily and in the order of `lookups.entries`."""
+        candidates = self.root.candidates(lookups)
+        ordinals = (
+            range(len(lookups.entries)) if candidates is None else sorted(candidates)
+        )
+        entries = lookups.entries
+        if self.root.exact:
+            for ordinal in ordinals:
+                yield entries[ordinal]
+            return
+        test = self.root.test
+        for ordinal in ordinals:
+            entry = entries[ordinal]
+            if test(entry.tag_set()):
+                yield entry
+
+    def __repr__(self) -> str:
+        return "Query(%r)" % (self.root,)
+
+
+def term(word: str) -> Node:
+    """The node for a single term such as `@done` or `project:foo*`."""
+    if word.startswith("@"):
+        word = word[1:]
+    if word.endswith(")") and "(" in word:
+        name, _, value = word[:-1].partition("(")
+    else:
+        name, colon, value = word.partition(":")
+        if not colon:
+            value = None
+    if value is not None:
+        value = value.replace('"', "")
+    if not name:
+        raise ValueError("Missing tag name in '%s'" % word)
+    if value is None:
+        return Has(name)
+    if not any(c in value for c in "*?["):
+        return Has(name, value)
+    if value.endswith("*") and not any(c in value[:-1] for c in "*?["):
+        return StartsWith(name, value[:-1])
+    return Glob(name, value)
+
+
+class _Parser:
+    def __init__(self, expression: str):
+        self.expression = expression
+        self.tokens: List[str] = []
+        position = 0
+        expression = expression.rstrip()
+        while position < len(expression):
+            match = TOKEN_RE.match(expression, position)
+            if match is None or not match.group(0).strip():
+                raise ValueError(
+                    "Can't make sense of '%s' in query '%s'"
+                    % (expression[position:], self.expression)
+                )
+            self.tokens.append(match.group(match.lastindex))
+            position = match.end()
+        self.position = 0
+
+    def parse(self) -> Node:
+        if not self.tokens:
+            raise ValueError("Empty query")
+        node = self._or()
+        if self.position < len(self.tokens):
+            self._fail("Unexpected '%s'" % self.tokens[self.position])
+        return node
+
+    def _fail(self, message: str) -> NoReturn:
+        raise ValueError("%s in query '%s'" % (message, self.expression))
+
+    def _peek(self) -> Optional[str]:
+        if self.position < len(self.tokens):
+            return self.tokens[self.position]
+        return None
+
+    def _keyword(self, keyword: str) -> bool:
+        token = self._peek()
+        if token is not None and token.upper() == keyword:
+            self.position += 1
+            return True
+        return False
+
+    def _or(self) -> Node:
+        operands = [self._and()]
+        while self._keyword("OR"):
+            operands.append(self._and())
+        return operands[0] if len(operands) == 1 else Or(operands)
+
+    def _and(self) -> Node:
+        operands = [self._not()]
+        while True:
+            if self._keyword("AND"):
+                operands.append(self._not())
+                continue
+            token = self._peek()
+            if token is None or token == ")" or token.upper() == "OR":
+                break
+            operands.append(self._not())
+        return operands[0] if len(operands) == 1 else And(operands)
+
+    def _not(self) -> Node:
+        if self._keyword("NOT"):
+            return Not(self._not())
+        return self._atom()
+
+    def _atom(self) -> Node:
+        token = self._peek()
+        if token is None:
+            self._fail("Unexpected end")
+        self.position += 1
+        if token == "(":
+            node = self._or()
+            if self._peek() != ")":
+                self._fail("Missing ')'")
+            self.position += 1
+            return node
+        if token == ")" or token.upper() in KEYWORDS:
+            self._fail("Unexpected '%s'" % token)
+        return term(token)
@@ -0,0 +1,65 @@
+"""Bulk conversions over many entries at once.
+
+`plan` computes the new text of every entry in parallel without touching
+anything. `apply` then writes all of them to temp files first and only
+swaps them in (via rename) once every write succeeded, so a failure
+part-way leaves the journal as it was."""
+
+import difflib
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Optional, TextIO
+
+from jnl.entries import Entry
+
+
+class Change:
+    def __init__(self, entry: Entry, old_text: str, new_text: str):
+        self.entry = entry
+        self.old_text = old_text
+        self.new_text = new_text
+
+    def diff(self) -> str:
+        return "".join(
+            difflib.unified_diff(
+                self.old_text.splitlines(keepends=True),
+                self.new_text.splitlines(keepends=True),
+                fromfile="a/" + self.entry.file_name,
+                tofile="b/" + self.entry.file_name,
+            )
+        )
+
+
+def plan(
+    entries: List[Entry], replacements: List[Callable[[str], str]], jobs: int = 1
+) -> List[Change]:
+    """Changes the replacements would make, in entry order."""
+
+    def _one(entry: Entry) -> Optional[Change]:
+        new_text = entry.rewritten(replacements)
+        old_text = entry.content().text
+        entry.forget_content()
+        if new_text is None:
+            return None
+        return Change(entry, old_text, new_text)
+
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+        return [c for c in pool.map(_one, entries) if c is not None]
+
+
+def print_diff(changes: List[Change], out: TextIO) -> None:
+    for change in changes:
+        out.write(change.diff())
+
+
+def apply(changes: List[Change]) -> None:
+    temps: List[str] = []
+    try:
+        for change in changes:
+            temps.append(change.entry.write_temp(change.new_text))
+    except BaseException:
+        for temp in temps:
+            os.unlink(temp)
+        raise
+    for change, temp in zip(changes, temps):
+        change.entry.replace_with(temp)
@@ -1,9 +1,12 @@
 import sys
 from colorama import init, Fore, Style
 from contextlib import contextmanager
+from itertools import islice
 from typing import (
     List,
     Generator,
+    Iterator,
+    Tuple,
     AnyStr,
     Dict,
     Pattern,
@@ -25,29 +28,64 @@ def _colored_screen() -> Generator[TextIO, None, None]:
         pass
 
 
-def search(database: Database, pattern: Pattern[AnyStr]) -> None:
+def search(database: Database, pattern: Pattern[AnyStr], **filters) -> None:
+    """`filters` are passed on to `Database.entries_matching`"""
     with _colored_screen() as scr:
-        return _search(database=database, pattern=pattern, scr=scr)
+        return _search(database=database, pattern=pattern, scr=scr, **filters)
 
 
-def _search(database: Database, pattern: Pattern[AnyStr], scr: TextIO) -> None:
-    entries: Dict[str, List[EntryMatch]] = database.entries_matching(pattern)
-    index: int = 0
+PAGE_SIZE = 10
+
+
+def _search(
+    database: Database, pattern: Pattern[AnyStr], scr: TextIO, **filters
+) -> None:
+    results = database.entries_matching(pattern, **filters)
+    options: Dict[int, str] = {}
+    try:
+        while True:
+            page = render_page(results, scr, first=len(options))
+            options.update(page)
+            if not options:
+                return
+            if len(page) < PAGE_SIZE:
+                choice = input("? ")
+                break
+            choice = input("? (enter for more) ")
+            if choice != "":
+                break
+    finally:
+        # Stop searching files nobody is going to look at
+        results.close()
+    jnl.system.open_entry(database.entry_with_guid(options[int(choice)]))
+
+
+def render(
+    database: Database, pattern: Pattern[AnyStr], scr: TextIO, **filters
+) -> Dict[int, str]:
+    """Write the first page of matches to scr and return the guid for each
+    choice."""
+    results = database.entries_matching(pattern, **filters)
+    try:
+        return render_page(results, scr)
+    finally:
+        results.close()
+
+
+def render_page(
+    results: Iterator[Tuple[str, List[EntryMatch]]], scr: TextIO, first: int = 0
+) -> Dict[int, str]:
+    """Write the next PAGE_SIZE results to scr, numbering them from `first`,
+    and return the guid for each choice. Only pulls that many from results."""
     options: Dict[int, str] = {}
-    scr.write(Fore.LIGHTGREEN_EX + "Found " + str(len(entries)) + ":\n")
-    written = 0
-    for k, v in entries.items():
-        if written > 10:
-            break
-        else:
-            written = written + 1
+    for index, (guid, matches) in enumerate(islice(results, PAGE_SIZE), first):
         scr.write(Fore.RED + Style.BRIGHT + str(index))
         scr.write("  ")
-        scr.write(Fore.LIGHTYELLOW_EX + v[0].entry.file_name)
+        scr.write(Fore.LIGHTYELLOW_EX + matches[0].entry.file_name)
         scr.write("\n")
-        [m.print(scr) for m in v[0:2]]
-        options[index] = k
-        index = index + 1
-    choice = int(input("? "))
-    key_of_choice = options[choice]
-    jnl.system.open_entry(entries[key_of_choice][0].entry)
+        [m.print(scr) for m in matches[0:2]]
+        options[index] = guid
+    if not options:
+        message = "No more matches" if first else "No matches"
+        scr.write(Fore.LIGHTGREEN_EX + message + "\n")
+    return options
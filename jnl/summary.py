@@ -0,0 +1,125 @@
+"""Weekly and monthly roll-ups of the daily entries.
+
+`summary/weekly/YYYY-Www.txt` and `summary/monthly/YYYY-MM.txt` hold the
+daily entries of that week or month one after the other. Each summary
+remembers (in `.jnl/summary.json`) the mtime and size of the dailies it was
+made from and is only rewritten when one of them was edited, added, or
+removed, so keeping years of summaries current costs a stat per daily."""
+
+import datetime
+import hashlib
+import json
+import os
+import tempfile
+from collections import defaultdict
+from typing import Callable, Dict, List, Tuple
+
+from jnl.entries import Entry
+from jnl.index import ensure_state_dir
+
+PERIODS: Dict[str, Callable[[datetime.date], str]] = {
+    "weekly": lambda day: "%04d-W%02d" % day.isocalendar()[:2],
+    "monthly": lambda day: "%04d-%02d" % (day.year, day.month),
+}
+"""summary/ subdirectory => name of the summary a day belongs in"""
+
+
+def dailies(entries: List[Entry]) -> List[Tuple[datetime.date, Entry]]:
+    """(day, entry) for each daily entry with a valid date, in day order."""
+    out = []
+    for entry in entries:
+        daily = entry.is_a_daily_entry()
+        if not daily:
+            continue
+        try:
+            out.append((datetime.date.fromisoformat(daily), entry))
+        except ValueError:
+            continue
+    out.sort(key=lambda pair: (pair[0], pair[1].relative_path()))
+    return out
+
+
+def group(days: List[Tuple[datetime.date, Entry]]) -> Dict[str, List[Entry]]:
+    """"weekly/2021-W01" and the like => the entries it summarizes"""
+    out: Dict[str, List[Entry]] = defaultdict(list)
+    for day, entry in days:
+        for kind, name in PERIODS.items():
+            out["%s/%s" % (kind, name(day))].append(entry)
+    return out
+
+
+def fingerprint(entries: List[Entry]) -> str:
+    """Changes whenever any of the entries' files (or the set of them) does."""
+    state = []
+    for entry in entries:
+        stat = os.stat(entry.file_path())
+        state.append([entry.relative_path(), stat.st_mtime_ns, stat.st_size])
+    return hashlib.sha1(json.dumps(state).encode()).hexdigest()
+
+
+def render(summary: str, entries: List[Entry]) -> str:
+    out = [
+        "%s: %d daily entries. Generated by jnl; edits will be overwritten.\n"
+        % (summary, len(entries))
+    ]
+    for entry in entries:
+        lines = [
+            line for line, _ in entry.lines() if not Entry.EXTRACT_GUID_RE.match(line)
+        ]
+        out.append("\n## %s\n\n" % entry.is_a_daily_entry())
+        out.append("".join(lines).strip("\n") + "\n")
+    return "".join(out)
+
+
+def materialize(
+    summary_path: str, state_file: str, entries: List[Entry], force: bool = False
+) -> List[str]:
+    """Bring the summaries in summary_path up to date with the daily entries
+    among `entries`. Returns the names of the summaries that were written."""
+    try:
+        with open(state_file) as handle:
+            previous: Dict[str, str] = json.load(handle)
+    except (OSError, ValueError):
+        previous = {}
+    current: Dict[str, str] = {}
+    written = []
+    read: Dict[str, Entry] = {}
+    for summary, constituents in sorted(group(dailies(entries)).items()):
+        current[summary] = fingerprint(constituents)
+        path = os.path.join(summary_path, summary + ".txt")
+        if (
+            not force
+            and previous.get(summary) == current[summary]
+            and os.path.exists(path)
+        ):
+            continue
+        _write(path, render(summary, constituents))
+        written.append(summary)
+        read.update((e.guid, e) for e in constituents)
+    # Each daily is in a weekly and a monthly summary; only read it once.
+    for entry in read.values():
+        entry.forget_content()
+    for summary in previous.keys() - current.keys():
+        # all of its dailies are gone
+        path = os.path.join(summary_path, summary + ".txt")
+        if os.path.exists(path):
+            os.unlink(path)
+    if current != previous:
+        ensure_state_dir(os.path.dirname(state_file))
+        with open(state_file, "w") as handle:
+            json.dump(current, handle, indent=2, sort_keys=True)
+    return written
+
+
+def _write(path: str, text: str) -> None:
+    """Replace path with text atomically so readers never see half of it."""
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    handle, temp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with os.fdopen(handle, "w") as f:
+            f.write(text)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
@@ -1,4 +1,6 @@
 import datetime
+import errno
+import functools
 import glob
 import os
 import random
@@ -6,10 +8,9 @@ import shutil
 import subprocess
 from contextlib import contextmanager
 
-from typing import List, Union
-
-import dateparser
+from typing import List, Optional, Tuple, Union
 
+import jnl.trace
 from jnl.entries import Entry
 
 
@@ -20,26 +21,36 @@ def file_contents(path: str):
 
 
 def makedirs(*args: str):
+    jnl.trace.count("syscall mkdir")
     return os.makedirs(*args)
 
 
-def check_call(args: List[str]):
-    subprocess.check_call(args)
+def check_call(args: List[str], cwd: str = None):
+    subprocess.check_call(args, cwd=cwd)
 
 
 def exists(path: str):
     return os.path.exists(path)
 
 
+def lexists(path: str):
+    """Like `exists` but True for a symlink whatever it points to."""
+    jnl.trace.count("syscall lstat")
+    return os.path.lexists(path)
+
+
 def readlink(path: str):
+    jnl.trace.count("syscall readlink")
     return os.readlink(path)
 
 
 def symlink(source: str, destination: str):
+    jnl.trace.count("syscall symlink")
     return os.symlink(source, destination)
 
 
 def unlink(path: str):
+    jnl.trace.count("syscall unlink")
     return os.unlink(path)
 
 
@@ -47,6 +58,7 @@ def rmtree(path: str):
     """Remove everything in a directory but don't remove the directory itself.
     This is useful if you have things referring to the file inode itself or
     things that generally get confused about treating a directory as symbolic name."""
+    jnl.trace.count("rmtree")
     for f in glob.glob(os.path.join(path, "*")):
         if os.path.isfile(f) or os.path.islink(f):
             os.remove(f)
@@ -58,6 +70,58 @@ def rmtree(path: str):
                 raise e
 
 
+def replace_dir(staging: str, path: str):
+    """Put the directory staging where path is, in one step where the OS
+    can do that, so anyone looking sees all of the old tree or all of the
+    new one. path needn't exist. What was there is removed afterwards."""
+    jnl.trace.count("syscall rename")
+    if not os.path.lexists(path):
+        os.rename(staging, path)
+        return
+    if not _exchange(staging, path):
+        # No atomic exchange here: for a moment there's nothing at path.
+        aside = staging + ".old"
+        os.rename(path, aside)
+        os.rename(staging, path)
+        os.rename(aside, staging)
+    shutil.rmtree(staging)
+
+
+_AT_FDCWD = -100
+_RENAME_EXCHANGE = 2
+"""renameat2's flag on Linux; renamex_np's RENAME_SWAP on macOS is 2 too"""
+
+
+@functools.lru_cache(maxsize=None)
+def _libc():
+    import ctypes
+    import ctypes.util
+
+    return ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+
+
+def _exchange(a: str, b: str) -> bool:
+    """Swap what's at a and b with a single rename. False if neither the C
+    library nor the filesystem can."""
+    import ctypes
+
+    libc = _libc()
+    if hasattr(libc, "renameat2"):
+        result = libc.renameat2(
+            _AT_FDCWD, os.fsencode(a), _AT_FDCWD, os.fsencode(b), _RENAME_EXCHANGE
+        )
+    elif hasattr(libc, "renamex_np"):
+        result = libc.renamex_np(os.fsencode(a), os.fsencode(b), _RENAME_EXCHANGE)
+    else:
+        return False
+    if result == 0:
+        return True
+    error = ctypes.get_errno()
+    if error in (errno.ENOSYS, errno.EINVAL, errno.ENOTSUP, errno.EOPNOTSUPP):
+        return False
+    raise OSError(error, os.strerror(error), a, None, b)
+
+
 @contextmanager
 def in_dir(path: str) -> None:
     old_dir = os.getcwd()
@@ -72,8 +136,44 @@ def _git_run(git_dir, *git_command: Union[str, List[str]]):
     if isinstance(git_command, str):
         git_command = [git_command]
     command = ["git", *git_command]
-    with in_dir(git_dir):
-        check_call(command)
+    # cwd= rather than in_dir: chdir would affect every thread
+    with jnl.trace.span("git %s", " ".join(command[1:])):
+        check_call(command, cwd=git_dir)
+
+
+async def git_async(git_dir: str, *git_command: str, capture=False) -> Optional[str]:
+    """Run git in git_dir without blocking the event loop. Returns its
+    stdout if `capture` else None; raises CalledProcessError on failure."""
+    import asyncio
+
+    command = ["git", *git_command]
+    with jnl.trace.span("git %s", " ".join(git_command)):
+        process = await asyncio.create_subprocess_exec(
+            *command,
+            cwd=git_dir,
+            stdout=asyncio.subprocess.PIPE if capture else None,
+            stderr=asyncio.subprocess.DEVNULL if capture else None,
+        )
+        out, _ = await process.communicate()
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, command)
+    return out.decode() if capture else None
+
+
+async def git_head(git_dir: str) -> Optional[str]:
+    """The commit HEAD points to or None if there isn't one yet."""
+    try:
+        return (await git_async(git_dir, "rev-parse", "HEAD", capture=True)).strip()
+    except subprocess.CalledProcessError:
+        return None
+
+
+async def git_changed_since(git_dir: str, commit: str) -> List[str]:
+    """Paths (relative to git_dir) that differ between commit and HEAD."""
+    out = await git_async(
+        git_dir, "diff", "--name-only", "--relative", "-z", commit, "HEAD", capture=True
+    )
+    return [path for path in out.split("\0") if path]
 
 
 def git_stat(git_dir: str):
@@ -84,6 +184,44 @@ def git_mv(git_dir: str, old: str, new: str):
     _git_run(git_dir, "mv", old, new)
 
 
+def in_git_repo(path: str) -> bool:
+    result = subprocess.run(
+        ["git", "rev-parse", "--is-inside-work-tree"],
+        cwd=path,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    return result.returncode == 0
+
+
+def git_mv_many(git_dir: str, renames: List[Tuple[str, str]]):
+    """Rename files (paths relative to git_dir) then record all of them in a
+    single `git update-index` rather than one `git mv` per file."""
+    for old, new in renames:
+        new = os.path.join(git_dir, new)
+        os.makedirs(os.path.dirname(new), exist_ok=True)
+        os.rename(os.path.join(git_dir, old), new)
+    jnl.trace.count("syscall rename", len(renames))
+    if not renames or not in_git_repo(git_dir):
+        return
+    paths = "".join("%s\0%s\0" % pair for pair in renames)
+    with jnl.trace.span("git update-index (%d renames)", len(renames)):
+        subprocess.run(
+            ["git", "update-index", "--add", "--remove", "-z", "--stdin"],
+            cwd=git_dir,
+            input=paths.encode(),
+            check=True,
+        )
+
+
+def git_stage(git_dir: str, path: str):
+    """Stage path (relative to git_dir) as it is now: added, changed, or gone."""
+    if exists(os.path.join(git_dir, path)):
+        _git_run(git_dir, "add", "--", path)
+    else:
+        _git_run(git_dir, "rm", "-q", "--cached", "--ignore-unmatch", "--", path)
+
+
 def git_pull(git_dir: str):
     _git_run(git_dir, "pull")
 
@@ -149,5 +287,15 @@ def yyyymmdd() -> str:
     return "%04d-%02d-%02d" % (d.year, d.month, d.day)
 
 
+def setxattr(path: str, name: str, value: bytes):
+    import xattr
+
+    jnl.trace.count("syscall setxattr")
+    return xattr.setxattr(path, name, value)
+
+
 def parse(somedate) -> str:
+    # dateparser takes a few hundred ms to import so only load it when needed
+    import dateparser
+
     return dateparser.parse(somedate)
@@ -0,0 +1,101 @@
+"""Opt-in timers and counters for jnl's hot paths, turned on by `--trace`.
+
+While disabled `span` hands back a shared no-op context manager and `count`
+returns immediately so the instrumentation can stay in hot loops."""
+
+import json
+import threading
+import time
+from collections import defaultdict
+from contextlib import nullcontext
+from typing import Dict, List, TextIO, Tuple
+
+_enabled = False
+_lock = threading.Lock()
+_spans: List[Tuple[str, float, float, int]] = []
+"""(name, start, duration, thread id) of every finished span"""
+_counters: Dict[str, int] = defaultdict(int)
+_origin = time.perf_counter()
+_NOT_TRACING = nullcontext()
+
+
+def enable() -> None:
+    global _enabled, _origin
+    _enabled = True
+    _origin = time.perf_counter()
+
+
+def reset() -> None:
+    """Disable tracing and forget everything recorded so far."""
+    global _enabled
+    _enabled = False
+    with _lock:
+        _spans.clear()
+        _counters.clear()
+
+
+def enabled() -> bool:
+    return _enabled
+
+
+class _Span:
+    def __init__(self, name: str):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        duration = time.perf_counter() - self.start
+        with _lock:
+            _spans.append((self.name, self.start, duration, threading.get_ident()))
+
+
+def span(name: str, *args):
+    """Time a block as `name % args`. Formatting only happens when enabled."""
+    if not _enabled:
+        return _NOT_TRACING
+    return _Span(name % args if args else name)
+
+
+def count(name: str, amount: int = 1) -> None:
+    if not _enabled:
+        return
+    with _lock:
+        _counters[name] += amount
+
+
+def report(out: TextIO) -> None:
+    """Per-phase totals, slowest first, followed by the counters."""
+    totals: Dict[str, List[float]] = defaultdict(lambda: [0, 0.0])
+    for name, _, duration, _ in _spans:
+        totals[name][0] += 1
+        totals[name][1] += duration
+    out.write("%10s %8s  phase\n" % ("wall ms", "calls"))
+    for name, (calls, seconds) in sorted(totals.items(), key=lambda kv: -kv[1][1]):
+        out.write("%10.1f %8d  %s\n" % (seconds * 1000, calls, name))
+    if _counters:
+        out.write("%10s  counter\n" % "count")
+        for name, value in sorted(_counters.items()):
+            out.write("%10d  %s\n" % (value, name))
+
+
+def chrome_trace() -> Dict:
+    """Spans in the Chrome trace event format (chrome://tracing, Perfetto)."""
+    events = [
+        {
+            "name": name,
+            "ph": "X",
+            "ts": (start - _origin) * 1e6,
+            "dur": duration * 1e6,
+            "pid": 1,
+            "tid": thread,
+        }
+        for name, start, duration, thread in _spans
+    ]
+    return {"traceEvents": events, "otherData": dict(_counters)}
+
+
+def dump_chrome_trace(path: str) -> None:
+    with open(path, "w") as handle:
+        json.dump(chrome_trace(), handle)
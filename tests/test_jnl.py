@@ -1,9 +1,17 @@
+import datetime
+import io
+import json
 import random
+import re
 import shutil
+import subprocess
 import tempfile
+import threading
+import time
 import os
 import sys
-from contextlib import contextmanager
+from contextlib import contextmanager, redirect_stderr, redirect_stdout
+from itertools import islice
 
 import jnl.entries
 import jnl.system as system
@@ -16,8 +24,17 @@ import unittest
 import mock
 from mock import patch
 
+import jnl.changes
 import jnl.cli
+import jnl.corpus
+import jnl.daemon
+import jnl.database
 import jnl.entries
+import jnl.layout
+import jnl.listeners
+import jnl.parallel
+import jnl.rewrite
+import jnl.trace
 
 bin_dir = os.path.join(os.path.dirname(__file__), "..", "bin")
 fixture_dir = os.path.join(bin_dir, "..", "tests", "fixtures")
@@ -64,6 +81,152 @@ class TestTag(unittest.TestCase):
             ["@ft", "@done", "@quick(other-foo)", "@abc"],
         )
 
+    def test_scan_matches_per_line_parse(self):
+        text = (
+            "\n"
+            "My Reference: ABC  \n"
+            "@quick(daily/2021-01-01) @ft\n"
+            "@foo(unclosed\n"
+            "still) @bar\n"
+            "@quick(One/Jane Doe/2021-01-01)\n"
+            "@before @noscan @after\n"
+            "@quick(ignored)\n"
+        )
+        per_line = []
+        for line in text.splitlines(keepends=True):
+            per_line.extend(jnl.entries.Tag.parse(line))
+            if "noscan" in [t.name for t in per_line]:
+                break
+        scanned = jnl.entries.Tag.scan(text)
+        assert [str(t) for t in scanned] == [str(t) for t in per_line]
+        assert [str(t) for t in scanned][-2:] == ["@noscan", "@after"]
+
+        tags = jnl.entries.TagSet(scanned)
+        assert tags.daily == "2021-01-01"
+        assert tags.one_on_one == ("Jane Doe", "2021-01-01")
+        assert tags.single_quick is None
+        assert tags.has("foo") and not tags.has("quick", "ignored")
+        assert tags.starts_with("quick", "One/")
+
+    def test_long_values(self):
+        person = "x" * 300
+        tag = "@quick(One/%s/2021-01-01)" % person
+        self.parses(tag + " @ft", [tag, "@ft"])
+        line = "@quick(One/%s/2021-01-01)\n" % person
+        assert jnl.entries.Entry.ft_tag_to_obsidian(line) == (
+            "#one/%s 2021-01-01\n" % person
+        )
+        # too long to be worth scanning for
+        assert [str(t) for t in jnl.entries.Tag.scan(line)] == ["@quick"]
+
+
+class TestEntry(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def entry(self, contents: str) -> jnl.entries.Entry:
+        with open(os.path.join(self.tmp_dir, "ABC.txt"), "w") as handle:
+            handle.write(contents)
+        return jnl.entries.Entry(worklogs_path=self.tmp_dir, file_name="ABC.txt")
+
+    def test_lines(self):
+        entry = self.entry("one\ntwo @ft\n\nfour")
+        assert [*entry.lines()] == [
+            ("one\n", 0),
+            ("two @ft\n", 1),
+            ("\n", 2),
+            ("four", 3),
+        ]
+        assert [*entry.lines(1, 2, strip=True)] == [("two @ft", 1), ("", 2)]
+        assert [*entry.lines(3, 10)] == [("four", 3)]
+        assert [*self.entry("").lines()] == []
+
+    def test_reads_file_once(self):
+        entry = self.entry("foo\nbar @ft\nfoo again\n")
+        with patch("jnl.entries.open", wraps=open, create=True) as opened:
+            matches = entry.matches(re.compile("foo"))
+            assert [m.matched_line_index for m in matches] == [0, 2]
+            for m in matches:
+                m.print(mock.MagicMock(), before_context=1, after_context=1)
+            assert [str(t) for t in entry.tags] == ["@ft"]
+        assert opened.call_count == 1
+
+    def test_tags_keep_no_text(self):
+        entry = self.entry("foo\nbar @ft\n")
+        assert [str(t) for t in entry.tags] == ["@ft"]
+        assert entry._content is None
+
+    def test_indexing_keeps_no_text(self):
+        jnl_dir = os.path.join(self.tmp_dir, "typical")
+        shutil.copytree(os.path.join(fixture_dir, "typical"), jnl_dir)
+        database = jnl.database.Database(entry_listeners=[], dbdir=jnl_dir)
+        assert database.entries
+        assert all(e._content is None for e in database.entries)
+
+    def test_rereads_changed_file(self):
+        entry = self.entry("@ft\n")
+        assert [str(t) for t in entry.tags] == ["@ft"]
+        with open(entry.file_path(), "w") as handle:
+            handle.write("@done and more\n")
+        assert [line for line, _ in entry.lines()] == ["@done and more\n"]
+        assert [str(t) for t in entry.tags] == ["@done"]
+
+    def test_scan_policy(self):
+        policy = jnl.entries.ScanPolicy(
+            full_scan_bytes=100, head_bytes=40, tail_bytes=20, max_line_chars=30
+        )
+        junk = "".join("junk line %d @junk\n" % i for i in range(20))
+        with patch.object(jnl.entries.Entry, "SCAN_POLICY", policy):
+            entry = self.entry("@head\n" + junk + "@tail\n")
+            assert [str(t) for t in entry.tags] == ["@head", "@junk", "@tail"]
+            # only the head and tail were read
+            assert entry._content is None
+
+            entry = self.entry("@head @noscan\n" + junk + "@tail\n")
+            assert [str(t) for t in entry.tags] == ["@head", "@noscan"]
+
+            entry = self.entry("@a\n" + "@b " * 20 + "\n@c\n")
+            assert [str(t) for t in entry.tags] == ["@a", "@c"]
+            entry = self.entry("@b " * 12 + "\n@c\n" + "@b " * 12)
+            assert [str(t) for t in entry.tags] == ["@c"]
+
+            assert self.entry("\0@ft\n").tags == ()
+
+    def test_undecodable_files(self):
+        path = os.path.join(self.tmp_dir, "worklogs")
+        os.makedirs(path)
+        with open(os.path.join(path, "LATIN.txt"), "wb") as handle:
+            handle.write("@quick(latin) caf\xe9\n".encode("latin-1"))
+        with open(os.path.join(path, "BINARY.txt"), "wb") as handle:
+            handle.write(b"\xff\xd8\xff\0@quick(binary)\n")
+        for use_index in (False, True):
+            database = jnl.database.Database(
+                entry_listeners=[], dbdir=self.tmp_dir, use_index=use_index
+            )
+            tags = {e.file_name: [str(t) for t in e.tags] for e in database.entries}
+            assert tags == {"BINARY.txt": [], "LATIN.txt": ["@quick(latin)"]}
+
+    def test_unclosed_parens_scan_quickly(self):
+        entry = self.entry("@a(" * 20000 + "\n@ft\n")
+        assert [str(t) for t in entry.tags] == ["@ft"]
+        assert len(jnl.entries.Tag.scan("@a(" * 20000)) == 20000
+
+    def test_compact(self):
+        entry = self.entry("@ft\n")
+        assert not hasattr(entry, "__dict__")
+        assert entry.tags[0].name is sys.intern("".join(["f", "t"]))
+        assert entry.file_name == "ABC.txt"
+        entry.file_name = "ABC.md"
+        assert entry.file_path() == os.path.join(self.tmp_dir, "ABC.md")
+
+    def test_rewrite(self):
+        entry = self.entry("@quick(One/Some One/2021-01-02)\nother\n")
+        entry.convert_ft_tags_to_obsidian()
+        assert [*entry.lines()] == [("#one/Some_One 2021-01-02\n", 0), ("other\n", 1)]
+
 
 # TODO: case of multiple files saying @quick(something).
 # A symlink can't point to 2 things.
@@ -148,6 +311,76 @@ class TestDatabase(unittest.TestCase):
             "@quick(entry-one-two)",
         )
 
+    def test_query(self):
+        main, jnl_dir = self.main_with_fixture("typical")
+        database = main.database
+        Tag = jnl.entries.Tag
+        done = database.create_entry(
+            [Tag(name="quick", value="daily/2021-01-04"), Tag(name="done")]
+        )
+        todo = database.create_entry([Tag(name="quick", value="daily/2021-01-05")])
+        project = database.create_entry([Tag(name="project", value="foobar")])
+
+        def guids(expression):
+            return [e.guid for e in database.query(expression)]
+
+        assert guids("quick:daily/2021-* AND NOT @done OR project:foo*") == [
+            todo.guid,
+            project.guid,
+        ]
+        assert guids("@quick(tickets/PERF-1188)") == ["HMKYKM4NNG4KREW61D55"]
+        assert guids("quick:daily/2021-01-0? done") == [done.guid]
+        assert guids("not (ft or project) AND @with") == ["W5BNE202WYF031H7J3RY"]
+        assert guids("NOT quick") == [project.guid]
+        assert guids("project:*bar AND NOT quick:*2021*") == [project.guid]
+        assert guids('quick:"no such thing"') == []
+        for bad in ["", "@done AND", "(@done", "@done)", "OR @done", ":foo"]:
+            with self.assertRaises(ValueError):
+                database.query(bad)
+
+    def test_reads_each_file_once(self):
+        main, jnl_dir = self.main_with_fixture("empty")
+        worklogs = os.path.join(jnl_dir, "worklogs")
+        os.makedirs(worklogs, exist_ok=True)
+        contents = ["scratch %d\n" % i for i in range(20)] + [
+            "@quick(daily/2021-01-04)\n",
+            "@quick(daily/2021-01-05)\n",
+            "@quick(One/Jane/2021-01-05)\n",
+            "@quick(notes)\n",
+        ]
+        for i, text in enumerate(contents):
+            with open(os.path.join(worklogs, "E%02d.txt" % i), "w") as handle:
+                handle.write(text)
+        database = jnl.database.Database(
+            entry_listeners=[], dbdir=jnl_dir, use_index=False
+        )
+
+        def lookups():
+            assert database.daily_entry("2021-01-05").guid == "E21"
+            assert database.yesterday_entry().guid == "E20"
+            assert [e.guid for e in database.query("quick:One/*")] == ["E22"]
+            for entry in database.entries:
+                entry.has_tag("done")
+                entry.tag_starts_with("quick", "daily/")
+                entry.is_a_daily_entry()
+                entry.single_quick_entry()
+                entry.one_on_one_entry()
+                entry.forget_content()
+
+        with patch("jnl.entries.open", wraps=open, create=True) as opened:
+            for _ in range(3):
+                lookups()
+            assert opened.call_count == len(contents)
+
+            with open(os.path.join(worklogs, "E05.txt"), "a") as handle:
+                handle.write("@done\n")
+            opened.reset_mock()
+            database.refresh()
+            lookups()
+            assert [e.guid for e in database.entries_with_tag("done")] == ["E05"]
+            # just the edited one
+            assert opened.call_count == 1
+
     def has_tags(self, entry, *tags):
         assert set([str(t) for t in entry.tags]) == set(tags)
 
@@ -188,6 +421,41 @@ class TestDatabase(unittest.TestCase):
 
         assert another_daily is not daily
 
+    def test_lookups(self):
+        main, jnl_dir = self.main_with_fixture("empty")
+        database = main.database
+        made = {}
+        for name, value in [
+            ("project", "foo/bar"),
+            ("project", "foo"),
+            ("project", "food"),
+            ("project", "baz"),
+            ("quick", "daily/2021-01-03"),
+            ("quick", "daily/2021-01-01"),
+            ("quick", "daily/2021-01-02"),
+        ]:
+            made[value] = database.create_entry(
+                [jnl.entries.Tag(name=name, value=value)]
+            )
+
+        assert database.entries_with_project("foo") == [
+            made["foo/bar"],
+            made["foo"],
+            made["food"],
+        ]
+        assert database.entries_with_project("nope") == []
+        assert database.entry_with_guid(made["baz"].guid) is made["baz"]
+        assert database.entries_with_tag("project") == [
+            made[v] for v in ["foo/bar", "foo", "food", "baz"]
+        ]
+        assert database.yesterday_entry() is made["daily/2021-01-02"]
+        assert database.daily_entry("2021-01-01") is made["daily/2021-01-01"]
+
+        # created after the lookups were built
+        today = database.daily_entry("2021-01-04")
+        assert database.daily_entry("2021-01-04") is today
+        assert database.yesterday_entry() is made["daily/2021-01-03"]
+
     class MockSystem(object):
         def __init__(self, root, files=None):
             self.files = files if files else {}
@@ -222,6 +490,9 @@ class TestDatabase(unittest.TestCase):
         def symlink(self, source, link_name):
             self.files[self._rmroot(link_name)] = ("symlink", self._rmroot(source))
 
+        def lexists(self, path):
+            return self.exists(path)
+
         def readlink(self, link):
             typ, path = self.files[self._rmroot(link)]
             assert typ == "symlink"
@@ -229,7 +500,7 @@ class TestDatabase(unittest.TestCase):
 
         def unlink(self, path):
             path = self._rmroot(path)
-            self.files = {k: v for k, v in self.files.items() if k == path}
+            self.files = {k: v for k, v in self.files.items() if k != path}
 
         def check_call(self, cmd):
             self.calls.append(cmd)
@@ -244,9 +515,22 @@ class TestDatabase(unittest.TestCase):
                 k: v for k, v in self.files.items() if not k.startswith(to_remove)
             }
 
+        def replace_dir(self, staging, path):
+            staging, path = self._rmroot(staging), self._rmroot(path)
+            files = {}
+            for k, v in self.files.items():
+                if k == staging or k.startswith(staging + "/"):
+                    files[path + k[len(staging) :]] = v
+                elif k != path and not k.startswith(path + "/"):
+                    files[k] = v
+            self.files = files
+
         def yyyymmdd(self):
             return "1995-03-27"
 
+        def setxattr(self, path, name, value):
+            self.calls.append(["setxattr", self._rmroot(path), name])
+
     def test_creates_symlinks(self):
         (main, jnl_dir) = self.main_with_fixture("typical")
         msys = TestDatabase.MockSystem(jnl_dir)
@@ -323,6 +607,164 @@ class TestDatabase(unittest.TestCase):
             "root/worklogs": "dir",
         }
 
+    def test_incremental_scan_only_touches_changes(self):
+        main, jnl_dir = self.main_with_fixture("typical")
+        msys = TestDatabase.MockSystem(jnl_dir)
+        with with_replacement(jnl, "system", msys):
+            main.database.scan()
+        before = dict(msys.files)
+
+        entry_path = os.path.join(jnl_dir, "worklogs", "HMKYKM4NNG4KREW61D55.txt")
+        with open(entry_path, "w") as handle:
+            handle.write("@quick(daily/2018-05-30) @quick(renamed)\n")
+
+        symlinked = []
+        msys.symlink = lambda source, link_name: symlinked.append(link_name)
+        msys.rmtree = lambda path: self.fail("Incremental scan shouldn't rmtree")
+        main = jnl.cli.Main(dbdir=jnl_dir)
+        with with_replacement(jnl, "system", msys):
+            main.database.scan()
+
+        assert symlinked == [os.path.join(jnl_dir, "quick", "renamed.txt")]
+        removed = set(before) - set(msys.files)
+        assert removed == {
+            "root/quick/entry-one-one.txt",
+            "root/quick/entry-one-two.txt",
+            "root/quick/tickets/PERF-1188.txt",
+        }
+
+    def test_full_scan_rebuilds(self):
+        main, jnl_dir = self.main_with_fixture("typical")
+        msys = TestDatabase.MockSystem(jnl_dir)
+        with with_replacement(jnl, "system", msys):
+            main.database.scan()
+            msys.files["root/quick/stray.txt"] = ("symlink", "root/elsewhere")
+            main.database.scan()
+            assert "root/quick/stray.txt" in msys.files
+            main.database.scan(full=True)
+            assert "root/quick/stray.txt" not in msys.files
+            assert "root/quick/example-tag.txt" in msys.files
+
+    def test_rebuild_swaps_in_a_whole_tree(self):
+        _, jnl_dir = self.main_with_fixture("typical")
+        database = jnl.database.Database(
+            entry_listeners=[
+                jnl.listeners.Symlinker(),
+                jnl.listeners.PreScanQuickCleaner(),
+            ],
+            dbdir=jnl_dir,
+        )
+        database.scan()
+        quick = database.path("quick")
+        before = sorted(os.listdir(quick))
+        replace_dir = jnl.system.replace_dir
+
+        def swap(staging, path):
+            # until now quick/ has been left alone
+            assert sorted(os.listdir(path)) == before
+            assert sorted(os.listdir(staging)) == before
+            replace_dir(staging, path)
+
+        def scan():
+            database.scan(full=True)
+            assert sorted(os.listdir(quick)) == before
+            assert os.readlink(os.path.join(quick, "example-tag.txt")) == (
+                os.path.join(jnl_dir, "worklogs", "W5BNE202WYF031H7J3RY.txt")
+            )
+            staging = jnl.listeners.Symlinker.staging_path(database)
+            assert not os.path.exists(staging)
+
+        with patch.object(jnl.system, "replace_dir", side_effect=swap) as replaced:
+            scan()
+            # two renames instead
+            with patch.object(jnl.system, "_exchange", return_value=False):
+                scan()
+        assert replaced.call_count == 2
+
+    def test_scan_restores_missing_links(self):
+        _, jnl_dir = self.main_with_fixture("typical")
+        database = jnl.database.Database(
+            entry_listeners=[
+                jnl.listeners.Symlinker(),
+                jnl.listeners.PreScanQuickCleaner(),
+            ],
+            dbdir=jnl_dir,
+        )
+        with redirect_stdout(io.StringIO()):
+            database.scan()
+            quick = os.path.join(jnl_dir, "quick")
+            before = sorted(os.listdir(quick))
+            os.unlink(os.path.join(quick, "example-tag.txt"))
+            database.scan()
+            assert sorted(os.listdir(quick)) == before
+            shutil.rmtree(quick)
+            database.scan()
+            assert sorted(os.listdir(quick)) == before
+
+    def test_scan_failing_part_way_is_followed_by_rebuild(self):
+        _, jnl_dir = self.main_with_fixture("typical")
+        database = jnl.database.Database(
+            entry_listeners=[
+                jnl.listeners.Symlinker(),
+                jnl.listeners.PreScanQuickCleaner(),
+            ],
+            dbdir=jnl_dir,
+        )
+        entry_path = os.path.join(jnl_dir, "worklogs", "HMKYKM4NNG4KREW61D55.txt")
+        quick = os.path.join(jnl_dir, "quick")
+        state_file = jnl.listeners.Symlinker.state_file(database)
+        with redirect_stdout(io.StringIO()):
+            database.scan()
+            with open(entry_path, "w") as handle:
+                handle.write("@quick(new-one) @quick(new-two)\n")
+            symlink = jnl.system.symlink
+            made = []
+
+            def fail_second(source, destination):
+                if made:
+                    raise OSError("disk full")
+                made.append(destination)
+                symlink(source, destination)
+
+            database.refresh()
+            with patch.object(jnl.system, "symlink", side_effect=fail_second):
+                with self.assertRaises(OSError):
+                    database.scan()
+            assert not os.path.exists(state_file)
+
+            with open(entry_path, "w") as handle:
+                handle.write("@quick(new-two)\n")
+            database.refresh()
+            database.scan()
+        assert sorted(os.listdir(quick)) == ["example-tag.txt", "new-two.txt"]
+        with open(state_file) as handle:
+            assert sorted(json.load(handle)) == ["example-tag.txt", "new-two.txt"]
+
+    def test_waiting_scans_coalesce(self):
+        import fcntl
+
+        _, jnl_dir = self.main_with_fixture("typical")
+        database = jnl.database.Database(entry_listeners=[], dbdir=jnl_dir)
+        database.scan()
+        scanned = []
+        listener = jnl.database.NopListener()
+        listener.on_pre_scan = lambda database: scanned.append(database)
+        database.entry_listeners = [listener]
+        for finished, expected in [("stale", 1), ("later", 0)]:
+            scanned.clear()
+            with open(database.state_path("scan.lock"), "a+") as held:
+                fcntl.flock(held, fcntl.LOCK_EX)
+                waiting = threading.Thread(target=database.scan)
+                waiting.start()
+                time.sleep(0.2)  # for it to start waiting
+                # as if a scan that was running the whole time just finished
+                listed_at = time.time_ns() if finished == "later" else 0
+                held.seek(0)
+                held.truncate()
+                held.write("%d 0\n" % listed_at)
+            waiting.join()
+            assert len(scanned) == expected, finished
+
     def test_cant_create_dupe_symlinks(self):
         main, jnl_dir = self.main_with_fixture("empty")
         one = main.database.create_entry([jnl.entries.Tag(name="quick", value="foo")])
@@ -336,6 +778,807 @@ class TestDatabase(unittest.TestCase):
         with self.assertRaises(Exception) as _:
             main.database.scan()
 
+    def test_cant_create_dupe_symlinks_parallel(self):
+        main, jnl_dir = self.main_with_fixture("empty")
+        for _ in range(8):
+            main.database.create_entry([jnl.entries.Tag(name="quick", value="foo")])
+        first, second = [e.file_path() for e in main.database.entries][:2]
+
+        with self.assertRaises(ValueError) as raised:
+            main.database.scan(jobs=4)
+        assert str(raised.exception) == (
+            "@quick(foo) owned by %s, so %s can't take it" % (first, second)
+        )
+
+    def test_parallel_scan_listener_order(self):
+        class Recorder(jnl.database.NopListener):
+            def __init__(self, thread_safe):
+                self.thread_safe = thread_safe
+                self.seen = []
+
+            def on_entry(self, database, entry):
+                self.seen.append(entry.guid)
+
+        concurrent, serial = Recorder(True), Recorder(False)
+        main, jnl_dir = self.main_with_fixture("typical")
+        database = jnl.database.Database(
+            entry_listeners=[concurrent, serial], dbdir=jnl_dir
+        )
+        database.scan(jobs=4)
+        guids = [e.guid for e in database.entries]
+        assert sorted(concurrent.seen) == guids
+        assert serial.seen == guids
+
+
+class TestEntryIndex(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.jnl_dir = os.path.join(self.tmp_dir, "typical")
+        shutil.copytree(os.path.join(fixture_dir, "typical"), self.jnl_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def database(self) -> jnl.database.Database:
+        return jnl.database.Database(entry_listeners=[], dbdir=self.jnl_dir)
+
+    def test_creates_ignored_state_dir(self):
+        self.database().entries
+        state_dir = os.path.join(self.jnl_dir, ".jnl")
+        assert os.path.exists(os.path.join(state_dir, "index.sqlite"))
+        with open(os.path.join(state_dir, ".gitignore")) as handle:
+            assert handle.read() == "*\n"
+
+    def test_unchanged_entries_not_reread(self):
+        first = [str(e) for e in self.database().entries]
+
+        def _fail(*args, **kwargs):
+            raise AssertionError("Shouldn't read unchanged entries")
+
+        with with_replacement(jnl.entries.Entry, "lines", _fail):
+            database = self.database()
+            assert [str(e) for e in database.entries] == first
+            daily = database.entries_with_tag("quick", "daily/2018-05-30")
+            assert [e.guid for e in daily] == ["HMKYKM4NNG4KREW61D55"]
+
+    def test_reparses_changed_and_drops_deleted(self):
+        self.database().entries
+        worklogs = os.path.join(self.jnl_dir, "worklogs")
+        with open(os.path.join(worklogs, "HMKYKM4NNG4KREW61D55.txt"), "w") as f:
+            f.write("@quick(changed) and some more text\n")
+        os.remove(os.path.join(worklogs, "W5BNE202WYF031H7J3RY.txt"))
+
+        entries = self.database().entries
+        assert [e.guid for e in entries] == ["HMKYKM4NNG4KREW61D55"]
+        assert [str(t) for t in entries[0].tags] == ["@quick(changed)"]
+
+    def test_search_candidates(self):
+        database = self.database()
+        database.entries
+        index = database._index
+        assert index.candidates(re.compile("sample ENTRY", re.I)) == {
+            "HMKYKM4NNG4KREW61D55"
+        }
+        assert index.candidates(re.compile("we (read|see)")) == {"W5BNE202WYF031H7J3RY"}
+        assert index.candidates(re.compile("nowhere to be found")) == set()
+        assert index.candidates(re.compile("[a-z]+")) is None
+
+    def test_entries_matching_only_reads_candidates(self):
+        database = self.database()
+        database.entries
+        opened = []
+        original = jnl.entries.Entry.lines
+
+        def _lines(entry, *args, **kwargs):
+            opened.append(entry.guid)
+            return original(entry, *args, **kwargs)
+
+        with with_replacement(jnl.entries.Entry, "lines", _lines):
+            found = database.entries_matching(re.compile("Including", re.I))
+            found = [guid for guid, _ in found]
+        assert found == ["W5BNE202WYF031H7J3RY"]
+        assert opened == ["W5BNE202WYF031H7J3RY"]
+
+    def needles(self, count: int):
+        worklogs = os.path.join(self.jnl_dir, "worklogs")
+        for i in range(count):
+            path = os.path.join(worklogs, "N%02d.txt" % i)
+            with open(path, "w") as f:
+                f.write("a needle\n")
+            os.utime(path, ns=(i * 10 ** 9, i * 10 ** 9))
+
+    def test_entries_matching_streams_by_recency(self):
+        self.needles(30)
+        database = self.database()
+        database.entries
+        opened = []
+        original = jnl.entries.Entry.lines
+
+        def _lines(entry, *args, **kwargs):
+            opened.append(entry.guid)
+            return original(entry, *args, **kwargs)
+
+        with with_replacement(jnl.entries.Entry, "lines", _lines):
+            results = database.entries_matching(re.compile("needle"), jobs=2)
+            first = [guid for guid, _ in islice(results, 3)]
+            results.close()
+        assert first == ["N29", "N28", "N27"]
+        assert len(opened) < 30
+
+    def test_since_until_skip_files_unopened(self):
+        self.needles(30)
+        database = self.database()
+        database.entries
+        opened = []
+        original = jnl.entries.Entry.lines
+
+        def _lines(entry, *args, **kwargs):
+            opened.append(entry.guid)
+            return original(entry, *args, **kwargs)
+
+        since = datetime.datetime.fromtimestamp(25)
+        until = datetime.datetime.fromtimestamp(27)
+        with with_replacement(jnl.entries.Entry, "lines", _lines):
+            found = database.entries_matching(
+                re.compile("needle"), since=since, until=until
+            )
+            found = [guid for guid, _ in found]
+        assert found == ["N27", "N26", "N25"]
+        assert sorted(opened) == ["N25", "N26", "N27"]
+
+    def test_rank(self):
+        self.needles(5)
+        with open(os.path.join(self.jnl_dir, "worklogs", "N00.txt"), "w") as f:
+            f.write("@quick(needle)\nneedle\n")
+            os.utime(f.name, ns=(0, 0))
+        found = self.database().entries_matching(re.compile("needle"), rank=True)
+        assert [guid for guid, _ in found] == ["N00", "N04", "N03", "N02", "N01"]
+
+    def test_search_filters(self):
+        argv = ["jnl", "search", "x", "--since", "2020-01-02", "--rank"]
+        assert jnl.cli.Main.search_filters(argv) == {
+            "rank": True,
+            "since": datetime.datetime(2020, 1, 2),
+        }
+
+    @patch.object(jnl.system, "open_entry")
+    def test_search_pages(self, open_entry):
+        import jnl.search
+
+        self.needles(15)
+        out = io.StringIO()
+        with patch("builtins.input", side_effect=["", "12"]):
+            jnl.search._search(self.database(), re.compile("needle"), out)
+        assert "No more matches" not in out.getvalue()
+        assert open_entry.call_args[0][0].guid == "N02"
+
+
+class TestBulkRewrite(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.jnl_dir = os.path.join(self.tmp_dir, "typical")
+        shutil.copytree(os.path.join(fixture_dir, "typical"), self.jnl_dir)
+        self.database = jnl.database.Database(entry_listeners=[], dbdir=self.jnl_dir)
+        self.one = self.database.create_entry(
+            [jnl.entries.Tag(name="quick", value="One/Some Body/2021-02-03")]
+        )
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_dry_run_diff(self):
+        changes = jnl.rewrite.plan(
+            self.database.entries, [jnl.entries.Entry.ft_tag_to_obsidian], jobs=4
+        )
+        assert [c.entry for c in changes] == [self.one]
+        out = io.StringIO()
+        jnl.rewrite.print_diff(changes, out)
+        assert "-@quick(One/Some Body/2021-02-03)  \n" in out.getvalue()
+        assert "+#one/Some_Body 2021-02-03  \n" in out.getvalue()
+        assert "One/Some Body" in self.one.content().text
+
+    def test_apply(self):
+        changes = jnl.rewrite.plan(
+            self.database.entries, [jnl.entries.Entry.ft_tag_to_obsidian]
+        )
+        jnl.rewrite.apply(changes)
+        assert "#one/Some_Body 2021-02-03" in self.one.content().text
+        worklogs = os.listdir(os.path.join(self.jnl_dir, "worklogs"))
+        assert not [f for f in worklogs if f.endswith(".tmp")]
+
+    def test_apply_failure_changes_nothing(self):
+        changes = jnl.rewrite.plan(
+            self.database.entries, [lambda line: line.replace("@", "!")]
+        )
+        assert len(changes) == 3
+        before = [c.entry.content().text for c in changes]
+        real_write_temp = jnl.entries.Entry.write_temp
+        written = []
+
+        def _write_temp(entry, text):
+            if written:
+                raise OSError("disk full")
+            written.append(entry)
+            return real_write_temp(entry, text)
+
+        with with_replacement(jnl.entries.Entry, "write_temp", _write_temp):
+            with self.assertRaises(OSError):
+                jnl.rewrite.apply(changes)
+        assert [c.entry.content().text for c in changes] == before
+        worklogs = os.listdir(os.path.join(self.jnl_dir, "worklogs"))
+        assert not [f for f in worklogs if f.endswith(".tmp")]
+
+    def test_batched_renames(self):
+        git = ["git", "-c", "user.name=t", "-c", "user.email=t@t"]
+        subprocess.check_call(git + ["init", "-q"], cwd=self.jnl_dir)
+        subprocess.check_call(git + ["add", "worklogs"], cwd=self.jnl_dir)
+        subprocess.check_call(git + ["commit", "-qm", "init"], cwd=self.jnl_dir)
+
+        entry = self.database.entry_with_guid("HMKYKM4NNG4KREW61D55")
+        self.database.rename_entries([(entry, "2018-05-30.txt")])
+
+        assert entry.file_name == "2018-05-30.txt"
+        assert "My Reference: HMKYKM4NNG4KREW61D55" in entry.content().text
+        status = subprocess.check_output(
+            ["git", "status", "--porcelain", "worklogs"], cwd=self.jnl_dir, text=True
+        )
+        assert status.splitlines() == [
+            "R  worklogs/HMKYKM4NNG4KREW61D55.txt -> worklogs/2018-05-30.txt"
+        ]
+
+    def test_rename_clash(self):
+        first, second = self.database.entries[:2]
+        with self.assertRaises(ValueError):
+            self.database.rename_entries([(first, second.file_name)])
+        with self.assertRaises(ValueError):
+            self.database.rename_entries([(first, "x.txt"), (second, "x.txt")])
+        assert os.path.exists(first.file_path())
+
+
+class TestLayout(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.jnl_dir = os.path.join(self.tmp_dir, "typical")
+        shutil.copytree(os.path.join(fixture_dir, "typical"), self.jnl_dir)
+        self.worklogs = os.path.join(self.jnl_dir, "worklogs")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def main(self) -> jnl.cli.Main:
+        main = jnl.cli.Main(dbdir=self.jnl_dir)
+        main.database.entry_listeners = [
+            jnl.listeners.Symlinker(),
+            jnl.listeners.PreScanQuickCleaner(),
+        ]
+        return main
+
+    def reshard(self, layout: str) -> None:
+        with redirect_stdout(io.StringIO()):
+            self.main().run(["jnl", "reshard", layout])
+
+    def test_reshard_and_back(self):
+        self.reshard("prefix")
+        daily = os.path.join(self.jnl_dir, "quick", "daily", "2018-05-30.txt")
+        assert os.readlink(daily) == os.path.join(
+            self.worklogs, "HM", "HMKYKM4NNG4KREW61D55.txt"
+        )
+        for use_index in (True, False):
+            database = jnl.database.Database(
+                entry_listeners=[], dbdir=self.jnl_dir, use_index=use_index
+            )
+            assert [e.relative_path() for e in database.entries] == [
+                "HM/HMKYKM4NNG4KREW61D55.txt",
+                "W5/W5BNE202WYF031H7J3RY.txt",
+            ]
+            assert database.entries_with_tag("quick", "example-tag")[0].guid == (
+                "W5BNE202WYF031H7J3RY"
+            )
+        created = database.create_entry()
+        assert created.relative_path() == os.path.join(
+            created.guid[:2], created.guid + ".txt"
+        )
+        os.unlink(created.file_path())
+
+        self.reshard("flat")
+        assert sorted(os.listdir(self.worklogs)) == [
+            "HMKYKM4NNG4KREW61D55.txt",
+            "W5BNE202WYF031H7J3RY.txt",
+        ]
+        assert os.readlink(daily) == os.path.join(
+            self.worklogs, "HMKYKM4NNG4KREW61D55.txt"
+        )
+
+    def test_month_layout_uses_daily_date(self):
+        self.reshard("month")
+        database = jnl.database.Database(entry_listeners=[], dbdir=self.jnl_dir)
+        daily = database.daily_entry("2018-05-30")
+        assert daily.relative_path() == "2018/05/HMKYKM4NNG4KREW61D55.txt"
+        assert jnl.layout.read(self.worklogs) == "month"
+
+    def test_reshard_renamed_daily(self):
+        with redirect_stdout(io.StringIO()):
+            self.main().run(["jnl", "rename-daily"])
+        self.reshard("month")
+        for use_index in (True, False):
+            database = jnl.database.Database(
+                entry_listeners=[], dbdir=self.jnl_dir, use_index=use_index
+            )
+            daily = database.daily_entry("2018-05-30")
+            assert daily.relative_path() == "2018/05/2018-05-30.txt"
+            assert daily.guid == "HMKYKM4NNG4KREW61D55"
+
+
+class TestCorpus(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.jnl_dir = os.path.join(self.tmp_dir, "typical")
+        shutil.copytree(os.path.join(fixture_dir, "typical"), self.jnl_dir)
+        worklogs = os.path.join(self.jnl_dir, "worklogs")
+        texts = {
+            "A1.txt": "first line\nfoo bar\nlast line, no newline foo",
+            "A2.txt": "éé foo\n\nFOO again\r\nfoo\n",
+            "A3.txt": "",
+        }
+        for name, text in texts.items():
+            with open(os.path.join(worklogs, name), "w", newline="") as handle:
+                handle.write(text)
+        self.database = jnl.database.Database(entry_listeners=[], dbdir=self.jnl_dir)
+        self.corpus = jnl.corpus.Corpus(self.database.state_path())
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def results(self, pattern, rank=False, processes=1):
+        self.database.refresh()
+        found = self.database.entries_matching(pattern, rank=rank, processes=processes)
+        return [
+            (guid, [(m.matched_line_index, m.match.span()) for m in matches])
+            for guid, matches in found
+        ]
+
+    def assert_same_results(self, *patterns):
+        for pattern in patterns:
+            self.corpus.delete()
+            expected = self.results(pattern)
+            self.corpus.create()
+            self.corpus.update(self.database.entries)
+            with patch.object(jnl.entries.Entry, "matches", side_effect=AssertionError):
+                assert self.results(pattern) == expected, pattern.pattern
+                # one pass over the whole corpus
+                ranked = self.results(pattern, rank=True)
+                assert sorted(ranked) == sorted(expected), pattern.pattern
+
+    def test_matches_searching_each_file(self):
+        self.assert_same_results(
+            re.compile("foo", re.I),
+            re.compile("^foo$"),
+            re.compile(r"foo\s*$", re.I),
+            re.compile(r"line\s+foo"),
+            re.compile(r"\w\w foo"),
+            re.compile("^"),
+            re.compile("$"),
+            re.compile("[^x]"),
+        )
+
+    @patch.object(jnl.corpus, "WINDOW_BYTES", 1)
+    def test_matches_one_segment_at_a_time(self):
+        self.assert_same_results(
+            re.compile("foo", re.I), re.compile("^"), re.compile("$")
+        )
+
+    def test_changed_entries_searched_from_files(self):
+        self.corpus.create()
+        self.corpus.update(self.database.entries)
+        path = os.path.join(self.jnl_dir, "worklogs", "A1.txt")
+        with open(path, "a") as handle:
+            handle.write("\nfoo appended")
+        assert self.results(re.compile("appended")) == [("A1", [(3, (4, 12))])]
+
+        self.corpus.update(self.database.entries)
+        with patch.object(jnl.entries.Entry, "matches", side_effect=AssertionError):
+            for rank in [False, True]:
+                assert self.results(re.compile("appended"), rank) == [
+                    ("A1", [(3, (4, 12))])
+                ]
+
+    def test_unsupported_patterns_search_files(self):
+        self.corpus.create()
+        self.corpus.update(self.database.entries)
+        for pattern in [r"\Afoo", r"foo(?!\n)", "foo.bar"]:
+            flags = re.DOTALL if "." in pattern else 0
+            assert self.corpus.matches(re.compile(pattern, flags), [], {}) is None
+
+    @patch.object(jnl.corpus, "MIN_DEAD_CHARS", 0)
+    def test_appends_changes_and_compacts(self):
+        self.corpus.create()
+        self.corpus.update(self.database.entries)
+        state_dir = self.database.state_path()
+        assert os.path.exists(os.path.join(state_dir, "corpus-0.txt"))
+        path = os.path.join(self.jnl_dir, "worklogs", "A1.txt")
+        for i in range(3):
+            with open(path, "w") as handle:
+                handle.write("%d\n\nlast line %s" % (i, "x" * 1000))
+            self.corpus.update(self.database.entries)
+        assert not os.path.exists(os.path.join(state_dir, "corpus-0.txt"))
+        assert self.results(re.compile("last line")) == [("A1", [(2, (0, 9))])]
+
+    @patch.object(jnl.parallel, "CHUNK", 2)
+    def test_worker_processes_match_searching_each_file(self):
+        for pattern in [
+            re.compile("foo", re.I),
+            re.compile("^foo$"),
+            re.compile("$"),
+            re.compile("[^x]"),
+            # not for a search over the whole file
+            re.compile(r"(?<=o)\s"),
+            re.compile(r"foo\Z"),
+        ]:
+            expected = self.results(pattern)
+            assert self.results(pattern, processes=2) == expected, pattern.pattern
+
+    def test_worker_processes_with_corpus(self):
+        self.corpus.create()
+        self.corpus.update(self.database.entries)
+        pattern = re.compile("foo", re.I)
+        expected = self.results(pattern)
+        with patch.object(jnl.parallel, "search", wraps=jnl.parallel.search) as used:
+            assert self.results(pattern, processes=2) == expected
+            assert self.results(pattern, rank=True, processes=2) == self.results(
+                pattern, rank=True
+            )
+        assert used.call_count == 2
+
+    def test_worker_hits_in_an_older_version_searched_again(self):
+        entry = self.database.entry_with_guid("A1")
+        matches = jnl.parallel._rebuild(entry, re.compile("foo"), [(0, 0, 3)])
+        assert [(m.matched_line_index, m.match.span()) for m in matches] == [
+            (1, (0, 3)),
+            (2, (22, 25)),
+        ]
+
+
+class TestSummary(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.jnl_dir = os.path.join(self.tmp_dir, "typical")
+        shutil.copytree(os.path.join(fixture_dir, "typical"), self.jnl_dir)
+        self.database = jnl.database.Database(entry_listeners=[], dbdir=self.jnl_dir)
+        self.days = {
+            day: self.database.daily_entry(day)
+            for day in ["2021-01-04", "2021-01-05", "2021-02-01"]
+        }
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def summarize(self):
+        return jnl.listeners.Summarizer.summarize(self.database)
+
+    def test_only_rewrites_changed_summaries(self):
+        assert self.summarize() == [
+            "monthly/2018-05",
+            "monthly/2021-01",
+            "monthly/2021-02",
+            "weekly/2018-W22",
+            "weekly/2021-W01",
+            "weekly/2021-W05",
+        ]
+        path = os.path.join(self.jnl_dir, "summary", "weekly", "2021-W01.txt")
+        with open(path) as f:
+            text = f.read()
+        assert "## 2021-01-04\n\n@quick(daily/2021-01-04)" in text
+        assert "My Reference" not in text
+        assert self.summarize() == []
+
+        with open(self.days["2021-01-05"].file_path(), "a") as f:
+            f.write("did a thing\n")
+        assert self.summarize() == ["monthly/2021-01", "weekly/2021-W01"]
+        with open(path) as f:
+            assert f.read().endswith("did a thing\n")
+
+        os.unlink(self.days["2021-02-01"].file_path())
+        self.database.refresh()
+        assert self.summarize() == []
+        summaries = os.path.join(self.jnl_dir, "summary")
+        assert not os.path.exists(os.path.join(summaries, "monthly", "2021-02.txt"))
+        assert not os.path.exists(os.path.join(summaries, "weekly", "2021-W05.txt"))
+
+
+class TestDaemon(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.jnl_dir = os.path.join(self.tmp_dir, "typical")
+        shutil.copytree(os.path.join(fixture_dir, "typical"), self.jnl_dir)
+        self.main = jnl.cli.Main(dbdir=self.jnl_dir)
+        self.daemon = jnl.daemon.Daemon(self.main)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_forward_without_daemon(self):
+        assert not jnl.daemon.forward(self.jnl_dir, ["jnl", "open", "X"])
+
+    def test_not_forwardable(self):
+        assert jnl.daemon.forwardable(["jnl"])
+        assert jnl.daemon.forwardable(["jnl", "today"])
+        assert not jnl.daemon.forwardable(["jnl", "sync"])
+        assert not jnl.daemon.forwardable(["jnl", "daemon"])
+
+    @patch.object(jnl.system, "open_entry")
+    def test_forwards_open(self, open_entry):
+        path = jnl.daemon.socket_path(self.jnl_dir)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with self.daemon.server(path) as server:
+            thread = threading.Thread(target=server.serve_forever)
+            thread.start()
+            try:
+                argv = ["jnl", "open", "W5BNE202WYF031H7J3RY"]
+                assert jnl.daemon.forward(self.jnl_dir, argv)
+            finally:
+                server.shutdown()
+                thread.join()
+        assert [c[0][0].guid for c in open_entry.call_args_list] == [
+            "W5BNE202WYF031H7J3RY"
+        ]
+
+    def test_search_returns_options(self):
+        response = self.daemon.handle({"argv": ["jnl", "search", "sample"]})
+        assert response["error"] is None
+        assert "HMKYKM4NNG4KREW61D55.txt" in response["output"]
+        assert response["options"] == {0: "HMKYKM4NNG4KREW61D55"}
+
+    def test_reports_errors(self):
+        response = self.daemon.handle({"argv": ["jnl", "bogus"]})
+        assert "Don't know about action bogus" in response["error"]
+
+    def test_refresh_sees_new_entries(self):
+        assert len(self.main.database.entries) == 2
+        with open(os.path.join(self.jnl_dir, "worklogs", "NEW.txt"), "w") as f:
+            f.write("@quick(new)\n")
+        self.main.database.refresh()
+        assert self.main.database.entries_with_tag("quick", "new")[0].guid == "NEW"
+
+    def test_watching_survives_exceptions(self):
+        class Flaky(jnl.database.NopListener):
+            scans = 0
+
+            def on_post_scan(self, database):
+                self.scans += 1
+                if self.scans == 1:
+                    raise ValueError("flaky")
+
+        class Stop(Exception):
+            pass
+
+        flaky = Flaky()
+        self.main.database.entry_listeners = [flaky]
+        worklogs = os.path.join(self.jnl_dir, "worklogs")
+        names = iter(["ONE.txt", "TWO.txt"])
+
+        def sleep(_):
+            name = next(names, None)
+            if name is None:
+                raise Stop
+            with open(os.path.join(worklogs, name), "w") as f:
+                f.write("@quick(%s)\n" % name)
+
+        err = io.StringIO()
+        with patch.object(
+            jnl.daemon, "_watch_inotify", side_effect=OSError
+        ), patch.object(jnl.daemon.time, "sleep", side_effect=sleep):
+            with redirect_stderr(err), self.assertRaises(Stop):
+                jnl.daemon.watch(worklogs, self.daemon.on_change, 0)
+        assert "ValueError: flaky" in err.getvalue()
+        assert flaky.scans == 2
+        assert self.main.database.entries_with_tag("quick", "TWO.txt")
+
+
+class TestSync(unittest.TestCase):
+    GIT = ["git", "-c", "user.name=t", "-c", "user.email=t@t"]
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        remote = os.path.join(self.tmp_dir, "remote.git")
+        self.jnl_dir = os.path.join(self.tmp_dir, "typical")
+        self.other = os.path.join(self.tmp_dir, "other")
+        shutil.copytree(os.path.join(fixture_dir, "typical"), self.jnl_dir)
+        self.git(self.tmp_dir, "init", "-q", "--bare", remote)
+        self.git(self.jnl_dir, "init", "-q")
+        self.git(self.jnl_dir, "add", "worklogs")
+        self.git(self.jnl_dir, "commit", "-qm", "init")
+        self.git(self.jnl_dir, "push", "-q", remote, "HEAD:refs/heads/main")
+        self.git(self.jnl_dir, "remote", "add", "origin", remote)
+        self.git(self.jnl_dir, "fetch", "-q", "origin")
+        self.git(self.jnl_dir, "branch", "-q", "--set-upstream-to=origin/main")
+        self.git(self.tmp_dir, "clone", "-q", "-b", "main", remote, self.other)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def git(self, cwd, *args):
+        subprocess.check_call(self.GIT + list(args), cwd=cwd)
+
+    def test_rescans_only_pulled_files(self):
+        path = os.path.join(self.other, "worklogs", "W5BNE202WYF031H7J3RY.txt")
+        with open(path) as f:
+            text = f.read()
+        with open(path, "w") as f:
+            f.write("@quick(pulled)\n" + text)
+        self.git(self.other, "commit", "-qam", "edit")
+        self.git(self.other, "push", "-q")
+
+        class Recorder(jnl.database.NopListener):
+            def on_post_scan(self, database):
+                self.changed = database.changed_files
+
+        recorder = Recorder()
+        main = jnl.cli.Main(dbdir=self.jnl_dir)
+        main.database.entry_listeners = [recorder]
+        with redirect_stdout(io.StringIO()):
+            main.sync(["jnl", "sync"])
+        assert recorder.changed == {"W5BNE202WYF031H7J3RY.txt"}
+        assert main.database.entries_with_tag("quick", "pulled")[0].guid == (
+            "W5BNE202WYF031H7J3RY"
+        )
+
+    def test_git_change_detection(self):
+        worklogs = os.path.join(self.jnl_dir, "worklogs")
+        edited = os.path.join(worklogs, "W5BNE202WYF031H7J3RY.txt")
+
+        def quick_tags():
+            database = jnl.database.Database(entry_listeners=[], dbdir=self.jnl_dir)
+            tags = [t for e in database.entries for t in e.tags]
+            return sorted(t.value for t in tags if t.name == "quick")
+
+        with with_replacement(jnl.changes.GitChanges, "MIN_ENTRIES", 1):
+            before = quick_tags()
+            quick_tags()  # now marked
+
+            with open(edited) as f:
+                text = f.read()
+            with open(edited, "w") as f:
+                f.write("@quick(edited)\n" + text)
+            with open(os.path.join(worklogs, "NEW.txt"), "w") as f:
+                f.write("@quick(new)\n")
+            with patch.object(os, "scandir", side_effect=AssertionError):
+                assert quick_tags() == sorted(before + ["edited", "new"])
+
+                self.git(self.jnl_dir, "checkout", "--", "worklogs")
+                self.git(self.jnl_dir, "rm", "-q", "worklogs/HMKYKM4NNG4KREW61D55.txt")
+                self.git(self.jnl_dir, "commit", "-qm", "rm")
+                assert quick_tags() == ["example-tag", "new"]
+
+    def test_scan_after_committed_rename(self):
+        database = jnl.database.Database(
+            entry_listeners=[
+                jnl.listeners.Symlinker(),
+                jnl.listeners.PreScanQuickCleaner(),
+            ],
+            dbdir=self.jnl_dir,
+        )
+        link = os.path.join(self.jnl_dir, "quick", "example-tag.txt")
+        with with_replacement(jnl.changes.GitChanges, "MIN_ENTRIES", 1):
+            with redirect_stdout(io.StringIO()):
+                database.scan()
+                database.refresh()
+                database.scan()  # now marked
+                self.git(
+                    self.jnl_dir,
+                    "mv",
+                    "worklogs/W5BNE202WYF031H7J3RY.txt",
+                    "worklogs/RENAMED.txt",
+                )
+                self.git(self.jnl_dir, "commit", "-qm", "rename")
+                database.refresh()
+                database.scan()
+        names = sorted(e.file_name for e in database.entries)
+        assert names == ["HMKYKM4NNG4KREW61D55.txt", "RENAMED.txt"]
+        assert os.readlink(link) == os.path.join(
+            self.jnl_dir, "worklogs", "RENAMED.txt"
+        )
+
+    def test_scan_gets_changes_from_git(self):
+        class Recorder(jnl.database.NopListener):
+            def on_post_scan(self, database):
+                self.changed = database.changed_files
+
+        recorder = Recorder()
+        database = jnl.database.Database(entry_listeners=[recorder], dbdir=self.jnl_dir)
+        with with_replacement(jnl.changes.GitChanges, "MIN_ENTRIES", 1):
+            database.scan()
+            assert recorder.changed is None
+            database.scan()
+            assert recorder.changed == set()
+            os.rename(
+                os.path.join(self.jnl_dir, "worklogs", "W5BNE202WYF031H7J3RY.txt"),
+                os.path.join(self.jnl_dir, "worklogs", "RENAMED.txt"),
+            )
+            database.refresh()
+            database.scan()
+            assert recorder.changed == {"W5BNE202WYF031H7J3RY.txt", "RENAMED.txt"}
+
+
+class TestTrace(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.jnl_dir = os.path.join(self.tmp_dir, "typical")
+        shutil.copytree(os.path.join(fixture_dir, "typical"), self.jnl_dir)
+
+    def tearDown(self):
+        jnl.trace.reset()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_disabled_records_nothing(self):
+        with jnl.trace.span("nothing %s", "here"):
+            jnl.trace.count("nothing")
+        assert jnl.trace.chrome_trace() == {"traceEvents": [], "otherData": {}}
+
+    def test_scan_breakdown(self):
+        jnl.trace.enable()
+        main = jnl.cli.Main(dbdir=self.jnl_dir)
+        msys = TestDatabase.MockSystem(self.jnl_dir)
+        with with_replacement(jnl, "system", msys):
+            main.database.scan()
+
+        trace = jnl.trace.chrome_trace()
+        names = {e["name"] for e in trace["traceEvents"]}
+        assert {
+            "Database.entries",
+            "Entry.tags",
+            "Entry.lines (read)",
+            "Symlinker.on_entry",
+            "Symlinker.on_post_scan",
+            "SetsOpenWith.on_entry",
+        } <= names
+        # each entry once for the index, then the daily again for its summary
+        assert trace["otherData"]["file opens"] == 3
+        out = io.StringIO()
+        jnl.trace.report(out)
+        assert "Database.entries" in out.getvalue()
+
+
+class TestStartup(unittest.TestCase):
+    BUDGET_SECONDS = 0.5
+    """For `jnl today` once the index is warm, not counting interpreter startup"""
+
+    SCRIPT = """
+import sys, time
+start = time.perf_counter()
+import jnl.cli, jnl.system
+jnl.system.open_entry = lambda entry: None
+jnl.system.setxattr = lambda path, name, value: None
+jnl.cli.main(["jnl", "today"])
+print(time.perf_counter() - start)
+heavy = ["dateparser", "xattr", "colorama", "mmap", "multiprocessing",
+         "concurrent.futures.process"]
+print(" ".join(m for m in heavy if m in sys.modules))
+"""
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.jnl_dir = os.path.join(self.tmp_dir, "typical")
+        shutil.copytree(os.path.join(fixture_dir, "typical"), self.jnl_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def today(self) -> (float, str):
+        out = subprocess.check_output(
+            [sys.executable, "-c", TestStartup.SCRIPT],
+            cwd=os.path.join(os.path.dirname(__file__), ".."),
+            env={**os.environ, "JNL_DIR": self.jnl_dir},
+            text=True,
+        )
+        elapsed, heavy = out.splitlines()[-2:]
+        return float(elapsed), heavy
+
+    def test_today_startup(self):
+        self.today()  # build the index
+        elapsed, heavy = self.today()
+        assert heavy == ""
+        assert elapsed < TestStartup.BUDGET_SECONDS
+
 
 if __name__ == "__main__":
     unittest.main()